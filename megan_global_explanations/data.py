@@ -6,14 +6,20 @@ based on the visual graph dataset format to represent the concept prototypes for
 """
 import os
 import json
+import pickle
+import hashlib
 import shutil
 import logging
+import threading
 import collections
+import multiprocessing as mp
 import typing as t
 import visual_graph_datasets.typing as tv
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
+import matplotlib as mpl
 import matplotlib.pyplot as plt
 from visual_graph_datasets.util import dynamic_import
 from visual_graph_datasets.data import VisualGraphDatasetReader
@@ -26,6 +32,14 @@ from graph_attention_student.torch.megan import Megan
 import megan_global_explanations.typing as tg
 from megan_global_explanations.utils import NULL_LOGGER
 from megan_global_explanations.utils import safe_int
+from megan_global_explanations.serialization import dump_json
+from megan_global_explanations.serialization import load_json
+
+# The name of the index file of a concept clustering folder, which contains the basic information about all the 
+# concepts such that the concept folders themselves do not have to be listed or opened to find specific concepts.
+INDEX_FILE_NAME: str = 'index.json'
+# The name of the file which contains the stacked centroids of all the concepts of a concept clustering folder.
+CENTROIDS_FILE_NAME: str = 'centroids.npy'
 
 # ~ Implementations
 
@@ -51,6 +65,72 @@ def update_dict(original: dict, update: dict) -> dict:
     return original
 
 
+def file_checksum(path: str) -> str:
+    """
+    Returns the SHA256 hex digest of the content of the file with the given ``path``.
+    """
+    with open(path, mode='rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def write_graph_element(processing: ProcessingBase,
+                        writer_cls: type,
+                        value: str,
+                        graph: tv.GraphDict,
+                        index: int,
+                        path: str,
+                        additional_metadata: dict = {},
+                        ) -> None:
+    """
+    Writes the given ``graph`` with the domain representation ``value`` as the visual graph element with the 
+    given ``index`` into the given folder ``path``, using the given ``processing`` instance to create the 
+    visualization and a new instance of the ``writer_cls`` to write the files.
+    
+    This is a module-level function so that it can be executed by the worker processes of the ConceptWriter.
+    """
+    writer: VisualGraphDatasetWriter = writer_cls(
+        path=path,
+    )
+    processing.create(
+        value=value,
+        graph=graph,
+        output_path=path,
+        index=index,
+        additional_metadata=additional_metadata,
+        writer=writer,
+    )
+
+
+def _initialize_writer_worker() -> None:
+    """
+    Initializer for the worker processes of the ConceptWriter. The workers only ever save the prototype 
+    visualizations to files, so the non-interactive Agg backend is used.
+    """
+    mpl.use('Agg')
+
+
+def _check_writer_worker(processing: ProcessingBase) -> bool:
+    """
+    No-op task for the worker processes of the ConceptWriter. The task only succeeds if the given ``processing`` 
+    instance can be unpickled in the worker process, which is for example not the case if its class was loaded 
+    dynamically from a file in the main process.
+    """
+    return True
+
+
+def stripped_graph_data(data: dict) -> dict:
+    """
+    Returns a copy of the given visual graph element dict ``data`` without the image path and without the 
+    graph dict in the metadata - which is the information that is already contained in the dataset anyways. 
+    In contrast to ``strip_graph_data``, the given dict is not modified and only the top level dicts are 
+    copied, so that the (large) graph dict is never copied.
+    """
+    stripped = {key: value for key, value in data.items() if key != 'image_path'}
+    stripped['metadata'] = {key: value for key, value in data['metadata'].items() if key != 'graph'}
+    
+    return stripped
+
+
 def strip_graph_data(data: dict,
                      data_keys: t.List[str] = ['image_path'],
                      graph_keys: t.List[str] = ['node_']):
@@ -72,12 +152,23 @@ class ConceptWriter():
                  model: t.Optional[Megan] = None,
                  logger: logging.Logger = NULL_LOGGER,
                  writer_cls: type = VisualGraphDatasetWriter,
+                 num_workers: int = 1,
                  ):
         self.path = path
         self.processing = processing
         self.model = model
         self.logger = logger
         self.writer_cls = writer_cls
+        # If this is larger than 1, the concepts are written in parallel. The prototype visualizations are 
+        # rendered by a pool of that many worker processes and the concept folders are written by a pool of 
+        # that many threads.
+        self.num_workers = num_workers
+        
+        # During a parallel write, this will hold the process pool that renders the prototype visualizations. 
+        # If the processing instance cannot be sent to worker processes, the prototypes are instead rendered 
+        # in the main process, one at a time, which is ensured by this lock.
+        self.process_pool: t.Optional[ProcessPoolExecutor] = None
+        self.render_lock = threading.Lock()
         
         # This attribute will later on hold the absolute path of where the model was actually saved 
         # to. This will be set in the self.write_model method.
@@ -85,10 +176,18 @@ class ConceptWriter():
         
     def write(self,
               concepts: tg.ConceptData,
+              metadata: dict = {},
+              mappers: t.Optional[t.Dict[int, t.Any]] = None,
               ) -> None:
         
         # This will persistently save the model to a file in the folder.
         self.write_model()
+        
+        # Optionally, the dimensionality reduction mappers (e.g. UMAP) which were fitted on the embeddings of 
+        # each channel can be saved alongside the concepts so that they can be re-used to project new 
+        # elements into the same 2D space later on without having to re-fit them.
+        if mappers:
+            self.write_mappers(mappers)
 
         # This method will write the concept metadata as a json file to the folder
         # It is important that this is called after the model writing, since we need to save the model path as part 
@@ -101,23 +200,126 @@ class ConceptWriter():
                 'channel_index': concept['channel_index'],
             })
         
+        # The optional additional metadata can be used to store information about the concept clustering as a 
+        # whole, such as the dataset indices that were considered during the extraction.
         self.write_metadata(data={
+            **metadata,
             'concepts': reduced_concepts
         })
         
-        for index, concept in enumerate(deepcopy(concepts)):
-            self.logger.info(f' * writing concept {index:03d}/{len(concepts)}')
-            self.write_concept(index, concept)
+        # The concept folders are first written to temporary folders, which may have been left behind by 
+        # a previous write that was interrupted.
+        self.remove_temp_folders()
+        
+        # Only shallow copies of the concept dicts are needed here because the writing of the individual concepts 
+        # never modifies the values of the concept dicts, it only replaces them. Deep copies would duplicate the 
+        # graph dicts of all the concept members in memory.
+        concepts_copy = [dict(concept) for concept in concepts]
+        if self.num_workers > 1:
+            self.write_concepts_parallel(concepts_copy)
+        else:
+            for index, concept in enumerate(concepts_copy):
+                self.logger.info(f' * writing concept {index:03d}/{len(concepts)}')
+                self.write_concept(index, concept)
+            
+        # The index file is written last so that it only exists if all the concepts were written completely.
+        self.write_index(concepts)
             
         # self.logger.info(' * writing concept processing')
         # self.write_processing()
             
+    def write_concepts_parallel(self, concepts: tg.ConceptData) -> None:
+        """
+        Writes the given ``concepts`` in parallel using a thread pool for the concept folders and a process 
+        pool for the rendering of the prototype visualizations.
+        """
+        process_pool = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=mp.get_context('spawn'),
+            initializer=_initialize_writer_worker,
+        )
+        # Being able to pickle the processing instance in the main process does not mean that it can be unpickled 
+        # by the worker processes (e.g. a processing class loaded dynamically from a "process.py" file). Therefore, 
+        # the pool is checked with an actual round trip of the processing instance.
+        try:
+            process_pool.submit(_check_writer_worker, self.processing).result()
+        except Exception as exc:
+            self.logger.info(f' * processing cannot be used by worker processes ({exc}) - '
+                             f'rendering prototypes in the main process')
+            process_pool.shutdown()
+            process_pool = None
+        
+        try:
+            self.process_pool = process_pool
+            with ThreadPoolExecutor(max_workers=self.num_workers) as thread_pool:
+                futures = [thread_pool.submit(self.write_concept, index, concept) 
+                           for index, concept in enumerate(concepts)]
+                for c, future in enumerate(futures):
+                    future.result()
+                    self.logger.info(f' * ({c+1}/{len(concepts)}) concepts written')
+        finally:
+            self.process_pool = None
+            if process_pool is not None:
+                process_pool.shutdown()
+            
+    def remove_temp_folders(self) -> None:
+        """
+        Removes all the temporary concept folders within the concept clustering folder.
+        """
+        for name in os.listdir(self.path):
+            if name.startswith('.') and name.endswith('.tmp'):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            
     def write_model(self) -> None:
         
         if self.model is not None:
             self.model_path = os.path.join(self.path, 'model.ckpt')
             self.model.save(self.model_path)
             
+    def write_mappers(self, mappers: t.Dict[int, t.Any]) -> None:
+        """
+        Saves the given ``mappers`` dict, whose keys are the channel indices and the values the corresponding 
+        fitted mapper objects (e.g. umap.UMAP), as pickle files into the "mappers" folder.
+        """
+        mappers_path = os.path.join(self.path, 'mappers')
+        os.makedirs(mappers_path, exist_ok=True)
+        
+        for channel_index, mapper in mappers.items():
+            mapper_path = os.path.join(mappers_path, f'{channel_index:02d}.pkl')
+            with open(mapper_path, mode='wb') as file:
+                pickle.dump(mapper, file)
+            
+    def write_index(self, concepts: tg.ConceptData) -> None:
+        """
+        Writes the index file of the concept clustering, which contains one entry for each of the given 
+        ``concepts`` with the name of the concept folder, the channel index, the number of members, the 
+        row of the concept centroid in the centroids file and the checksum of the concept metadata file.
+        The centroids of all concepts are saved as a single array into the centroids file.
+        
+        Based on that, the ConceptReader can access and filter the concepts without listing or opening 
+        all of the concept folders.
+        """
+        entries = []
+        for index, concept in enumerate(concepts):
+            name = f'{index:03d}'
+            metadata_path = os.path.join(self.path, name, 'metadata.json')
+            entries.append({
+                'index': index,
+                'path': name,
+                'channel_index': concept['channel_index'],
+                'size': len(concept.get('elements', concept.get('index_tuples', []))),
+                'centroid_offset': index,
+                'checksum': file_checksum(metadata_path),
+            })
+            
+        if len(concepts) != 0:
+            centroids = np.stack([np.asarray(concept['centroid'], dtype=float) for concept in concepts])
+            np.save(os.path.join(self.path, CENTROIDS_FILE_NAME), centroids)
+            
+        index_path = os.path.join(self.path, INDEX_FILE_NAME)
+        with open(index_path, mode='w') as file:
+            json.dump({'concepts': entries}, file, cls=NumericJsonEncoder)
+            
     def write_processing(self) -> None:
         content = create_processing_module(self.processing)
         processing_path = os.path.join(self.path, 'process.py')
@@ -135,8 +337,7 @@ class ConceptWriter():
             **data,
         }
         
-        with open(metadata_path, mode='w') as file:
-            json.dump(metadata, file, cls=NumericJsonEncoder)
+        dump_json(metadata, metadata_path)
                 
     def write_graph(self,
                     graph: tv.GraphDict,
@@ -152,32 +353,55 @@ class ConceptWriter():
         else:
             raise ValueError('No domain graph representation found for the given graph!')
                 
-        writer: VisualGraphDatasetWriter = self.writer_cls(
+        kwargs = dict(
+            processing=self.processing,
+            writer_cls=self.writer_cls,
+            value=value,
+            graph=graph,
+            index=index,
             path=path,
+            additional_metadata=additional_metadata,
         )
                 
         # To actually write the given graph as a visual graph element (a visualization PNG file and a 
         # metadata JSON file) we use the corresponding Processing instance. The "create" method will 
         # take care of this.
+        # A graph that cannot be processed is skipped in the same way, regardless of whether it is rendered 
+        # by a worker process or in the main process, so that the result does not depend on the number of workers.
         try:
-            self.processing.create(
-                value=value,
-                graph=graph,
-                output_path=path,
-                index=index,
-                additional_metadata=additional_metadata,
-                writer=writer,
-            )
+            if self.process_pool is not None:
+                self.process_pool.submit(write_graph_element, **kwargs).result()
+            else:
+                with self.render_lock:
+                    write_graph_element(**kwargs)
         except Exception as exc:
-            print(f'Processing of the graph "{value}" failed with exception: {exc}')
+            self.logger.info(f' * processing of the graph "{value}" failed with exception: {exc} - skipping')
                 
     def write_concept(self,
                       index: int,
                       concept: tg.ConceptDict,
                       ) -> None:
         
-        concept_path = os.path.join(self.path, f'{index:03d}')
+        # The concept is first written into a temporary folder which is only renamed to the actual concept 
+        # folder once it is complete. That way, an interrupted write never leaves a partial concept folder.
+        final_path = os.path.join(self.path, f'{index:03d}')
+        if os.path.exists(final_path):
+            raise FileExistsError(f'concept folder "{final_path}" already exists!')
+        
+        concept_path = os.path.join(self.path, f'.{index:03d}.tmp')
         os.mkdir(concept_path)
+        try:
+            self.write_concept_folder(concept_path, concept)
+        except BaseException:
+            shutil.rmtree(concept_path, ignore_errors=True)
+            raise
+        
+        os.rename(concept_path, final_path)
+        
+    def write_concept_folder(self,
+                             concept_path: str,
+                             concept: tg.ConceptDict,
+                             ) -> None:
         
         # ~ prototypes
         # Each cluster is *optionally* associated with one or more prototype elements. These are also graphs which 
@@ -191,7 +415,8 @@ class ConceptWriter():
             # We need to remove the prototype from the concept dict and handle it separately as this cannot 
             # just be written to the disk as a json file but needs to be handled as a visual graph dataset
             # element.
-            prototypes = concept['prototypes']
+            # The prototypes themselves are modified below, so they are copied.
+            prototypes = deepcopy(concept['prototypes'])
             del concept['prototypes']
             
             prototypes_path = os.path.join(concept_path, 'prototypes')
@@ -218,11 +443,11 @@ class ConceptWriter():
         # the dataset here.
         if 'elements' in concept:
             
-            for data in concept['elements']:
-                # This function removes all the redundant information from the visual graph element dict aka all the 
-                # information that is already contained in the dataset anyways. So that after this function the resulting 
-                # leftover dict only contains the information that was added during the concept creation process.
-                strip_graph_data(data)
+            # This function removes all the redundant information from the visual graph element dict aka all the 
+            # information that is already contained in the dataset anyways. So that after this function the resulting 
+            # leftover dict only contains the information that was added during the concept creation process.
+            # The elements are usually references to the dataset elements, which is why they are not modified.
+            concept['elements'] = [stripped_graph_data(data) for data in concept['elements']]
                 
         if 'graphs' in concept:
             del concept['graphs']
@@ -231,9 +456,10 @@ class ConceptWriter():
             del concept['image_paths']
                 
         # ~ concept metadata
+        # The large arrays of the concept (such as the member embeddings) are saved into a binary sidecar 
+        # file next to the metadata file.
         metadata_path = os.path.join(concept_path, 'metadata.json')
-        with open(metadata_path, 'w') as file:
-            json.dump(concept, file, cls=NumericJsonEncoder)
+        dump_json(concept, metadata_path)
         
     
 class ConceptReader():
@@ -245,6 +471,7 @@ class ConceptReader():
                  logger: logging.Logger = NULL_LOGGER,
                  reader_cls: type = VisualGraphDatasetReader,
                  model_cls: type = Megan,
+                 query_model: bool = True,
                  ):
         
         self.path = path
@@ -253,6 +480,10 @@ class ConceptReader():
         self.logger = logger
         self.reader_cls = reader_cls
         self.model_cls = model_cls
+        # If this flag is False, the graphs of the concept elements are not updated with the model's predictions
+        # and explanations while reading. This avoids a model forward pass for all the concept elements in 
+        # cases where only the information stored in the concept metadata (such as the embeddings) is needed.
+        self.query_model = query_model
         
         # This will later hold the dictionary structure of the global concept clustering metadata. This 
         # will be metadata that is not attached to any particular concept but rather additional information about 
@@ -260,27 +491,143 @@ class ConceptReader():
         # This will be populated in the "read_metadata" method.
         self.metadata: t.Optional[str] = None
         
+        # This will later hold the dictionary of the dimensionality reduction mappers (e.g. UMAP) for each of the 
+        # channels, if these were saved alongside the concepts. The keys are the channel indices.
+        # This will be populated in the "read_mappers" method.
+        self.mappers: t.Optional[t.Dict[int, t.Any]] = None
+        
         # This will later hold the index data map of the visual graph dataset that is used as the basis for the 
         # concept clustering. This will be populated in the "load_dataset" method.
         self.index_data_map: t.Optional[dict] = None
         
+        # This will later hold the entries of the concept index file, where the keys are the integer indices of 
+        # the concepts and the values are dicts with the keys "path", "channel_index", "size", "centroid_offset" 
+        # and "checksum". This will be populated in the "read_index" method.
+        self.index: t.Optional[t.Dict[int, dict]] = None
+        
         # In this dictionary we are creating a map where the keys are the integer indices of the concepts and the 
         # values are the corresponding absolute paths to the concept folders.
         self.index_path_map: t.Dict[int, str] = {}
-        for file in os.listdir(path):
-            file_path = os.path.join(path, file)
-            if os.path.isdir(file_path) and (index := safe_int(file)) is not None:
-                self.index_path_map[index] = file_path
+        
+        # If the concept clustering folder contains an index file, the concept paths are taken from there. Only 
+        # for older folders without an index file, the folder has to be listed instead.
+        index_path = os.path.join(path, INDEX_FILE_NAME)
+        if os.path.exists(index_path):
+            self.read_index()
+            for index, entry in self.index.items():
+                self.index_path_map[index] = os.path.join(path, entry['path'])
+        else:
+            for file in os.listdir(path):
+                file_path = os.path.join(path, file)
+                if os.path.isdir(file_path) and (index := safe_int(file)) is not None:
+                    self.index_path_map[index] = file_path
+        
+    def read_index(self) -> t.Dict[int, dict]:
+        """
+        Loads the entries of the concept index file into self.index and returns them. For older concept 
+        clustering folders without an index file, the entries are created from the metadata files of 
+        the individual concepts instead (without the checksums and centroid offsets).
+        """
+        if self.index is not None:
+            return self.index
+        
+        index_path = os.path.join(self.path, INDEX_FILE_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, mode='r') as file:
+                data = json.load(file)
+            self.index = {int(entry['index']): entry for entry in data['concepts']}
+            
+        else:
+            self.index = {}
+            for index, concept_path in sorted(self.index_path_map.items()):
+                concept = load_json(os.path.join(concept_path, 'metadata.json'))
+                self.index[index] = {
+                    'index': index,
+                    'path': os.path.basename(concept_path),
+                    'channel_index': concept['channel_index'],
+                    'size': len(concept.get('elements', [])),
+                    'centroid_offset': None,
+                    'checksum': None,
+                }
+                
+        return self.index
+    
+    def select_indices(self,
+                       channel_index: t.Optional[int] = None,
+                       min_size: t.Optional[int] = None,
+                       max_size: t.Optional[int] = None,
+                       ) -> t.List[int]:
+        """
+        Returns the sorted list of the indices of all the concepts that belong to the given ``channel_index`` and 
+        whose number of members is between ``min_size`` and ``max_size``. All of these filters are optional. The 
+        filtering only requires the concept index and none of the concept metadata files.
+        """
+        return [
+            index 
+            for index, entry in sorted(self.read_index().items())
+            if (channel_index is None or entry['channel_index'] == channel_index)
+            and (min_size is None or entry['size'] >= min_size)
+            and (max_size is None or entry['size'] <= max_size)
+        ]
+        
+    def read_centroids(self) -> np.ndarray:
+        """
+        Returns the array of shape (K, D) of the centroids of all the K concepts in the order of their indices.
+        These are loaded from the centroids file if it exists and from the concept metadata files otherwise.
+        """
+        centroids_path = os.path.join(self.path, CENTROIDS_FILE_NAME)
+        indices = sorted(self.read_index().keys())
+        offsets = [self.index[index]['centroid_offset'] for index in indices]
+        if os.path.exists(centroids_path) and None not in offsets:
+            centroids = np.load(centroids_path)
+            return centroids[offsets]
+        
+        centroids = []
+        for index in indices:
+            concept = load_json(os.path.join(self.index_path_map[index], 'metadata.json'))
+            centroids.append(concept['centroid'])
+        
+        return np.array(centroids)
+    
+    def verify_concept(self, index: int) -> bool:
+        """
+        Returns whether the metadata file of the concept with the given ``index`` still has the checksum which 
+        was recorded in the concept index. Concepts without a recorded checksum are always considered valid.
+        """
+        checksum = self.read_index()[index]['checksum']
+        if checksum is None:
+            return True
+        
+        return file_checksum(os.path.join(self.index_path_map[index], 'metadata.json')) == checksum
         
     def read_metadata(self) -> dict:
         
         metadata_path = os.path.join(self.path, 'metadata.json')
         if os.path.exists(metadata_path):
-            with open(metadata_path, 'r') as file:
-                self.metadata = json.load(file)
+            self.metadata = load_json(metadata_path)
                 
         return self.metadata
         
+    def read_mappers(self) -> t.Dict[int, t.Any]:
+        """
+        Loads the dimensionality reduction mappers of the concept clustering from the "mappers" folder and 
+        returns them as a dict whose keys are the channel indices. If the concept clustering does not contain 
+        any mappers, the dict is empty. The mappers are only loaded once and then cached in self.mappers.
+        """
+        if self.mappers is not None:
+            return self.mappers
+        
+        self.mappers = {}
+        mappers_path = os.path.join(self.path, 'mappers')
+        if os.path.exists(mappers_path):
+            for file_name in os.listdir(mappers_path):
+                name, extension = os.path.splitext(file_name)
+                if extension == '.pkl' and (channel_index := safe_int(name)) is not None:
+                    with open(os.path.join(mappers_path, file_name), mode='rb') as file:
+                        self.mappers[channel_index] = pickle.load(file)
+                    
+        return self.mappers
+        
     def load_dataset(self) -> None:
         # If the given "dataset" is a dict, it will be assumed that this is directly the already loaded 
         # index_data_map representation of the dataset.
@@ -320,7 +667,16 @@ class ConceptReader():
             
             self.model_cls.load_from_checkpoint(model_path)
         
-    def read(self) -> tg.ConceptData:
+    def read(self,
+             channel_index: t.Optional[int] = None,
+             min_size: t.Optional[int] = None,
+             max_size: t.Optional[int] = None,
+             ) -> tg.ConceptData:
+        """
+        Reads the concepts from the concept clustering folder and returns them as a list of concept dicts. 
+        Optionally, only the concepts of the given ``channel_index`` and with a number of members between 
+        ``min_size`` and ``max_size`` are read (see ``select_indices``).
+        """
         
         assert os.path.exists(self.path), f'concept data path does not exist!'
         assert os.path.isdir(self.path), f'concept data path is not a directory!'
@@ -330,6 +686,10 @@ class ConceptReader():
         # clustering. This metadata will be saved in the self.metadata attribute.
         self.read_metadata()
         
+        # This method will load the (optional) dimensionality reduction mappers which were saved alongside the 
+        # concepts into the self.mappers attribute.
+        self.read_mappers()
+        
         # This method will load the dataset which this concept clustering references. There are multiple options 
         # of how this is done either by passing it directly or by passing only a string path. However, after this 
         # method completes successfully, the dataset will be loaded into the self.index_data_map attribute.
@@ -343,26 +703,18 @@ class ConceptReader():
         # this will also be the result of the loading process.        
         concepts: t.List[int] = []
 
-        # "safe_int" is a utility function that will convert a string to an integer but does not raise
-        # an exception if the string is not a valid integer. Instead it will return None in that case.
-        
-        # This list contains the string names of the direct members of the given directory which are 
-        # valid integers in their correct integer order. This is because as a soft condition all concept 
-        # folders' names should be their intger indices. 
-        elements = [element for element in os.listdir(self.path) 
-                    if os.path.isdir(os.path.join(self.path, element)) and safe_int(element) is not None]
-        elements.sort(key=lambda element: int(element))
-        
-        index: int = 0
-        for element in elements:
-            element_path = os.path.join(self.path, element)
-            if os.path.isdir(element_path):
-                self.logger.info(f' * reading concept {index}')
-                concept = self.read_concept_from_path(
-                    concept_path=element_path,
-                )
-                concepts.append(concept)
-                index += 1
+        # The concept folders are read in the order of their integer indices. Without any filters this does not 
+        # require the concept index, which would have to be created from the concept metadata files for older 
+        # concept folders.
+        if channel_index is None and min_size is None and max_size is None:
+            indices = sorted(self.index_path_map.keys())
+        else:
+            indices = self.select_indices(channel_index=channel_index, min_size=min_size, max_size=max_size)
+        
+        for index in indices:
+            self.logger.info(f' * reading concept {index}')
+            concept = self.read_concept(index)
+            concepts.append(concept)
                 
         return concepts
             
@@ -380,8 +732,7 @@ class ConceptReader():
         metadata_path = os.path.join(concept_path, 'metadata.json')
         assert os.path.exists(metadata_path), f'concept metadata file for {concept_path} does not exist!'
         
-        with open(metadata_path, 'r') as file:
-            concept: tg.ConceptDict = json.load(file)
+        concept: tg.ConceptDict = load_json(metadata_path)
             
         # ~ loading graph data
         # The main amount of the graph data is stored in the "elements" list. This list contains one dict entry 
@@ -389,16 +740,20 @@ class ConceptReader():
         # visual graph elements that represent the graphs. All the actual data regarding the graph structure 
         # had been removed and now we load that again from the visual graph dataset.
         
-        self.logger.info(f'   querying the model with concept elements...')
         elements = concept['elements']
         indices = [element['metadata']['index'] for element in elements]
-        graphs = deepcopy([self.index_data_map[index]['metadata']['graph'] for index in indices])
+        # Updating the graphs with the model results only adds new keys to the graph dicts, so shallow copies of the 
+        # graph dicts are sufficient to keep the dataset itself unchanged.
+        graphs = [dict(self.index_data_map[index]['metadata']['graph']) for index in indices]
         
-        self.logger.info(f'   updating graph information...')
-        self.update_graphs(graphs)
+        if self.query_model:
+            self.logger.info(f'   querying the model with concept elements...')
+            self.update_graphs(graphs)
+            
         for index, element, graph in zip(indices, elements, graphs):
-            element.update(deepcopy(self.index_data_map[index]))
-            element['metadata']['graph'] = graph
+            data = self.index_data_map[index]
+            element.update(data)
+            element['metadata'] = {**data['metadata'], 'graph': graph}
             
         # ~ optional
         # Everything else is optional and not guaranteed to be contained within the folder.
@@ -411,7 +766,8 @@ class ConceptReader():
             
             prototypes = [data for data in index_data_map.values()]
             prototype_graphs = [data['metadata']['graph'] for data in prototypes]
-            self.update_graphs(prototype_graphs)
+            if self.query_model:
+                self.update_graphs(prototype_graphs)
             
             concept['prototypes'] = prototypes
             
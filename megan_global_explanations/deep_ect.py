@@ -10,17 +10,18 @@ import tensorflow as tf
 import tensorflow.keras as ks
 import numpy as np
 from sklearn.mixture import GaussianMixture
-from sklearn.cluster import KMeans
 from sklearn.metrics import davies_bouldin_score
-from sklearn.metrics import pairwise_distances
 from sklearn.semi_supervised import LabelPropagation
-from scipy.spatial.distance import euclidean
 
 from graph_attention_student.training import EpochCounterCallback
 from graph_attention_student.models.utils import tf_euclidean_distance, tf_pairwise_euclidean_distance
 from graph_attention_student.data import tensors_from_graphs
 
 from megan_global_explanations.utils import NULL_LOGGER
+from megan_global_explanations.serialization import dumps_json
+from megan_global_explanations.serialization import loads_json
+from megan_global_explanations.serialization import load_json
+from megan_global_explanations.serialization import append_frame
 
 
 
@@ -34,6 +35,176 @@ class CustomJsonEncoder(json.JSONEncoder):
             return obj.numpy().tolist()
 
 
+@tf.function(reduce_retracing=True)
+def tf_projection_loss(embeddings: tf.Tensor,
+                       positions: tf.Tensor,
+                       siblings: tf.Tensor,
+                       masks: tf.Tensor,
+                       valid: tf.Tensor,
+                       num_nodes: tf.Tensor,
+                       ) -> tf.Tensor:
+    """
+    Computes the DeepECT projection loss for all the nodes of the cluster tree at once. For every (non-root) 
+    node, the member embeddings are projected onto the axis between the node's position and its sibling's 
+    position and the loss is the average absolute distance of these projections to the node's own position.
+    The final loss is the sum of these node losses divided by the number of nodes.
+    
+    The tree is given as padded tensors whose first dimension is the node index, so that the shapes only 
+    change when the capacity of the tree grows and not with every split.
+    
+    :param embeddings: The (B, D) embeddings of the batch
+    :param positions: The (K, D) positions of the tree nodes
+    :param siblings: The (K, ) integer node indices of the siblings of the nodes
+    :param masks: The (K, B) membership masks, which are 1 if an embedding belongs to the node and 0 otherwise
+    :param valid: The (K, ) mask which is 1 for all the nodes that should be considered (those that exist and 
+        have a sibling) and 0 for all the others.
+    :param num_nodes: The scalar number of nodes in the tree by which the sum of the node losses is divided
+        
+    :returns: The scalar loss tensor
+    """
+    positions = tf.cast(positions, embeddings.dtype)
+    masks = tf.cast(masks, embeddings.dtype)
+    valid = tf.cast(valid, embeddings.dtype)
+    
+    # rho: (K, D) - the normalized direction from each node towards its sibling
+    rho = tf.gather(positions, siblings) - positions
+    rho = rho / tf.maximum(tf.norm(rho, axis=-1, keepdims=True), 1e-12)
+    
+    # The projection of (position - embedding) onto rho is the difference of the individual projections
+    # offsets: (K, )
+    offsets = tf.reduce_sum(positions * rho, axis=-1)
+    # projections: (K, B)
+    projections = tf.matmul(rho, embeddings, transpose_b=True)
+    contribs = tf.abs(tf.expand_dims(offsets, axis=-1) - projections) * masks
+    
+    # counts: (K, )
+    counts = tf.reduce_sum(masks, axis=-1)
+    node_losses = tf.reduce_sum(contribs, axis=-1) / tf.maximum(counts, 1.0)
+    # Nodes without any members in the current batch do not contribute to the loss
+    node_weights = valid * tf.cast(counts > 0, embeddings.dtype)
+    
+    return tf.reduce_sum(node_losses * node_weights) / tf.cast(num_nodes, embeddings.dtype)
+
+
+@tf.function(reduce_retracing=True)
+def tf_center_loss(centers: tf.Tensor,
+                   embeddings: tf.Tensor,
+                   labels: tf.Tensor,
+                   num_leaves: tf.Tensor,
+                   ) -> tf.Tensor:
+    """
+    Computes the DeepECT center loss for all the leaf nodes of the cluster tree at once. The loss of each leaf 
+    node is the euclidean distance between the leaf center and the mean of the embeddings that are currently 
+    assigned to that leaf. The final loss is the sum of these leaf losses divided by the number of leaves.
+    
+    :param centers: The (K, D) matrix of the node centers, where the first dimension is the node index
+    :param embeddings: The (B, D) embeddings of the batch
+    :param labels: The (B, ) integer node indices of the leaf nodes that the embeddings are assigned to
+    :param num_leaves: The scalar number of leaf nodes in the tree
+    
+    :returns: The scalar loss tensor
+    """
+    embeddings = tf.cast(embeddings, centers.dtype)
+    num_segments = tf.shape(centers)[0]
+    
+    # means: (K, D) - The mean of the member embeddings for every node, which is zero for all the nodes 
+    # without any members (split nodes and empty leaves).
+    sums = tf.math.unsorted_segment_sum(embeddings, labels, num_segments)
+    counts = tf.math.unsorted_segment_sum(tf.ones_like(labels, dtype=centers.dtype), labels, num_segments)
+    means = sums / tf.maximum(tf.expand_dims(counts, axis=-1), 1.0)
+    
+    # The lower bound avoids the undefined gradient of the square root when a center coincides with the mean
+    distances = tf.sqrt(tf.maximum(tf.reduce_sum(tf.square(centers - means), axis=-1), 1e-12))
+    weights = tf.cast(counts > 0, centers.dtype)
+    
+    return tf.reduce_sum(distances * weights) / tf.cast(num_leaves, centers.dtype)
+
+
+@tf.function(reduce_retracing=True)
+def tf_assign_leaves(embeddings: tf.Tensor,
+                     centers: tf.Tensor,
+                     leafs: tf.Tensor,
+                     ) -> tf.Tensor:
+    """
+    Assigns each of the given ``embeddings`` to the leaf node with the closest center.
+    
+    :param embeddings: The (B, D) embeddings to be assigned
+    :param centers: The (K, D) matrix of the node centers, where the first dimension is the node index
+    :param leafs: The (L, ) integer node indices of the leaf nodes
+    
+    :returns: The (B, ) integer tensor of the node indices of the assigned leaf nodes
+    """
+    # leaf_centers: (L, D)
+    leaf_centers = tf.gather(centers, leafs)
+    embeddings = tf.cast(embeddings, leaf_centers.dtype)
+    
+    # distances: (B, L) - The squared euclidean distances, which have the same minimum as the distances
+    distances = (
+        tf.reduce_sum(tf.square(embeddings), axis=-1, keepdims=True)
+        - 2 * tf.matmul(embeddings, leaf_centers, transpose_b=True)
+        + tf.expand_dims(tf.reduce_sum(tf.square(leaf_centers), axis=-1), axis=0)
+    )
+    return tf.gather(leafs, tf.argmin(distances, axis=-1, output_type=tf.int32))
+
+
+def batched_two_means(embeddings_list: t.List[np.ndarray],
+                      num_iterations: int = 50,
+                      ) -> t.List[np.ndarray]:
+    """
+    Computes the 2-means clusterings of several sets of embeddings at the same time. The sets are padded to the 
+    same size so that the iterations of all the clusterings are computed as single vectorized operations.
+    
+    The clusters are initialized by splitting each set along its first principal component, which makes the 
+    result deterministic, and then refined with the standard Lloyd iterations until the labels do not change 
+    anymore or the maximum number of iterations is reached.
+    
+    :param embeddings_list: A list of C arrays with the shapes (M_c, D) for the different sets
+    :param num_iterations: The maximum number of Lloyd iterations
+    
+    :returns: A list of C integer arrays with the shapes (M_c, ) with the cluster labels 0 or 1
+    """
+    sizes = np.array([len(embeddings) for embeddings in embeddings_list])
+    num_candidates = len(embeddings_list)
+    num_members = max(int(np.max(sizes, initial=0)), 1)
+    num_dimensions = embeddings_list[0].shape[-1]
+    
+    # padded: (C, M, D)
+    # mask: (C, M)
+    padded = np.zeros(shape=(num_candidates, num_members, num_dimensions), dtype=np.float64)
+    for index, embeddings in enumerate(embeddings_list):
+        padded[index, :len(embeddings)] = embeddings
+    mask = np.arange(num_members)[None, :] < sizes[:, None]
+    
+    # ~ initialization
+    means = np.sum(padded, axis=1) / np.maximum(sizes, 1)[:, None]
+    centered = (padded - means[:, None, :]) * mask[:, :, None]
+    # directions: (C, D) - the first principal component of each set
+    _, _, vt = np.linalg.svd(centered, full_matrices=False)
+    directions = vt[:, 0, :]
+    labels = (np.einsum('cmd,cd->cm', centered, directions) > 0).astype(int)
+    
+    # ~ lloyd iterations
+    for _ in range(num_iterations):
+        # onehot: (C, M, 2)
+        onehot = (labels[:, :, None] == np.arange(2)) & mask[:, :, None]
+        # counts: (C, 2)
+        # centers: (C, 2, D)
+        counts = np.sum(onehot, axis=1)
+        centers = np.einsum('cmk,cmd->ckd', onehot, padded) / np.maximum(counts, 1)[:, :, None]
+        
+        # distances: (C, M, 2) - An empty cluster does not have a center and can therefore not receive members
+        distances = np.sum(np.square(padded[:, :, None, :] - centers[:, None, :, :]), axis=-1)
+        distances = np.where(counts[:, None, :] > 0, distances, np.inf)
+        labels_new = np.argmin(distances, axis=-1)
+        
+        if np.array_equal(labels_new, labels):
+            break
+        
+        labels = labels_new
+    
+    return [labels[index, :size] for index, size in enumerate(sizes)]
+
+
 class DeepEctMixin():
     
     def __init__(self):
@@ -62,9 +233,13 @@ class DeepEctTrainer:
                  split_epoch_step: int = 10,
                  epochs_warmup: int = 0,
                  min_cluster_size: int = 5,
+                 num_split_candidates: int = 1,
                  projection_factor: float = 1.0,
+                 center_learning_rate: float = 0.01,
                  logger: logging.Logger = NULL_LOGGER,
                  save_history: bool = False,
+                 history_path: t.Optional[str] = None,
+                 history_num_samples: t.Optional[int] = None,
                  **kwargs):
         
         self.model = model
@@ -74,9 +249,15 @@ class DeepEctTrainer:
         self.split_epoch_step = split_epoch_step
         self.epochs_warmup = epochs_warmup
         self.min_cluster_size = min_cluster_size
+        self.num_split_candidates = num_split_candidates
         self.projection_factor = projection_factor
+        self.center_learning_rate = center_learning_rate
         self.logger = logger
         self.save_history = save_history
+        # If a history path is given, the history frames are appended to that binary log file instead of being 
+        # kept in the "history" dict. The number of samples optionally limits the number of embeddings per frame.
+        self.history_path = history_path
+        self.history_num_samples = history_num_samples
         
         self.indices = list(range(len(self.elements) * 1))
         self.inputs: t.Union[tf.Tensor, t.List[tf.Tensor]] = None
@@ -84,6 +265,8 @@ class DeepEctTrainer:
         self.batch_indices = []
         self.batch_inputs = []
         self.batch_embeddings = []
+        # The node index of the leaf node that each element of the batch is assigned to
+        self.batch_labels: np.ndarray = np.zeros(shape=(0, ), dtype=np.int32)
         
         self.set_model(model)
         
@@ -102,23 +285,129 @@ class DeepEctTrainer:
         self.next_index: int = 0
         self.num_nodes: tf.Variable = tf.Variable(0, trainable=False)
         
+        # The tree is additionally represented as padded arrays whose first dimension is the node index, which 
+        # is what the vectorized loss functions operate on. To avoid the re-tracing of the compiled functions 
+        # with every single split, the capacity of these arrays is only ever doubled when it is exceeded.
+        self.node_capacity: int = 8
+        self.tree_tensors: t.Dict[str, np.ndarray] = {}
+        
+        # The centers of all the nodes are stored as the rows of a single variable matrix, where the row index 
+        # is the node index. Only the rows of the leaf nodes are actually trained.
+        self.centers: t.Optional[tf.Variable] = None
+        self.center_optimizer: t.Optional[ks.optimizers.Optimizer] = None
+        # A numpy copy of the centers matrix, which is updated with every call of "collect_leaves"
+        self.center_values: t.Optional[np.ndarray] = None
+        # The (K, K) leaf to ancestor matrix, where the row of every node is 1 for the node itself and all of its 
+        # ancestors. Together with the leaf labels of the batch, this defines the members of all the nodes.
+        self.ancestors: t.Optional[np.ndarray] = None
+        # The number of members of every node (including the members of all the descendants) in the current batch
+        self.node_counts: t.Optional[np.ndarray] = None
+        
     # -- PERSISTENT STORAGE --
     
     def save(self, path: str) -> None:
+        """
+        Saves the state of the trainer as a binary numpy ".npz" checkpoint to the given ``path``. The tree is 
+        stored as arrays indexed by the node index and the member lists of the leaf nodes are represented by the 
+        leaf labels of the current batch. The elements are stored as an array if possible and otherwise as part 
+        of the JSON encoded constructor arguments.
+        
+        :param path: The absolute path of the checkpoint file
+        
+        :returns: None
+        """
+        config = {
+            'batch_size': self.batch_size,
+            'split_epoch_step': self.split_epoch_step,
+            'epochs_warmup': self.epochs_warmup,
+            'min_cluster_size': self.min_cluster_size,
+            'num_split_candidates': self.num_split_candidates,
+            'projection_factor': self.projection_factor,
+            'center_learning_rate': self.center_learning_rate,
+        }
         
-        with open(path, mode='w') as file:
-            data = self.to_dict()
-            content = json.dumps(data, cls=CustomJsonEncoder)
-            file.write(content)
+        arrays = {}
+        try:
+            elements = np.asarray(self.elements)
+        except ValueError:
+            elements = None
+            
+        if elements is not None and elements.dtype != object:
+            arrays['elements'] = elements
+        else:
+            config['elements'] = self.elements
+        
+        num_nodes = self.next_index
+        nodes = [self.tree[node_index] for node_index in range(num_nodes)]
+        centers = np.zeros(shape=(0, 0), dtype=np.float32) if self.centers is None else self.centers.numpy()[:num_nodes]
+        arrays.update({
+            'config': np.array(dumps_json(config).decode('utf-8')),
+            'centers': centers,
+            'positions': np.array([node['position'] for node in nodes]),
+            'weights': np.array([node['weight'] for node in nodes], dtype=float),
+            'parents': np.array([-1 if node['parent'] is None else node['parent'] for node in nodes], dtype=int),
+            'siblings': np.array([-1 if node['sibling'] is None else node['sibling'] for node in nodes], dtype=int),
+            'children': np.array([[-1, -1] if node['children'] is None else node['children'] for node in nodes], dtype=int),
+            'labels': self.batch_labels,
+        })
+        
+        # Writing into the file object prevents numpy from appending the ".npz" extension to the path
+        with open(path, mode='wb') as file:
+            np.savez(file, **arrays)
     
     @classmethod
     def load(cls, path: str) -> t.Any:
+        """
+        Loads a trainer from the checkpoint file with the given ``path`` (see ``save``). For backwards 
+        compatibility, this also loads the JSON files of older versions.
+        
+        :param path: The absolute path of the checkpoint file
         
-        with open(path, mode='r') as file:
-            content = file.read()
-            data = json.loads(content)
+        :returns: The trainer instance
+        """
+        if os.path.splitext(path)[1] == '.json':
+            data = load_json(path)
             return cls.from_dict(data)
         
+        with np.load(path, allow_pickle=False) as data:
+            config = loads_json(str(data['config']))
+            if 'elements' in data:
+                config['elements'] = data['elements']
+            
+            obj = cls(**config)
+            
+            centers = data['centers']
+            weights = data['weights']
+            positions = data['positions']
+            obj.batch_labels = data['labels']
+            for node_index in range(len(centers)):
+                children = data['children'][node_index].tolist()
+                parent = int(data['parents'][node_index])
+                sibling = int(data['siblings'][node_index])
+                obj.tree[node_index] = {
+                    'position':     positions[node_index],
+                    'indices':      np.flatnonzero(obj.batch_labels == node_index).tolist(),
+                    'weight':       float(weights[node_index]),
+                    'children':     None if children[0] < 0 else children,
+                    'parent':       None if parent < 0 else parent,
+                    'sibling':      None if sibling < 0 else sibling,
+                }
+        
+        obj.next_index = len(centers)
+        if obj.tree:
+            obj.ensure_capacity(num_dimensions=centers.shape[1])
+            obj.centers[:len(centers)].assign(centers)
+            obj.collect_leaves()
+            
+            # collect_leaves also advances the moving average of the node weights, which is reverted here so that 
+            # the loaded state is exactly the saved state.
+            for node_index, node in obj.tree.items():
+                node['weight'] = float(weights[node_index])
+                node['position'] = positions[node_index]
+            obj.update_tree_tensors()
+            
+        return obj
+        
     def to_dict(self) -> dict:
         
         data = {
@@ -127,9 +416,12 @@ class DeepEctTrainer:
             'split_epoch_step': self.split_epoch_step,
             'epochs_warmup': self.epochs_warmup,
             'min_cluster_size': self.min_cluster_size,
+            'num_split_candidates': self.num_split_candidates,
             'projection_factor': self.projection_factor,
+            'center_learning_rate': self.center_learning_rate,
             # These values represent the state of the 
-            'tree': deepcopy(self.tree)
+            'tree': deepcopy(self.tree),
+            'centers': None if self.centers is None else self.centers.numpy()[:self.next_index],
         }
         return data
         
@@ -138,18 +430,37 @@ class DeepEctTrainer:
         
         obj = cls(**data)
         
-        # One pre-processing step we need to do is to fix the datatypes of the tree, specifically the "variable" 
-        # field of each node is meant to be a tf.Variable object but for the dict export is is being converted 
+        # One pre-processing step we need to do is to fix the datatypes of the tree, specifically the "position" 
+        # field of each node is meant to be a numpy array but for the dict export is is being converted 
         # into just a list of numbers.
+        centers = {}
         for node_index, node in data['tree'].items():
             # When loading from JSON all the keys which are meant to be int are actually converted to str! which we fix here
             node_index = int(node_index)
             
-            if not isinstance(node['variable'], tf.Variable): 
-                node['variable'] = tf.Variable(np.array(node['variable']), trainable=True)
+            node['position'] = np.array(node['position'])
+            # Older exports still contain the center of every node as a separate "variable" field instead of 
+            # the "centers" matrix.
+            if 'variable' in node:
+                centers[node_index] = np.array(node.pop('variable'))
                 
             # At the end we can add the node to the tree of the actual instantiated object
             obj.tree[node_index] = node
+            
+        if obj.tree:
+            obj.next_index = max(obj.tree.keys()) + 1
+            if data.get('centers') is not None:
+                centers = dict(enumerate(np.array(data['centers'])))
+            
+            obj.ensure_capacity(num_dimensions=len(obj.tree[0]['position']))
+            for node_index, center in centers.items():
+                obj.centers[node_index].assign(center)
+                
+            # The batch labels are restored from the member indices of the leaf nodes
+            leaf_indices = {node_index: node['indices'] for node_index, node in obj.tree.items() if node['children'] is None}
+            obj.batch_labels = np.zeros(shape=(sum(len(indices) for indices in leaf_indices.values()), ), dtype=np.int32)
+            for node_index, indices in leaf_indices.items():
+                obj.batch_labels[indices] = node_index
         
         # After the object is constructed we can call collect_leaves to make 
         # sure that all the other secondary instance fields such as the leaf node list are updated correspondingly based 
@@ -177,7 +488,12 @@ class DeepEctTrainer:
     # -- TREE MANAGEMENT --
         
     def initialize(self):
+        # The inputs of all the elements only have to be converted once, all the batches are then sampled from them.
+        if self.inputs is None:
+            self.inputs = self.model.convert_elements(self.elements)
+        
         self.sample_batch()
+        self.batch_embeddings = self.model.embedd(self.batch_inputs)
         
         # Clearing the tree at the beginning here so that the initialize method can be used to re-initialize an object 
         # back to the base state as well.
@@ -194,8 +510,6 @@ class DeepEctTrainer:
         # This method will actually collects all the tensorflow variables from the tree into the variables list!
         self.collect_leaves(node_index)
         
-        self.inputs = self.model.convert_elements(self.elements)
-        
         self.logger.info(f'initialized the tree with {len(self.tree)} nodes and {len(self.leafs)}')
         
     def insert_node(self, indices: t.List[int]):
@@ -207,7 +521,6 @@ class DeepEctTrainer:
         node_index = self.next_index
         self.tree[node_index] = {
             'position':     centroid,
-            'variable':     tf.Variable(centroid, trainable=True),
             'indices':      indices,
             'weight':       len(indices),
             'children':     None,
@@ -218,16 +531,54 @@ class DeepEctTrainer:
         # that will be inserted has a unique index.
         self.next_index += 1
         
+        self.ensure_capacity(num_dimensions=len(centroid))
+        self.centers[node_index].assign(centroid)
+        self.batch_labels[indices] = node_index
+        
         self.num_nodes.assign_add(1)
         
         return node_index
         
+    def ensure_capacity(self, num_dimensions: int) -> None:
+        """
+        Makes sure that the node capacity of the trainer is sufficient for all the nodes of the tree, doubling 
+        it if necessary. If the capacity changes, the ``centers`` variable matrix is replaced with a larger one
+        which contains the previous centers.
+        
+        :param num_dimensions: The number of dimensions of the embeddings / centers
+        
+        :returns: None
+        """
+        capacity = self.node_capacity
+        while capacity < self.next_index:
+            capacity *= 2
+            
+        if self.centers is not None and self.centers.shape[0] == capacity:
+            return
+        
+        values = np.zeros(shape=(capacity, num_dimensions), dtype=np.float32)
+        if self.centers is not None:
+            values[:self.centers.shape[0]] = self.centers.numpy()
+            
+        self.node_capacity = capacity
+        self.centers = tf.Variable(values, trainable=True)
+        # A keras optimizer is bound to the variables that it was first applied to, which is why we need a new 
+        # one for the new variable.
+        self.center_optimizer = ks.optimizers.SGD(learning_rate=self.center_learning_rate)
+        
     def collect_leaves(self, node_index: int = 0, clear: bool = True):
         # First we clear all the current tensorflow variables from the collection so that we can then afterwards iterate 
         # through the entire tree to collect all the new ones from the leaf nodes.
         if clear:
             self.leafs = []
             self.splits = []
+            self.center_values = self.centers.numpy()
+            
+            self.update_ancestors()
+            # Multiplying the number of members of the leaf nodes with the ancestor matrix yields the number of 
+            # members of every node - including all the members of the descendants for the split nodes.
+            leaf_counts = np.bincount(self.batch_labels, minlength=self.node_capacity)
+            self.node_counts = leaf_counts @ self.ancestors
         
         node_data = self.tree[node_index]
         node = self.tree[node_index]
@@ -239,7 +590,7 @@ class DeepEctTrainer:
             
             self.leafs.append(node_index)
             
-            node['position'] = node['variable'].numpy()
+            node['position'] = self.center_values[node_index]
         
         # ~ split nodes
         # If its not None that means its a split node in which case we recursively explore the tree further along the 
@@ -258,9 +609,6 @@ class DeepEctTrainer:
             # those two children, which is simply in the middle of them (weighted average)
             child_0, child_1 = [self.tree[i] for i in children]
             
-            indices = child_0['indices'] + child_1['indices']
-            node['indices'] = indices
-            
             # The position of the weight
             self.tree[node_index]['position'] = (
                 child_0['position'] * child_0['weight'] +
@@ -269,31 +617,97 @@ class DeepEctTrainer:
             
         # This is the formula from the paper: We calculate the new weight of each leaf node as the average of the 
         # of the previous batch's weight and the new number of elements assigned to this leaf.
-        node['weight'] = 0.5 * node['weight'] + 0.5 * len(node['indices'])
+        node['weight'] = 0.5 * node['weight'] + 0.5 * self.node_counts[node_index]
+        
+        # Only once the entire tree has been traversed, the padded tree arrays are updated accordingly.
+        if clear:
+            self.update_tree_tensors()
+            
+    def update_ancestors(self) -> None:
+        """
+        Updates the leaf to ancestor matrix ``ancestors`` if the structure of the tree has changed since the 
+        last update. The matrix has the shape (K, K) where K is the node capacity and the row of each node is 1 
+        for the node itself and for all of its ancestors and 0 otherwise.
+        
+        :returns: None
+        """
+        # Nodes are only ever added to the tree, which is why the structure can only have changed if the 
+        # number of nodes has changed.
+        if self.ancestors is not None and self.ancestors.shape[0] == self.node_capacity and np.trace(self.ancestors) == len(self.tree):
+            return
+        
+        self.ancestors = np.zeros(shape=(self.node_capacity, self.node_capacity), dtype=np.int32)
+        for node_index in self.tree.keys():
+            ancestor_index = node_index
+            while ancestor_index is not None:
+                self.ancestors[node_index, ancestor_index] = 1
+                ancestor_index = self.tree[ancestor_index]['parent']
+            
+    def update_tree_tensors(self) -> None:
+        """
+        Updates the padded array representation of the tree in the ``tree_tensors`` dict from the current 
+        state of the ``tree``. The first dimension of all these arrays is the node index:
+        
+        - positions: (K, D) the current positions of the nodes
+        - siblings: (K, ) the node indices of the siblings. 0 for the root node and the padding.
+        - valid: (K, ) 1 for all the nodes that have a sibling and 0 for the root node and the padding.
+        - masks: (K, B) 1 where the batch element is a member of the node and 0 otherwise.
+        - labels: (B, ) the node index of the leaf node that each batch element is assigned to.
+        
+        :returns: None
+        """
+        num_dimensions = len(self.tree[0]['position'])
+        positions = np.zeros(shape=(self.node_capacity, num_dimensions), dtype=np.float32)
+        siblings = np.zeros(shape=(self.node_capacity, ), dtype=np.int32)
+        valid = np.zeros(shape=(self.node_capacity, ), dtype=np.float32)
+        
+        for node_index, node in self.tree.items():
+            positions[node_index] = node['position']
+            if node['sibling'] is not None:
+                siblings[node_index] = node['sibling']
+                valid[node_index] = 1.0
+        
+        # The batch elements are members of their leaf node and of all the ancestors of that leaf node
+        labels = self.batch_labels
+        masks = self.ancestors[labels].T.astype(np.float32)
+                
+        self.tree_tensors = {
+            'positions': positions,
+            'siblings': siblings,
+            'valid': valid,
+            'masks': masks,
+            'labels': labels,
+        }
                 
     def split(self):
-        self.embeddings = self.embedd_elements(self.elements)
-        
-        # We iterate through all leaf nodes and calculate the split metric for all of them and the one with the 
-        # hightest metric we split.
-        split_values: t.List[float] = [self.get_split_value(node_index) for node_index in self.leafs]
-        node_index = self.leafs[np.argmax(split_values)]
         
-        success = self.split_node(node_index)
-        if not success:
-            self.leaf_blacklist[node_index] = self.callback.epoch
-            self.logger.info(f'rejected split of leaf node {node_index}')
-        else:
-            self.logger.info(f'split leaf node {node_index}')
+        # The split metric is calculated for all the leaf nodes at once and the leaf nodes with the highest metric are 
+        # the candidates for the split.
+        split_values = self.get_split_values()
+        candidate_indices = np.argsort(-split_values, kind='stable')[:self.num_split_candidates]
+        candidates = [self.leafs[i] for i in candidate_indices]
+        
+        # The 2-means clusterings of all the candidates are computed together in a single batched pass and then the 
+        # candidates are tried in the order of their split metric until the first split is accepted.
+        embeddings = np.asarray(self.batch_embeddings)
+        labels_list = batched_two_means([embeddings[self.tree[node_index]['indices']] for node_index in candidates])
+        
+        for node_index, labels in zip(candidates, labels_list):
+            success = self.split_node(node_index, labels=labels)
+            if not success:
+                self.leaf_blacklist[node_index] = self.callback.epoch
+                self.logger.info(f'rejected split of leaf node {node_index}')
+            else:
+                self.logger.info(f'split leaf node {node_index}')
+                break
         
         self.collect_leaves()
         
         return node_index
         
-    def split_node(self, node_index: int, force: bool = False) -> bool:
+    def split_node(self, node_index: int, force: bool = False, labels: t.Optional[np.ndarray] = None) -> bool:
         node = self.tree[node_index]
         indices = node['indices']
-        embeddings = [self.batch_embeddings[i] for i in indices]
         
         # try:
         #     gm_single = GaussianMixture(n_components=1, max_iter=300, covariance_type='diag')
@@ -305,23 +719,21 @@ class DeepEctTrainer:
         #     return False
         # labels = gm.predict(embeddings) 
         
-        kmeans = KMeans(
-            n_clusters=2
-        )
-        kmeans.fit(embeddings)
-        labels = kmeans.labels_
-        print('\n')    
+        # The labels of the members can optionally be given if the 2-means clustering was already computed 
+        # in a batch with other candidates (see "split").
+        if labels is None:
+            embeddings = np.asarray(self.batch_embeddings)[indices]
+            labels = batched_two_means([embeddings])[0]
         
         # ~ cluster member check
         # As the first check to see if we accept a certain cluster splitting or not is by looking at the 
         # number of cluster members. If the clusters are severely unbalanced aka if one of the clusters 
         # would get more than X% of the members then we reject the splitting
         cluster_counts = [np.sum((labels == k).astype(int)) for k in [0, 1]]
-        print('COUNTS', cluster_counts)
         for count in cluster_counts:
             if (count < 0.1 * len(indices) or count < self.min_cluster_size) and not force:
                 return False
-        
+
         # ~ variance reduction check
         # Another criterion is how much a potential splitting reduces the variance compared to leaving the 
         # cluster as it is. We say that we only accept a splitting here if the average variance is reduced 
@@ -352,53 +764,62 @@ class DeepEctTrainer:
         self.tree[node['children'][0]]['sibling'] = node['children'][1]
         self.tree[node['children'][1]]['sibling'] = node['children'][0]
         
+        # Only the leaf nodes keep explicit lists of their members. The members of the split nodes are 
+        # given by the ancestor matrix.
+        node['indices'] = []
+        
         return True
                 
-    def get_split_value(self, node_index: int):
-        
-        if node_index in self.leaf_blacklist:
-            return -1
-        
-        # This is the list of embeddings for the cluster with the given node_index
-        embeddings = [self.batch_embeddings[i] for i in self.tree[node_index]['indices']]
-        
-        # Now we need to calculate the sum of square distances towards the center of that cluster
-        center = self.tree[node_index]['variable'].numpy()
-        
-        distances = np.array([euclidean(center, emb) for emb in embeddings])
-        distances = distances
+    def get_split_values(self) -> np.ndarray:
+        """
+        Returns the array of the split metric values for all the leaf nodes, in the same order as the ``leafs`` 
+        list. The split metric of a leaf node is the sum of the distances of its members in the current batch to 
+        the leaf center. Leaf nodes on the blacklist have a value of -1.
+        
+        :returns: An array of shape (L, )
+        """
+        # distances: (B, ) - The distance of every batch element to the center of its leaf node
+        embeddings = np.asarray(self.batch_embeddings)
+        centers = self.centers.numpy()
+        distances = np.linalg.norm(embeddings - centers[self.batch_labels], axis=-1)
+        
+        sums = np.bincount(self.batch_labels, weights=distances, minlength=self.node_capacity)
+        values = sums[self.leafs]
+        values[np.isin(self.leafs, list(self.leaf_blacklist.keys()))] = -1
+        
+        return values
+                
+    def get_split_value(self, node_index: int) -> float:
         
-        return np.sum(distances)
+        return self.get_split_values()[self.leafs.index(node_index)]
                 
     def sample_batch(self):
         
-        self.batch_elements = random.sample(self.elements, k=self.batch_size)
-        # sample_indices = random.sample(self.indices, k=self.batch_size)
-        # if isinstance(self.inputs, (list, tuple)):
-        #     self.batch_inputs = [tf.gather(inp, sample_indices) for inp in self.inputs]
-        # else:
-        #     self.batch_inputs = tf.gather(self.inputs, sample_indices)    
-        self.batch_inputs = self.model.convert_elements(self.batch_elements)
-        self.batch_embeddings = self.model.embedd(self.batch_inputs)
-        self.batch_indices = list(range(len(self.batch_embeddings)))
+        # Instead of converting the sampled elements for every batch, the batch inputs are gathered from the 
+        # already converted inputs of all the elements, which also works for ragged tensors. The embeddings of 
+        # the batch are only computed during the train step.
+        sample_indices = random.sample(self.indices, k=min(self.batch_size, len(self.indices)))
+        self.batch_elements = [self.elements[i] for i in sample_indices]
+        if isinstance(self.inputs, (list, tuple)):
+            self.batch_inputs = [tf.gather(inp, sample_indices) for inp in self.inputs]
+        else:
+            self.batch_inputs = tf.gather(self.inputs, sample_indices)    
+        self.batch_indices = list(range(len(sample_indices)))
+        self.batch_labels = np.zeros(shape=(len(self.batch_indices), ), dtype=np.int32)
         
     def assign_nodes(self):
         
-        # First of all we need to clear the lists that still contain the previous batch's assignments of the 
-        # leaf nodes
+        # The assignment scheme is very simple: We assign every embedding of this batch to the leaf node with 
+        # the closest center, which results in the vector of the leaf node indices for the batch.
+        self.batch_labels = tf_assign_leaves(
+            self.batch_embeddings, 
+            self.centers, 
+            tf.constant(self.leafs, dtype=tf.int32),
+        ).numpy()
+        
+        # From this we derive the member lists of the leaf nodes themselves
         for node_index in self.leafs:
-            self.tree[node_index]['indices'] = []
-        
-        # Then the assignment scheme is very simple: We assign every embedding of this batch to the closest 
-        # leaf node. For that we compute all the pairwise distances of all the embeddings with the leaf centers
-        # and then select the minimum one for each.
-        leaf_centers = [self.tree[i]['variable'].numpy() for i in self.leafs]
-        distances = pairwise_distances(self.batch_embeddings, leaf_centers, metric='euclidean')
-        closest = np.argmin(distances, axis=1)
-        
-        for index, closest in enumerate(closest):
-            node_index = self.leafs[closest]
-            self.tree[node_index]['indices'].append(index)
+            self.tree[node_index]['indices'] = np.flatnonzero(self.batch_labels == node_index).tolist()
                 
     # -- CALLBACK METHODS --
                 
@@ -406,13 +827,10 @@ class DeepEctTrainer:
         
         if self.callback.epoch >= self.epochs_warmup:
             
-            self.sample_batch() # could be improved
-        
-            self.assign_nodes()
-            
-            self.collect_leaves()
+            self.sample_batch()
             
-            self.train_step_projection() # ! bottleneck
+            # This also assigns the batch to the leaf nodes, using the same forward pass as the projection loss
+            self.train_step_projection()
 
             self.train_step_node_centers() # cheap
         
@@ -429,13 +847,41 @@ class DeepEctTrainer:
         if self.save_history:
             
             self.logger.info(f'recording ect history at epoch {self.callback.epoch}') 
+            self.record_history()
             
-            self.batch_embeddings = self.embedd_elements(self.batch_elements)
+    def record_history(self) -> None:
+        """
+        Records the current state of the batch embeddings and the leaf nodes as a frame of the history. If the 
+        ``history_path`` is set, the frame is appended to that binary log file (see ``serialization.append_frame``)
+        and otherwise it is added to the ``history`` dict. If ``history_num_samples`` is set, only a random 
+        subsample of that many embeddings of the batch is recorded.
+        
+        :returns: None
+        """
+        self.batch_embeddings = self.model.embedd(self.batch_inputs).numpy()
+        embeddings = self.batch_embeddings
+        labels = self.batch_labels
+        if self.history_num_samples is not None and len(labels) > self.history_num_samples:
+            sample_indices = np.sort(np.random.choice(len(labels), size=self.history_num_samples, replace=False))
+            embeddings = embeddings[sample_indices]
+            labels = labels[sample_indices]
+            
+        centers = self.centers.numpy()
+        if self.history_path is not None:
+            append_frame(self.history_path, {
+                'epoch':        self.callback.epoch,
+                'embeddings':   embeddings,
+                'labels':       labels,
+                'leafs':        np.array(self.leafs),
+                'centers':      centers[self.leafs],
+                'weights':      np.array([self.tree[node_index]['weight'] for node_index in self.leafs], dtype=float),
+            })
+        else:
             self.history[self.callback.epoch] = [
                 {
                     'index':        node_index,
-                    'embeddings':   [self.batch_embeddings[i] for i in node['indices']],
-                    'center':       node['variable'].numpy(),
+                    'embeddings':   embeddings[labels == node_index],
+                    'center':       centers[node_index],
                     'weight':       node['weight'],
                 }
                 for node_index in self.leafs
@@ -444,88 +890,62 @@ class DeepEctTrainer:
     
     def train_step_node_centers(self):
         
+        # The loss of all the leaf nodes is computed at once from the leaf labels of the batch elements, so 
+        # that the cost of this step does not depend on the number of leaves.
         with tf.GradientTape() as tape:
-            loss = 0.0
-            
-            # pass all the elements through the model
-            # x = tf.constant(self.elements)
-            # embeddings = self.model.embedd(self.inputs)
-            embeddings = self.batch_embeddings
-            
-            for node_index in self.leafs:
-                
-                node = self.tree[node_index]
-                leaf_center = node['variable']
-                
-                if len(node['indices']) == 0:
-                    continue
-                
-                # print(node['indices'])
-                leaf_embeddings = tf.gather(embeddings, node['indices'])
-                leaf_embeddings_mean = tf.reduce_mean(leaf_embeddings, axis=0)
-            
-                loss += tf_euclidean_distance(leaf_center, leaf_embeddings_mean) / self.num_leaves
+            loss = tf_center_loss(
+                self.centers,
+                self.batch_embeddings,
+                self.tree_tensors['labels'],
+                tf.constant(self.num_leaves, dtype=tf.float32),
+            )
     
-        variables = [self.tree[i]['variable'] for i in self.leafs]
-        gradients = tape.gradient(loss, variables)
-
-        for var, grad in zip(variables, gradients):
-            if grad is not None:
-                var.assign_add(-0.01 * grad)
+        gradients = tape.gradient(loss, [self.centers])
+        self.center_optimizer.apply_gradients(zip(gradients, [self.centers]))
         
         return loss
     
     def train_step_projection(self):
         
-        loss = 0.0
-        if len(self.tree) > 1:
+        with tf.GradientTape() as tape:
             
-            with tf.GradientTape() as tape:
-                loss = tf.constant(0.0)
-                
-                # pass all the elements through the model
-                self.batch_embeddings = self.model.embedd(self.batch_inputs)
-                embeddings = self.batch_embeddings
-                
-                for node_index in range(1, self.next_index):
-                    
-                    node = self.tree[node_index]
-                    sibling = self.tree[node['sibling']]
-                    
-                    if len(node['indices']) == 0:
-                        continue
-                    
-                    # rho: (D, )
-                    # node_center: (D, )
-                    #rho = node['position'] - sibling['position']
-                    rho = sibling['position'] - node['position']
-                    rho = rho / np.linalg.norm(rho)
-                    rho = tf.constant(rho)
-                    rho = tf.expand_dims(rho, axis=-1)
-                    
-                    node_center = node['position']
-                    
-                    # node_embeddings: ([B], D)
-                    node_embeddings = tf.gather(embeddings, node['indices'])
-                    
-                    loss_contribs = tf.abs(tf.matmul(node_center - node_embeddings, rho))
-                    loss += tf.reduce_mean(loss_contribs) / len(self.tree)
-        
-                loss *= self.projection_factor
-        
-                trainable_vars = self.model.trainable_variables
-                gradients = tape.gradient(loss, trainable_vars)
-                
-                # This list comprehension here is a bit messy and one might ask why it is even necessary. What it essentially 
-                # does is it filters out all the gradients that are None. None gradients can happen here because in this 
-                # train step we are effectively only training the encoder part of the network and not at all the output head
-                # We need to filter these None gradients here because they would evoke tf warning messages that would absolutely 
-                # flood the console...
-                self.model.optimizer.apply_gradients([
-                    (grad, var) 
-                    for (grad, var) in zip(gradients, trainable_vars) 
-                    if grad is not None
-                ])
+            # pass the batch through the model. This is the only forward pass of the batch per train step.
+            self.batch_embeddings = self.model.embedd(self.batch_inputs)
+            
+            # The assignment of the batch to the leaf nodes and the resulting update of the tree only depend on the 
+            # values of the embeddings, which is why they do not need to be recorded.
+            with tape.stop_recording():
+                self.assign_nodes()
+                self.collect_leaves()
+            
+            if len(self.tree) <= 1:
+                return tf.constant(0.0)
+            
+            # The loss of all the nodes is computed in a single compiled function based on the padded 
+            # tree arrays, which avoids the python loop over all the nodes of the tree.
+            loss = tf_projection_loss(
+                self.batch_embeddings,
+                self.tree_tensors['positions'],
+                self.tree_tensors['siblings'],
+                self.tree_tensors['masks'],
+                self.tree_tensors['valid'],
+                tf.constant(len(self.tree), dtype=tf.float32),
+            )
+            loss *= self.projection_factor
+    
+        trainable_vars = self.model.trainable_variables
+        gradients = tape.gradient(loss, trainable_vars)
+        
+        # This list comprehension here is a bit messy and one might ask why it is even necessary. What it essentially 
+        # does is it filters out all the gradients that are None. None gradients can happen here because in this 
+        # train step we are effectively only training the encoder part of the network and not at all the output head
+        # We need to filter these None gradients here because they would evoke tf warning messages that would absolutely 
+        # flood the console...
+        self.model.optimizer.apply_gradients([
+            (grad, var) 
+            for (grad, var) in zip(gradients, trainable_vars) 
+            if grad is not None
+        ])
         
         return loss
     
@@ -539,18 +959,14 @@ class DeepEctTrainer:
             
         self.model.fit(x, y, **kwargs) 
     
-    def predict_embeddings(self, embeddings: list):
-        
-        leaf_centers = [self.tree[i]['variable'].numpy() for i in self.leafs]
-        distances = pairwise_distances(embeddings, leaf_centers, metric='euclidean')
-        closest = np.argmin(distances, axis=1)
-        
-        labels = []
-        for index, closest in enumerate(closest):
-            node_index = self.leafs[closest]
-            labels.append(node_index)
+    def predict_embeddings(self, embeddings: list) -> np.ndarray:
         
-        return labels
+        labels = tf_assign_leaves(
+            tf.constant(np.asarray(embeddings), dtype=tf.float32),
+            self.centers,
+            tf.constant(self.leafs, dtype=tf.int32),
+        )
+        return labels.numpy()
     
     def predict_elements(self, elements: list):
     
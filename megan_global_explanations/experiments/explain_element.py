@@ -304,6 +304,51 @@ def experiment(e: Experiment):
     expl_path = os.path.join(e.path, 'local_explanations.pdf')
     fig.savefig(expl_path)
     
+    # ~ projecting the element
+    # If the concept clustering was saved together with the UMAP mappers that were fitted during the concept 
+    # extraction, we can project the embeddings of the query element into the same 2D space as the concept 
+    # centroids. The mappers are only used to transform the embeddings - there is no re-fitting.
+    mappers = concept_reader.read_mappers()
+    if mappers:
+        
+        e.log('projecting the query element with the concept mappers...')
+        fig, rows = plt.subplots(
+            ncols=num_channels,
+            nrows=1,
+            figsize=(num_channels * 5, 5),
+            squeeze=False,
+        )
+        for channel_index, mapper in mappers.items():
+            
+            ax = rows[0][channel_index]
+            ax.set_title(f'UMAP Projection - Channel {channel_index}')
+            
+            channel_concepts = [concept for concept in concepts if concept['channel_index'] == channel_index]
+            if len(channel_concepts) != 0:
+                # centroids_mapped: (num_concepts, 2)
+                centroids_mapped = mapper.transform(np.array([concept['centroid'] for concept in channel_concepts]))
+                ax.scatter(
+                    centroids_mapped[:, 0], centroids_mapped[:, 1],
+                    color='black',
+                    marker='x',
+                )
+                for concept, mapped in zip(channel_concepts, centroids_mapped):
+                    ax.text(mapped[0], mapped[1], f'({concept["index"]})', color='black')
+            
+            # element_mapped: (2, )
+            element_mapped = mapper.transform(np.expand_dims(info['graph_embedding'][:, channel_index], axis=0))[0]
+            ax.scatter(
+                element_mapped[0], element_mapped[1],
+                color='red',
+                marker='*',
+                s=200,
+                label='query element',
+            )
+            ax.legend()
+        
+        projection_path = os.path.join(e.path, 'umap_projection.pdf')
+        fig.savefig(projection_path)
+    
     e.log('visualizing concept explanations...')
     fig, rows = plt.subplots(
         ncols=1 + e.NUM_EXAMPLES,
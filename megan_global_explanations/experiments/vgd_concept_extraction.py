@@ -12,12 +12,13 @@ the concept explanations.
 """
 import os
 import json
+import time
 import random
 import pathlib
 import traceback
 import typing as t
-from copy import deepcopy
 from collections import defaultdict
+from concurrent.futures import Future
 
 import umap
 import hdbscan
@@ -28,8 +29,6 @@ import visual_graph_datasets.typing as tv
 from sklearn.metrics import pairwise_distances
 from sklearn.metrics.pairwise import paired_cosine_distances
 from sklearn.metrics.pairwise import cosine_distances
-from sklearn.metrics import silhouette_score
-from sklearn.metrics import davies_bouldin_score
 from scipy.spatial.distance import cosine
 from pycomex.functional.experiment import Experiment
 from pycomex.utils import folder_path, file_namespace
@@ -39,13 +38,16 @@ from visual_graph_datasets.graph import graph_find_connected_regions
 from visual_graph_datasets.graph import extract_subgraph
 from visual_graph_datasets.web import ensure_dataset
 from visual_graph_datasets.data import VisualGraphDatasetReader
-from visual_graph_datasets.data import NumericJsonEncoder
 from visual_graph_datasets.processing.base import ProcessingBase
 from visual_graph_datasets.processing.colors import ColorProcessing
 from graph_attention_student.utils import array_normalize
 from graph_attention_student.torch.megan import Megan
 
+from megan_global_explanations.metrics import concepts_to_columns
+from megan_global_explanations.metrics import clustering_metrics
 from megan_global_explanations.visualization import create_concept_cluster_report
+from megan_global_explanations.visualization import fit_transform_mapper
+from megan_global_explanations.visualization import plot_embedding_points
 from megan_global_explanations.prototype.optimize import genetic_optimize
 from megan_global_explanations.prototype.optimize import embedding_distance_fitness
 from megan_global_explanations.prototype.colors import sample_from_cogiles
@@ -55,9 +57,15 @@ from megan_global_explanations.prototype.colors import mutate_modify_node
 from megan_global_explanations.prototype.colors import mutate_add_node
 from megan_global_explanations.prototype.colors import mutate_remove_node
 from megan_global_explanations.gpt import describe_color_graph
+from megan_global_explanations.gpt import map_future
+from megan_global_explanations.gpt import resolve_futures
+from megan_global_explanations.gpt import GptQueue
+from megan_global_explanations.gpt import GptCache
 from megan_global_explanations.data import ConceptWriter
 from megan_global_explanations.data import ConceptReader
+from megan_global_explanations.serialization import dump_json
 from megan_global_explanations.utils import EXPERIMENTS_PATH
+from megan_global_explanations.utils import sort_concepts_by_similarity
 
 mpl.use('Agg')
 
@@ -126,6 +134,17 @@ CLUSTER_SELECTION_METHOD: str = 'leaf'
 #       the concept report a bit more readable because similar clusters will appear close to each other 
 #       in the report PDF.
 SORT_SIMILARITY: bool = True
+# :param SORT_METHOD:
+#       This string determines the method that is used to determine the similarity order of the clusters 
+#       within each channel. "greedy" is a nearest neighbor walk starting from the first cluster, "two_opt"
+#       additionally refines that walk with the 2-opt heuristic and "leaf" uses the optimal leaf ordering 
+#       of a hierarchical clustering of the cluster centroids.
+SORT_METHOD: str = 'greedy'
+# :param METRICS_SAMPLE_SIZE:
+#       The maximum number of concept members per channel on which the silhouette score is computed. Since 
+#       the silhouette requires all the pairwise distances between the members, it is computed on a random 
+#       subsample of that size for larger channels. If this is None, it is always computed on all members.
+METRICS_SAMPLE_SIZE: t.Optional[int] = 10_000
 
 # == PROTOTYPE OPTIMIZATION PARAMETERS ==
 # These parameters configure the process of optimizing the cluster prototype representatation
@@ -161,6 +180,21 @@ DESCRIBE_PROTOTYPE: bool = True
 #       or not. If this is False, the entire hypothesis routine will be skipped during the
 #       cluster discovery.
 HYPOTHESIZE_PROTOTYPE: bool = True
+# :param GPT_CONCURRENCY:
+#       This integer determines the maximum number of GPT requests that are sent concurrently. The requests 
+#       for the prototype descriptions are submitted to a request queue during the concept loop and only 
+#       awaited at the end, so that they do not block the (expensive) prototype optimization.
+GPT_CONCURRENCY: int = 4
+# :param GPT_REQUESTS_PER_MINUTE:
+#       This optional integer limits the number of GPT requests per minute. If this is None, the requests 
+#       are only limited by the concurrency. Requests that still hit the rate limit of the API are retried 
+#       with an exponential backoff.
+GPT_REQUESTS_PER_MINUTE: t.Optional[int] = None
+# :param GPT_CACHE_PATH:
+#       This optional string path determines the folder of the persistent cache for the GPT responses. When the 
+#       experiment is re-run with the same prototypes, the cached descriptions and hypotheses are used instead 
+#       of repeating the requests, which also works offline. If this is None, no cache is used.
+GPT_CACHE_PATH: t.Optional[str] = os.path.join(PATH, 'cache', 'gpt')
 # :param CONTRIBUTION_THRESHOLDS:
 #       This dictionary determines the thresholds to be used when converting the contribution values 
 #       of classification tasks into the strings such that they can be passed to the language model 
@@ -182,8 +216,28 @@ CONTRIBUTION_THRESHOLDS: dict = {
 # :param PLOT_UMAP:
 #       This boolean flag determines whether the UMAP visualization of the graph embeddings should be
 #       created or not. If this is True, the UMAP visualization will be created and saved as an additional 
-#       artifact of the experiment.
+#       artifact of the experiment. The fitted UMAP mappers are then also saved into the concepts folder.
 PLOT_UMAP: bool = True
+# :param UMAP_NUM_FIT_SAMPLES:
+#       Optionally, the maximum number of embeddings on which the UMAP mapper of each channel is fitted. If a 
+#       channel contains more elements than that, the mapper is fitted on a subsample which is stratified by the 
+#       concept clusters and all the remaining elements are then only transformed in batches. If this is None, 
+#       the mapper is fitted on all the elements.
+UMAP_NUM_FIT_SAMPLES: t.Optional[int] = None
+# :param WRITER_NUM_WORKERS:
+#       The number of workers that are used to write the concept folders in parallel. The prototype visualizations 
+#       are rendered by that many worker processes and the concept files are written by that many threads. With 
+#       the default value of 1, the concepts are written sequentially in the main process.
+WRITER_NUM_WORKERS: int = 1
+# :param REPORT_NUM_WORKERS:
+#       The number of worker processes that are used to create the pages of the concept report in parallel. 
+#       With the default value of 1, the report is created sequentially in the main process.
+REPORT_NUM_WORKERS: int = 1
+# :param REPORT_CHUNK_SIZE:
+#       Optionally, the number of concepts that are converted into one part of the report PDF. These parts 
+#       are converted independently and then concatenated into the final report, which limits the memory 
+#       usage for very large numbers of concepts. If this is None, the whole report is converted at once.
+REPORT_CHUNK_SIZE: t.Optional[int] = None
 
 __DEBUG__ = True
 
@@ -309,18 +363,33 @@ def prototype_hypothesis(e: Experiment,
 def describe_prototype(e: Experiment,
                        value: str,
                        image_path: str,
-                       ) -> str:
+                       ) -> t.Union[str, Future]:
+    
+    def format_description(description: str) -> str:
+        return (
+            f'Prototoype Representation: {value}\n'
+            f'GPT-4 Description: {description}'
+        )
+    
+    # If the experiment has set up a request queue, the request is only submitted here and the hook 
+    # returns the future of the description, which is resolved after the concept loop.
+    queue: t.Optional[GptQueue] = getattr(e, 'gpt_queue', None)
+    if queue is not None:
+        future = describe_color_graph(
+            api_key=e.OPENAI_KEY,
+            image_path=image_path,
+            queue=queue,
+        )
+        return map_future(future, lambda result: format_description(result[0]))
     
     try:
         description, _ = describe_color_graph(
             api_key=e.OPENAI_KEY,
             image_path=image_path,
+            cache=getattr(e, 'gpt_cache', None),
         )
         print(description)
-        return (
-            f'Prototoype Representation: {value}\n'
-            f'GPT-4 Description: {description}'
-        )
+        return format_description(description)
         
     except Exception as exc:
         e.log(f'error "{exc}" while describing the prototype - skipping!')
@@ -329,6 +398,120 @@ def describe_prototype(e: Experiment,
         return 'No description generated.'
 
 
+@experiment.hook('generate_prototype', replace=False, default=False)
+def generate_prototype(e: Experiment,
+                       model: Megan,
+                       processing: ProcessingBase,
+                       info: dict,
+                       channel_index: int,
+                       cluster_graphs: t.List[tv.GraphDict],
+                       cluster_embeddings: np.ndarray,
+                       contribution: float,
+                       ) -> None:
+    """
+    This hook receives the concept cluster ``info`` dict and all the information that is needed to generate 
+    the prototype for that cluster. It uses the "optimize_prototype" hook to obtain the prototype graph, 
+    visualizes it and then optionally uses the "describe_prototype" and "prototype_hypothesis" hooks to 
+    obtain the natural language description and hypothesis.
+    
+    The results are added to the given info dict in place as the "prototypes", "description" and 
+    "hypothesis" keys.
+    """
+    try:
+        e.log(f' * optimizing prototype for cluster {info["index"]}...')
+        # :hook optimize_prototype:
+        #       Given the model, the channel index, the processing instance, the list of cluster graphs and
+        #       the list of cluster embeddings, this hook is supposed to return a dictionary that describes 
+        #       the optimized prototype for the cluster. This dictionary will have to contain the two keys 
+        #       "graph" (the graph dict representation) and "value" (the string domain representation) of the 
+        #       the prototype.
+
+        # There are rare cases where this also fails due to the initial elements being empty for example
+        # in that case we 
+        cluster_prototype: dict = e.apply_hook(
+            'optimize_prototype',
+            model=model,
+            channel_index=channel_index,
+            processing=processing,
+            cluster_graphs=cluster_graphs,
+            cluster_embeddings=cluster_embeddings,
+        )
+
+        prototype_graph = cluster_prototype['graph']
+        prototype_value = cluster_prototype['value']
+
+        # Additionally the graph representation will have to contain the keys "node_importances" and
+        # "edge_importances" which are the explanation masks for the prototype and can be obtained 
+        # by querying the model with the final prototype graph and updating its attributes.
+        prototype_info = model.forward_graphs([prototype_graph])[0]
+        prototype_graph['node_importances'] = prototype_info['node_importance']
+        prototype_graph['edge_importances'] = prototype_info['edge_importance']
+
+        # 29.01.24
+        # So actually there is a chance that this visualization step may fail for some very exotic SMILES.
+        fig, _ = processing.visualize_as_figure(
+            value=cluster_prototype['value'],
+            graph=cluster_prototype['graph'],
+            width=1000,
+            height=1000,
+        )
+        prototype_path = os.path.join(e.path, f'prototype__cl{info["index"]:02d}.png')
+        fig.savefig(prototype_path)
+        plt.close(fig)
+
+        # The prototype that we add to the list needs to be a visual graph element dictionary which means that 
+        # it has to have the following structure consisting of an image path and the metadata dict, which then in 
+        # turn contains the actual graph representation dict.
+
+        prototype_graph['graph_repr'] = prototype_value
+
+        prototype = {
+            'image_path': prototype_path,
+            'metadata': {
+                'graph':    prototype_graph, 
+                'repr':     prototype_value,
+            },
+        }
+        info['prototypes'] = [prototype]
+
+        # It is also possible to specifically disable/enable the description of the prototypes
+        if e.DESCRIBE_PROTOTYPE:
+
+            # :hook describe_prototype:
+            #       Given the string representation of the prototype and the path to the visualization of the 
+            #       prototype, this hook is supposed to return a string description for the prototype.
+            #       which will be included in the concept report.
+            description = e.apply_hook(
+                'describe_prototype',
+                value=cluster_prototype['value'],
+                image_path=prototype_path,
+            )
+            info['description'] = description
+
+        if e.HYPOTHESIZE_PROTOTYPE:
+            # :hook prototype_hypothesis:
+            #       Given the string representation of the prototype, the path to the visualization and the 
+            #       description string, this hook is supposed to return a string hypothesis for the prototype.
+            #       This hypothesis is supposed to provide a starting point about the causal structure property 
+            #       relationship of the prototype & the cluster as a whole.
+            hypothesis = e.apply_hook(
+                'prototype_hypothesis', 
+                value=cluster_prototype['value'],
+                image_path=prototype_path,
+                channel_index=channel_index,
+                contribution=contribution,
+            )
+            # Thers is a chance that the hypothesis generation fails or is not implemented for a specific 
+            # target domain. So only if a textual hypothesis is actually returned we want to include it in
+            # the cluster info.
+            if hypothesis is not None:
+                info['hypothesis'] = hypothesis
+
+    except Exception as exc:
+        e.log(f'error "{exc}" while optimizing the prototype - skipping!')
+        traceback.print_exc()
+
+
 @experiment
 def experiment(e: Experiment):
     
@@ -430,8 +613,22 @@ def experiment(e: Experiment):
     # the analysis as well so we will save them as a separate experiment artifact.
     e.log('saving the raw graph data as a JSON file...')
     graphs_path = os.path.join(e.path, 'graphs.json')
-    with open(graphs_path, 'w') as file:
-        json.dump(graphs, file, cls=NumericJsonEncoder)
+    dump_json(graphs, graphs_path)
+    
+    # The GPT requests for the prototype descriptions are submitted to this queue during the concept loop, which 
+    # executes them concurrently in the background. They are only awaited after the loop.
+    # Responses which are found in the cache are returned immediately, so the queue is also set up without an API 
+    # key to allow offline runs with the cached responses.
+    e.gpt_queue = None
+    e.gpt_cache = GptCache(e.GPT_CACHE_PATH) if e.GPT_CACHE_PATH else None
+    if e.OPTIMIZE_CLUSTER_PROTOTYPE and (e.DESCRIBE_PROTOTYPE or e.HYPOTHESIZE_PROTOTYPE):
+        e.gpt_queue = GptQueue(
+            api_key=e.OPENAI_KEY,
+            max_concurrency=e.GPT_CONCURRENCY,
+            requests_per_minute=e.GPT_REQUESTS_PER_MINUTE,
+            cache=e.gpt_cache,
+            logger=e.logger,
+        )
     
     # Now we calculate the concept clusters separately for each of the explanation channels of the model.
     e.log('starting concept clustering...')
@@ -487,7 +684,10 @@ def experiment(e: Experiment):
             cluster_centroid = np.mean(cluster_graph_embeddings, axis=0)
             # cluster_indices: (B_cluster, )
             cluster_indices = channel_indices[mask]
-            cluster_elements = deepcopy([index_data_map[i] for i in cluster_indices])
+            # The elements are only references to the shared element dicts of the dataset and not copies. The 
+            # ConceptWriter only creates (small) copies of them when it strips the fields that don't need to be 
+            # saved, so the clusters do not duplicate the full graph dicts of all their members in memory.
+            cluster_elements = [index_data_map[i] for i in cluster_indices]
             cluster_index_tuples = [(i, channel_index) for i in cluster_indices]
             cluster_graphs = [index_data_map[i]['metadata']['graph'] for i in cluster_indices]
             cluster_image_paths = [index_data_map[i]['image_path'] for i in cluster_indices]
@@ -506,6 +706,7 @@ def experiment(e: Experiment):
                 'elements':             cluster_elements,
                 'graphs':               cluster_graphs,
                 'image_paths':          cluster_image_paths,
+                'contribution':         cluster_contribution,
                 'name':                 e.CHANNEL_INFOS[channel_index]['name'],
                 'color':                e.CHANNEL_INFOS[channel_index]['color'],
             }
@@ -514,104 +715,39 @@ def experiment(e: Experiment):
             # Optionally it is also possible to derive an approximation for the prototype of the cluster by doing 
             # an optimization scheme. However, this will require quite some time so it can be skipped as well.
             if e.OPTIMIZE_CLUSTER_PROTOTYPE:
-
-                try:
-                    e.log(f' ({cluster}/{num_clusters}) optimizing prototype...')
-                    # :hook optimize_prototype:
-                    #       Given the model, the channel index, the processing instance, the list of cluster graphs and
-                    #       the list of cluster embeddings, this hook is supposed to return a dictionary that describes 
-                    #       the optimized prototype for the cluster. This dictionary will have to contain the two keys 
-                    #       "graph" (the graph dict representation) and "value" (the string domain representation) of the 
-                    #       the prototype.
-                    
-                    # There are rare cases where this also fails due to the initial elements being empty for example
-                    # in that case we 
-                    cluster_prototype: dict = e.apply_hook(
-                        'optimize_prototype',
-                        model=model,
-                        channel_index=channel_index,
-                        processing=processing,
-                        cluster_graphs=cluster_graphs,
-                        cluster_embeddings=cluster_graph_embeddings,
-                    )
-                    
-                    prototype_graph = cluster_prototype['graph']
-                    prototype_value = cluster_prototype['value']
-                    
-                    # Additionally the graph representation will have to contain the keys "node_importances" and
-                    # "edge_importances" which are the explanation masks for the prototype and can be obtained 
-                    # by querying the model with the final prototype graph and updating its attributes.
-                    prototype_info = model.forward_graphs([prototype_graph])[0]
-                    prototype_graph['node_importances'] = prototype_info['node_importance']
-                    prototype_graph['edge_importances'] = prototype_info['edge_importance']
-                    
-                    # 29.01.24
-                    # So actually there is a chance that this visualization step may fail for some very exotic SMILES.
-                    fig, _ = processing.visualize_as_figure(
-                        value=cluster_prototype['value'],
-                        graph=cluster_prototype['graph'],
-                        width=1000,
-                        height=1000,
-                    )
-                    prototype_path = os.path.join(e.path, f'prototype__cl{cluster_index:02d}.png')
-                    fig.savefig(prototype_path)
-                    plt.close(fig)
-                    
-                    # The prototype that we add to the list needs to be a visual graph element dictionary which means that 
-                    # it has to have the following structure consisting of an image path and the metadata dict, which then in 
-                    # turn contains the actual graph representation dict.
-                    
-                    prototype_graph['graph_repr'] = prototype_value
-                    
-                    prototype = {
-                        'image_path': prototype_path,
-                        'metadata': {
-                            'graph':    prototype_graph, 
-                            'repr':     prototype_value,
-                        },
-                    }
-                    info['prototypes'] = [prototype]
-                    
-                    # It is also possible to specifically disable/enable the description of the prototypes
-                    if e.DESCRIBE_PROTOTYPE:
-                    
-                        # :hook describe_prototype:
-                        #       Given the string representation of the prototype and the path to the visualization of the 
-                        #       prototype, this hook is supposed to return a string description for the prototype.
-                        #       which will be included in the concept report.
-                        description = e.apply_hook(
-                            'describe_prototype',
-                            value=cluster_prototype['value'],
-                            image_path=prototype_path,
-                        )
-                        info['description'] = description
-                        
-                    if e.HYPOTHESIZE_PROTOTYPE:
-                        # :hook prototype_hypothesis:
-                        #       Given the string representation of the prototype, the path to the visualization and the 
-                        #       description string, this hook is supposed to return a string hypothesis for the prototype.
-                        #       This hypothesis is supposed to provide a starting point about the causal structure property 
-                        #       relationship of the prototype & the cluster as a whole.
-                        hypothesis = e.apply_hook(
-                            'prototype_hypothesis', 
-                            value=cluster_prototype['value'],
-                            image_path=prototype_path,
-                            channel_index=channel_index,
-                            contribution=cluster_contribution,
-                        )
-                        # Thers is a chance that the hypothesis generation fails or is not implemented for a specific 
-                        # target domain. So only if a textual hypothesis is actually returned we want to include it in
-                        # the cluster info.
-                        if hypothesis is not None:
-                            info['hypothesis'] = hypothesis
-                    
-                except Exception as exc:
-                    e.log(f'error "{exc}" while optimizing the prototype - skipping!')
-                    traceback.print_exc()
+                
+                # :hook generate_prototype:
+                #       Given the cluster info dict and the cluster members, this hook optimizes the prototype 
+                #       graph and optionally generates the description and hypothesis for it. The results are 
+                #       added to the info dict in place.
+                e.apply_hook(
+                    'generate_prototype',
+                    model=model,
+                    processing=processing,
+                    info=info,
+                    channel_index=channel_index,
+                    cluster_graphs=cluster_graphs,
+                    cluster_embeddings=cluster_graph_embeddings,
+                    contribution=cluster_contribution,
+                )
             
             cluster_index += 1
             cluster_infos.append(info)
     
+    if e.gpt_queue is not None:
+        e.log('waiting for the pending GPT requests...')
+        resolve_futures(
+            cluster_infos, 
+            defaults={'description': 'No description generated.', 'hypothesis': None},
+            logger=e.logger,
+        )
+        e.log(f'finished GPT requests with {e.gpt_queue.num_retries} retries')
+        e.gpt_queue.close()
+        
+    if e.gpt_cache is not None:
+        e.log(e.gpt_cache.report())
+        e['gpt_cache'] = {'hits': e.gpt_cache.num_hits, 'misses': e.gpt_cache.num_misses}
+    
     print(cluster_infos[0].keys())
             
     # We definitely want to store the cluster infos to the experiment storage so that we can access them 
@@ -624,28 +760,13 @@ def experiment(e: Experiment):
     # are added to the new list.
     if e.SORT_SIMILARITY:
         
-        e.log('sorting clusters by similarity...')
-        cluster_infos_sorted = []
-        for k in range(e['num_channels']):
-            infos = [info for info in cluster_infos if info['channel_index'] == k]
-            
-            info = infos.pop(0)
-            cluster_infos_sorted.append(info)
-            
-            while len(infos) != 0:
-                
-                centroid = info['centroid']
-                centroid_distances = pairwise_distances(
-                    np.expand_dims(centroid, axis=0),
-                    [i['centroid'] for i in infos],
-                    metric='manhattan',
-                )
-                
-                index = np.argmin(centroid_distances[0])
-                info = infos.pop(index)
-                cluster_infos_sorted.append(info)
-        
-        cluster_infos = cluster_infos_sorted
+        e.log(f'sorting clusters by similarity with the "{e.SORT_METHOD}" method...')
+        cluster_infos = sort_concepts_by_similarity(
+            concepts=cluster_infos,
+            num_channels=e['num_channels'],
+            metric='manhattan',
+            method=e.SORT_METHOD,
+        )
         
     for index, info in enumerate(cluster_infos):
         info['index'] = index
@@ -653,6 +774,9 @@ def experiment(e: Experiment):
     # ~ Clustering metrics
     
     e.log('calculating clustering metrics...')
+    # These are the metrics for each channel, which are later saved into the global metadata of the concept 
+    # clustering, while the per-concept metrics are added to the concept dicts themselves.
+    channel_metrics: t.Dict[int, dict] = {}
     for channel_index in range(e['num_channels']):
             
         infos = [info for info in cluster_infos if info['channel_index'] == channel_index]
@@ -660,28 +784,42 @@ def experiment(e: Experiment):
         if len(infos) < 2:
             continue
         
-        embeddings = []
-        labels = []
-        for index, info in enumerate(infos):
-            embeddings += info['embeddings'].tolist()
-            labels += [index for _ in info['embeddings']]
-        
-        embeddings = np.array(embeddings)
-        labels = np.array(labels)
+        time_start = time.time()
+        # embeddings: (N, D) and labels: (N, ) 
+        # This is the columnar representation of all the concept members of the channel, where the labels 
+        # are the positions of the concepts in the infos list.
+        embeddings, labels = concepts_to_columns(infos)
         
-        # calculating the silhouette score
         # The silhouette score is a measure of how similar an object is to its own cluster (cohesion) compared to
         # other clusters (separation). The silhouette ranges from -1 to 1, where a high value indicates that the
         # object is well matched to its own cluster and poorly matched to neighboring clusters.
-        sil_value = silhouette_score(embeddings, labels)
-        dbi_value = davies_bouldin_score(embeddings, labels)
+        # Since the silhouette requires all the pairwise distances, it is computed on a random subsample if 
+        # there are more than METRICS_SAMPLE_SIZE elements.
+        metrics = clustering_metrics(
+            embeddings, labels,
+            silhouette_sample_size=e.METRICS_SAMPLE_SIZE,
+        )
+        duration = time.time() - time_start
         
-        e[f'{channel_index}/silhouette'] = sil_value
-        e[f'{channel_index}/dbi'] = dbi_value
+        for info, intra_distance, nearest_distance in zip(infos, metrics['intra_distances'], metrics['nearest_distances']):
+            info['intra_distance'] = intra_distance
+            info['nearest_distance'] = nearest_distance
+        
+        channel_metrics[channel_index] = {
+            'silhouette': metrics['silhouette'],
+            'dbi': metrics['dbi'],
+            'inter_distance_mean': metrics['inter_distance_mean'],
+            'duration': duration,
+        }
+        e[f'{channel_index}/silhouette'] = metrics['silhouette']
+        e[f'{channel_index}/dbi'] = metrics['dbi']
+        e[f'{channel_index}/metrics_duration'] = duration
         
         e.log(f'channel {channel_index}'
-              f' - silhouette: {sil_value:.3f}'
-              f' - dbi: {dbi_value:.3f}')
+              f' - silhouette: {metrics["silhouette"]:.3f}'
+              f' - dbi: {metrics["dbi"]:.3f}'
+              f' - inter distance: {metrics["inter_distance_mean"]:.3f}'
+              f' - duration: {duration:.2f}s')
     
     # ~ Dimensionality reduction
     # In this section we want to create perform a dimensionality reduction on the graph embedding latent space 
@@ -689,6 +827,9 @@ def experiment(e: Experiment):
     # this purpose we are using UMAP - specifically we are using a separate UMAPing process for each of the 
     # explanation channels.
     
+    # The fitted mappers are saved alongside the concepts so that new elements can later be projected into the 
+    # same 2D space without having to re-fit the mappers.
+    mappers: t.Dict[int, umap.UMAP] = {}
     if e.PLOT_UMAP:
         
         e.log(f'starting to create {e["num_channels"]} UMAP visualizations...')
@@ -706,15 +847,26 @@ def experiment(e: Experiment):
             # all the graphs for the mapping but only a subset of them according to the fidelty threshold.
             # because the embeddings with really low fidelity dont make any sense to look at anyways and would 
             # only "pollute" the visualization.
-            channel_graphs = [
-                graph
-                for graph in graphs
+            channel_indices = [
+                index
+                for index, graph in zip(indices, graphs)
                 if graph['graph_fidelity'][channel_index] > e.FIDELITY_THRESHOLD
             ]
             
             # graph_embeddings: (B, D)
-            embeddings = np.array([graph['graph_embedding'][:, channel_index] for graph in channel_graphs])
-            e.log(f' * filtered {len(channel_graphs)} elements from {len(graphs)}')
+            embeddings = np.array([index_data_map[index]['metadata']['graph']['graph_embedding'][:, channel_index] 
+                                   for index in channel_indices])
+            e.log(f' * filtered {len(channel_indices)} elements from {len(graphs)}')
+            
+            # For each of the filtered elements we determine the concept that it belongs to as its label, where the 
+            # elements that do not belong to any concept get the label -1. These labels are used to stratify the 
+            # subsample on which the mapper is fitted and to find the mapped positions of the concept members.
+            infos = [info for info in cluster_infos if info['channel_index'] == channel_index]
+            index_position_map = {index: position for position, index in enumerate(channel_indices)}
+            labels = np.full(shape=(len(channel_indices), ), fill_value=-1, dtype=int)
+            for info in infos:
+                positions = [index_position_map[i] for i, _ in info['index_tuples'] if i in index_position_map]
+                labels[positions] = info['index']
             
             mapper = umap.UMAP(
                 n_neighbors=100,
@@ -723,16 +875,22 @@ def experiment(e: Experiment):
                 metric='manhattan',
                 repulsion_strength=1.0,
             )
-            mapped = mapper.fit_transform(embeddings)
+            mapped = fit_transform_mapper(
+                mapper=mapper,
+                embeddings=embeddings,
+                labels=labels,
+                num_fit_samples=e.UMAP_NUM_FIT_SAMPLES,
+            )
+            mappers[channel_index] = mapper
             
             # Then in the first row, we ware going to just plot the latent space in raw format without indicating the 
             # actual clustering results.
             ax_raw = rows[0][channel_index]
-            ax_raw.scatter(
-                mapped[:, 0], mapped[:, 1],
+            plot_embedding_points(
+                ax=ax_raw,
+                points=mapped,
                 color=e.CHANNEL_INFOS[channel_index]['color'],
-                linewidths=0.0,
-                s=10,
+                size=10,
                 alpha=0.25,
             )
             ax_raw.set_title(f'UMAP Reduced Explanation Embeddings\n'
@@ -744,39 +902,39 @@ def experiment(e: Experiment):
             ax_cls = rows[1][channel_index]
             ax_cls.set_title('HDBSCAN Clusters and Centroids')
             
-            ax_cls.scatter(
-                mapped[:, 0], mapped[:, 1],
+            plot_embedding_points(
+                ax=ax_cls,
+                points=mapped,
                 color='lightgray',
-                linewidths=0.0,
-                s=10,
+                size=10,
+                alpha=1.0,
                 zorder=-10,
             )
+            # The concept members are part of the elements that were already mapped, so their positions can 
+            # be taken directly from the mapping without any further transformation.
+            plot_embedding_points(
+                ax=ax_cls,
+                points=mapped[labels >= 0],
+                color='lightgreen',
+                size=5,
+                alpha=1.0,
+            )
             
-            infos = [info for info in cluster_infos if info['channel_index'] == channel_index]
-            for info in infos:
-                
-                embeddings = info['embeddings']
-                embeddings_mapped = mapper.transform(embeddings)
-                ax_cls.scatter(
-                    embeddings_mapped[:, 0], embeddings_mapped[:, 1],
-                    color='lightgreen',
-                    linewidths=0.0,
-                    s=5,
-                )
-                
-                centroid = info['centroid']
-                centroid_mapped = mapper.transform(np.expand_dims(centroid, axis=0))
+            if len(infos) != 0:
+                # centroids_mapped: (num_concepts, 2)
+                centroids_mapped = mapper.transform(np.array([info['centroid'] for info in infos]))
                 ax_cls.scatter(
-                    centroid_mapped[0, 0], centroid_mapped[0, 1],
+                    centroids_mapped[:, 0], centroids_mapped[:, 1],
                     color='black',
                     marker='x',
                     zorder=10,
                 )
-                ax_cls.text(
-                    centroid_mapped[0, 0], centroid_mapped[0, 1],
-                    f'({info["index"]})',
-                    zorder=10,
-                )
+                for info, centroid_mapped in zip(infos, centroids_mapped):
+                    ax_cls.text(
+                        centroid_mapped[0], centroid_mapped[1],
+                        f'({info["index"]})',
+                        zorder=10,
+                    )
         
         fig_path = os.path.join(e.path, 'umap.png')
         fig.savefig(fig_path, dpi=300)
@@ -794,8 +952,15 @@ def experiment(e: Experiment):
         model=model,
         processing=processing,
         logger=e.logger,
+        num_workers=e.WRITER_NUM_WORKERS,
+    )
+    # Besides the concepts themselves we also store the dataset indices that were considered for the clustering 
+    # so that an incremental update of the concepts is able to determine which elements of a dataset are new.
+    writer.write(
+        cluster_infos, 
+        metadata={'indices': indices, 'metrics': channel_metrics}, 
+        mappers=mappers,
     )
-    writer.write(cluster_infos)
     
     # ~ creating the concept report
     # Based on the raw information about the extracted concept clusters we now want to generate a PDF report 
@@ -818,6 +983,8 @@ def experiment(e: Experiment):
         num_examples=16,
         distance_func=cosine,
         normalize_centroid=True,
+        num_workers=e.REPORT_NUM_WORKERS,
+        chunk_size=e.REPORT_CHUNK_SIZE,
     )
     
     
@@ -879,6 +1046,8 @@ def analysis(e: Experiment):
         num_examples=16,
         distance_func=cosine,
         normalize_centroid=True,
+        num_workers=e.REPORT_NUM_WORKERS,
+        chunk_size=e.REPORT_CHUNK_SIZE,
     )
 
 experiment.run_if_main()
\ No newline at end of file
@@ -7,6 +7,7 @@ import pathlib
 import random
 import traceback
 import typing as t
+from concurrent.futures import Future
 from copy import deepcopy
 
 import numpy as np
@@ -21,6 +22,8 @@ from visual_graph_datasets.graph import copy_graph_dict
 from graph_attention_student.torch.megan import Megan
 from megan_global_explanations.gpt import query_gpt
 from megan_global_explanations.gpt import describe_molecule
+from megan_global_explanations.gpt import map_future
+from megan_global_explanations.gpt import GptQueue
 from megan_global_explanations.prototype.optimize import genetic_optimize
 from megan_global_explanations.prototype.optimize import embedding_distances_fitness_mse
 from megan_global_explanations.prototype.molecules import mutate_remove_atom
@@ -233,15 +236,30 @@ def optimize_prototype(e: Experiment,
 def describe_prototype(e: Experiment,
                        value: str,
                        image_path: str,
-                       ) -> str:
+                       ) -> t.Union[str, Future]:
     
     print(value)
     e.log(' * generating description for the molecular prototype...')
+    
+    # If the experiment has set up a request queue, the request is only submitted here and the hook 
+    # returns the future of the description, which is resolved after the concept loop.
+    queue: t.Optional[GptQueue] = getattr(e, 'gpt_queue', None)
+    if queue is not None:
+        future = describe_molecule(
+            api_key=e.OPENAI_KEY,
+            smiles=value,
+            image_path=image_path,
+            max_tokens=200,
+            queue=queue,
+        )
+        return map_future(future, lambda result: result[0])
+    
     description, _ = describe_molecule(
         api_key=e.OPENAI_KEY,
         smiles=value,
         image_path=image_path,
         max_tokens=200,
+        cache=getattr(e, 'gpt_cache', None),
     )
     print(description)
     
@@ -255,7 +273,7 @@ def prototype_hypothesis(e: Experiment,
                          channel_index: int,
                          contribution: float,
                          **kwargs,
-                         ) -> t.Optional[str]:
+                         ) -> t.Union[str, Future, None]:
     
     e.log(' * generating mutagenicity prototype hypothesis with GPT...')
     
@@ -290,11 +308,22 @@ def prototype_hypothesis(e: Experiment,
         f'towards "{name}"'
     )
     
+    queue: t.Optional[GptQueue] = getattr(e, 'gpt_queue', None)
+    if queue is not None:
+        future = query_gpt(
+            api_key=e.OPENAI_KEY,
+            system_message=system_message,
+            user_message=user_message,
+            queue=queue,
+        )
+        return map_future(future, lambda result: result[0])
+    
     try:
         description, messages = query_gpt(
             api_key=e.OPENAI_KEY,
             system_message=system_message,
             user_message=user_message,
+            cache=getattr(e, 'gpt_cache', None),
         )
         print(description)
         return description
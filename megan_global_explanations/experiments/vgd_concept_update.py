@@ -0,0 +1,244 @@
+"""
+This experiment extends the base concept extraction experiment "vgd_concept_extraction" with an incremental
+update mode. Instead of re-running the entire concept extraction when new elements are added to a visual
+graph dataset, this experiment loads an existing concept clustering folder (as created by the ConceptWriter)
+and only processes the new elements of the dataset.
+
+Only the new elements are passed through the model. These are then assigned to the existing concepts if they
+lie within the radius of the closest concept centroid. Only the remaining unassigned elements are clustered to
+find new concepts. Prototypes are only re-generated for the new concepts and for those existing concepts whose
+centroids have drifted past the given threshold due to the new members.
+"""
+import os
+import pathlib
+import typing as t
+
+import numpy as np
+import matplotlib as mpl
+from scipy.spatial.distance import cosine
+from pycomex.functional.experiment import Experiment
+from pycomex.utils import folder_path, file_namespace
+from graph_attention_student.torch.megan import Megan
+
+from megan_global_explanations.main import annotate_graphs
+from megan_global_explanations.main import update_concepts
+from megan_global_explanations.utils import extend_graph_info
+from megan_global_explanations.data import ConceptReader
+from megan_global_explanations.data import ConceptWriter
+from megan_global_explanations.gpt import GptCache
+from megan_global_explanations.visualization import create_concept_cluster_report
+
+mpl.use('Agg')
+
+PATH = pathlib.Path(__file__).parent.absolute()
+
+# == UPDATE PARAMETERS ==
+# These parameters determine the details of the incremental update of an existing concept clustering.
+
+# :param CONCEPTS_PATH:
+#       This has to be the absolute string path to the existing concept clustering folder which should be
+#       updated. This folder is typically the "concepts" folder in the archive of a previous run of the
+#       "vgd_concept_extraction" experiment. The updated concepts are written into a new folder within the
+#       archive folder of this experiment, the original folder is not modified.
+CONCEPTS_PATH: str = os.path.join(PATH, 'assets', 'concepts', 'rb_dual_motifs')
+# :param RADIUS_QUANTILE:
+#       This float value determines the radius of each existing concept as this quantile of the distances of
+#       the concept members to the concept centroid. A new element is only assigned to the closest existing
+#       concept if it is within that radius.
+RADIUS_QUANTILE: float = 0.95
+# :param DRIFT_THRESHOLD:
+#       This float value determines when the centroid of an existing concept is considered to have drifted
+#       due to the new members. It is measured relative to the radius of the concept. The prototypes are only
+#       re-generated for the concepts that have drifted.
+DRIFT_THRESHOLD: float = 0.1
+# :param CREATE_REPORT:
+#       This boolean flag determines whether the concept report PDF should be created for the updated concepts.
+#       Note that this requires a model forward pass for all the concept members, which is otherwise avoided.
+CREATE_REPORT: bool = False
+
+__DEBUG__ = True
+
+experiment = Experiment.extend(
+    'vgd_concept_extraction.py',
+    base_path=folder_path(__file__),
+    namespace=file_namespace(__file__),
+    glob=globals(),
+)
+
+
+@experiment
+def experiment(e: Experiment):
+
+    e.log('starting incremental concept update...')
+
+    # ~ loading the dataset and the model
+
+    dataset_path = e.apply_hook('get_dataset_path')
+    e.log('loading dataset...')
+    index_data_map, processing = e.apply_hook(
+        'load_dataset',
+        path=dataset_path,
+    )
+    e.log(f'loaded dataset with {len(index_data_map)} elements')
+    # This copies the domain representations from the metadata into the graph dicts themselves, which is
+    # required for the prototype optimization.
+    extend_graph_info(index_data_map)
+
+    model: Megan = e.apply_hook(
+        'load_model',
+        path=e.MODEL_PATH,
+    )
+    num_channels = model.num_channels
+    e['num_channels'] = num_channels
+    e.log(f'loaded model of the class: {model.__class__.__name__} '
+          f'with {num_channels} explanation channels')
+
+    # ~ loading the existing concepts
+    # For the update we only need the information which is stored in the concept metadata itself (centroids,
+    # embeddings and member indices) which is why the reader does not need to query the model here.
+
+    e.log('loading the existing concepts...')
+    reader = ConceptReader(
+        path=e.CONCEPTS_PATH,
+        model=model,
+        dataset=index_data_map,
+        logger=e.logger,
+        query_model=False,
+    )
+    concepts = reader.read()
+    for concept in concepts:
+        concept['embeddings'] = np.array(concept['embeddings'])
+        concept['centroid'] = np.array(concept['centroid'])
+    e.log(f'loaded {len(concepts)} concepts')
+
+    # The metadata of the concept folder should contain the dataset indices which were already considered
+    # during the creation of the concepts. For older concept folders, where this is not the case, only the
+    # concept members can be used as the known elements.
+    if 'indices' in reader.metadata:
+        indices_known = set(reader.metadata['indices'])
+    else:
+        indices_known = set(int(index) for concept in concepts for index, _ in concept['index_tuples'])
+
+    indices_new = [index for index in index_data_map.keys() if index not in indices_known]
+    e.log(f'found {len(indices_new)} new elements')
+
+    # ~ updating the concepts
+    # Only the new elements are passed through the model.
+
+    e.log('running the model forward pass for the new elements...')
+    annotate_graphs(
+        model=model,
+        graphs=[index_data_map[index]['metadata']['graph'] for index in indices_new],
+        dataset_type=e.DATASET_TYPE,
+    )
+
+    e.log('updating the concepts...')
+    concepts, update_indices = update_concepts(
+        concepts=concepts,
+        index_data_map=index_data_map,
+        indices=indices_new,
+        num_channels=num_channels,
+        dataset_type=e.DATASET_TYPE,
+        fidelity_threshold=e.FIDELITY_THRESHOLD,
+        min_samples=e.MIN_SAMPLES,
+        min_cluster_size=e.MIN_CLUSTER_SIZE,
+        cluster_metric='manhattan',
+        cluster_selection_method=e.CLUSTER_SELECTION_METHOD,
+        radius_quantile=e.RADIUS_QUANTILE,
+        drift_threshold=e.DRIFT_THRESHOLD,
+        embedding_key='graph_embeddings',
+        channel_infos=e.CHANNEL_INFOS,
+        logger=e.logger,
+    )
+    e['update_indices'] = update_indices
+    e.log(f'updated to {len(concepts)} concepts, {len(update_indices)} of which need new prototypes')
+
+    # ~ re-generating prototypes
+    # Only the concepts that are new or whose centroids have drifted get new prototypes. Only the members
+    # of these concepts need to be passed through the model to obtain the explanations.
+
+    if e.OPTIMIZE_CLUSTER_PROTOTYPE:
+
+        # The descriptions of the re-generated prototypes are requested synchronously here, but can still be 
+        # served from the same response cache as the original extraction.
+        e.gpt_cache = GptCache(e.GPT_CACHE_PATH) if e.GPT_CACHE_PATH else None
+        for concept in concepts:
+            if concept['index'] not in update_indices:
+                continue
+
+            e.log(f're-generating the prototype for concept {concept["index"]}...')
+            for key in ['prototypes', 'description', 'hypothesis']:
+                concept.pop(key, None)
+
+            graphs = [index_data_map[int(index)]['metadata']['graph'] for index, _ in concept['index_tuples']]
+            graphs_missing = [graph for graph in graphs if 'graph_embeddings' not in graph]
+            annotate_graphs(model, graphs_missing, dataset_type=e.DATASET_TYPE)
+
+            e.apply_hook(
+                'generate_prototype',
+                model=model,
+                processing=processing,
+                info=concept,
+                channel_index=concept['channel_index'],
+                cluster_graphs=graphs,
+                cluster_embeddings=concept['embeddings'],
+                contribution=concept.get('contribution', 0.0),
+            )
+            
+        if e.gpt_cache is not None:
+            e.log(e.gpt_cache.report())
+
+    # ~ writing the updated concepts
+
+    e.log('saving the updated concept clustering data...')
+    concepts_path = os.path.join(e.path, 'concepts')
+    os.mkdir(concepts_path)
+    writer = ConceptWriter(
+        path=concepts_path,
+        model=model,
+        processing=processing,
+        logger=e.logger,
+        num_workers=e.WRITER_NUM_WORKERS,
+    )
+    # The UMAP mappers of the existing concepts (if any) are carried over as they are, which keeps the 2D 
+    # projections of the updated concepts consistent with the original ones.
+    writer.write(
+        concepts, 
+        metadata={'indices': list(index_data_map.keys())},
+        mappers=reader.mappers,
+    )
+
+    # ~ creating the concept report
+
+    if e.CREATE_REPORT:
+
+        e.log('running the model forward pass for the remaining concept members...')
+        graphs = [index_data_map[int(index)]['metadata']['graph'] for concept in concepts for index, _ in concept['index_tuples']]
+        annotate_graphs(
+            model=model,
+            graphs=[graph for graph in graphs if 'graph_embeddings' not in graph],
+            dataset_type=e.DATASET_TYPE,
+        )
+        for concept in concepts:
+            concept['elements'] = [index_data_map[int(index)] for index, _ in concept['index_tuples']]
+
+        e.log('creating the concept report...')
+        report_path = os.path.join(e.path, 'concept_report.pdf')
+        cache_path = os.path.join(e.path, 'cache')
+        os.mkdir(cache_path)
+        create_concept_cluster_report(
+            cluster_data_list=concepts,
+            dataset_type=e.DATASET_TYPE,
+            logger=e.logger,
+            path=report_path,
+            cache_path=cache_path,
+            examples_type='centroid',
+            num_examples=16,
+            distance_func=cosine,
+            normalize_centroid=True,
+            num_workers=e.REPORT_NUM_WORKERS,
+            chunk_size=e.REPORT_CHUNK_SIZE,
+        )
+
+
+experiment.run_if_main()
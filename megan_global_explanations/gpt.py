@@ -1,8 +1,34 @@
+import io
 import os
+import json
+import time
 import base64
+import hashlib
+import random
+import asyncio
+import logging
+import threading
 import typing as t
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
 
 import requests
+from PIL import Image
+
+from megan_global_explanations.utils import NULL_LOGGER
+from megan_global_explanations.utils import safe_int
+from megan_global_explanations.utils import content_hash
+
+# The URL of the OpenAI chat completion API endpoint to which all the queries are sent by default.
+OPENAI_URL: str = 'https://api.openai.com/v1/chat/completions'
+# Requests that fail with these HTTP status codes are considered transient failures (rate limits, 
+# server overload etc.) and are retried by the GptQueue.
+RETRY_STATUS_CODES: t.Tuple[int, ...] = (408, 409, 429, 500, 502, 503, 504)
+# The vision model processes the images (in the "high" detail mode) after scaling them to fit into a 2048x2048 
+# square and then such that the shorter side is at most 768 pixels. Larger images would be downscaled by the 
+# API anyways, so they are already downscaled to that size before sending them.
+IMAGE_MAX_SIZE: int = 768
+IMAGE_MAX_BOX: int = 2048
 
 
 def encode_image(image_path: str) -> str:
@@ -21,10 +47,80 @@ def encode_image(image_path: str) -> str:
     return base64.b64encode(image_data).decode('utf-8')
 
 
+# This maps the (path, modification time, size) of an image file to the hash of its content, so that the 
+# content of an unchanged image file only has to be read and hashed once.
+_IMAGE_HASH_MAP: dict[tuple, str] = {}
+
+
+def image_hash(image_path: str) -> str:
+    """
+    Returns the SHA256 hex digest of the content of the image file with the given ``image_path``. The 
+    result is memoized for as long as the modification time and the size of the file do not change.
+    
+    :param image_path: The absolute string path to the image file
+    
+    :returns: The hex digest string
+    """
+    stat = os.stat(image_path)
+    key = (image_path, stat.st_mtime_ns, stat.st_size)
+    if key not in _IMAGE_HASH_MAP:
+        with open(image_path, 'rb') as file:
+            _IMAGE_HASH_MAP[key] = hashlib.sha256(file.read()).hexdigest()
+            
+    return _IMAGE_HASH_MAP[key]
+
+
+# This maps the (image content hash, max_size) to the already prepared base64 string of that image.
+_IMAGE_ENCODING_MAP: dict[tuple, str] = {}
+
+
+def prepare_image(image_path: str,
+                  max_size: t.Optional[int] = IMAGE_MAX_SIZE,
+                  ) -> str:
+    """
+    Prepares the image with the given ``image_path`` to be sent as part of a GPT request payload. The image is 
+    downscaled to the resolution that the vision model actually uses - such that the shorter side is at most 
+    ``max_size`` pixels - and compactly re-encoded as an optimized PNG, which is then encoded as a base64 string.
+    Fully opaque images are stored without the alpha channel.
+    
+    The result is memoized by the content hash of the image file (see ``image_hash``), so every image file 
+    is only encoded once as long as it does not change.
+    
+    :param image_path: The absolute string path to the image that should be encoded.
+    :param max_size: The maximum number of pixels of the shorter side of the image. If this is None, the 
+        image is not downscaled.
+        
+    :return: The base64 encoded string of the image.
+    """
+    key = (image_hash(image_path), max_size)
+    if key in _IMAGE_ENCODING_MAP:
+        return _IMAGE_ENCODING_MAP[key]
+    
+    with Image.open(image_path) as image:
+        image.load()
+        
+    if max_size is not None:
+        width, height = image.size
+        scale = min(max_size / min(width, height), IMAGE_MAX_BOX / max(width, height))
+        if scale < 1:
+            image = image.resize((round(width * scale), round(height * scale)), Image.LANCZOS)
+    
+    if image.mode in ('RGBA', 'LA') and image.getchannel('A').getextrema() == (255, 255):
+        image = image.convert(image.mode[:-1])
+        
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', optimize=True)
+    
+    _IMAGE_ENCODING_MAP[key] = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return _IMAGE_ENCODING_MAP[key]
+
+
 def describe_color_graph(api_key: str,
                          image_path: str,
                          max_tokens: int = 200,
-                         ) -> tuple[str, list[dict]]:
+                         queue: t.Optional['GptQueue'] = None,
+                         cache: t.Optional['GptCache'] = None,
+                         ) -> t.Union[tuple[str, list[dict]], Future]:
     """
     Given an OpenAI ``api_key`` and an image ``image_path`` this function will generate a description 
     of the color graph that is depicted in the given image.
@@ -34,10 +130,12 @@ def describe_color_graph(api_key: str,
     :param api_key: The OpenAI API key that should be used for the query.
     :param image_path: The absolute string path to the image that should be described.
     :param max_tokens: The maximum number of tokens that should be generated by the GPT assistant.
+    :param queue: An optional GptQueue to which the query is submitted instead of sending it immediately.
+    :param cache: An optional GptCache from which the response is returned if the same query was sent before.
     
     :returns: A tuple of the description string and the list of messages that were exchanged during the
         query process, which includes not only the initial user messages but also the assistants response
-        messages.
+        messages. If a queue is given, a Future of that tuple is returned instead.
     """
     
     system_message = (
@@ -59,21 +157,23 @@ def describe_color_graph(api_key: str,
     
     # The query_gpt function will take care of the actual query process and return the description string as well as the
     # list of messages that were exchanged during the query process.
-    description, messages = query_gpt(
+    return query_gpt(
         api_key=api_key,
         system_message=system_message,
         user_message=user_message,
         image_paths=[image_path],
+        queue=queue,
+        cache=cache,
     )
-    
-    return description, messages
 
 
 def describe_molecule(api_key: str,
                       smiles: str,
                       image_path: t.Optional[str] = None,
                       max_tokens: int = 500,
-                      ) -> tuple[str, list[dict]]:
+                      queue: t.Optional['GptQueue'] = None,
+                      cache: t.Optional['GptCache'] = None,
+                      ) -> t.Union[tuple[str, list[dict]], Future]:
     """
     Given an OpenAI ``api_key`` and a SMILES string ``smiles`` this function will generate a description 
     of the molecule that is represented by the given SMILES string. Optionally an ``image_path`` of the molecule 
@@ -85,10 +185,12 @@ def describe_molecule(api_key: str,
     :param api_key: The OpenAI API key that should be used for the query.
     :param smiles: The SMILES string representation of the molecule that should be described.
     :param image_path: An optional absolute string path to an image of the molecule that should be described.
+    :param queue: An optional GptQueue to which the query is submitted instead of sending it immediately.
+    :param cache: An optional GptCache from which the response is returned if the same query was sent before.
     
     :returns: A tuple of the description string and the list of messages that were exchanged during the
         query process, which includes not only the initial user messages but also the assistants response 
-        messages.
+        messages. If a queue is given, a Future of that tuple is returned instead.
     """
     
     system_message = (
@@ -123,14 +225,14 @@ def describe_molecule(api_key: str,
     
     # The query_gpt function will take care of the actual query process and return the description string as well as the
     # list of messages that were exchanged during the query process.
-    content, messages = query_gpt(
+    return query_gpt(
         api_key=api_key,
         system_message=system_message,
         user_message=user_message,
         image_paths=image_paths,
+        queue=queue,
+        cache=cache,
     )
-    
-    return content, messages
 
 
 def query_gpt(api_key: str,
@@ -141,7 +243,11 @@ def query_gpt(api_key: str,
               message_history: list[dict] = [],
               # Only this specific vision model is also able to process images as part of the query input.
               model: str = 'gpt-4-vision-preview',
-              ) -> tuple[str, list[dict]]:
+              url: str = OPENAI_URL,
+              queue: t.Optional['GptQueue'] = None,
+              cache: t.Optional['GptCache'] = None,
+              image_size: t.Optional[int] = IMAGE_MAX_SIZE,
+              ) -> t.Union[tuple[str, list[dict]], Future]:
     """
     This function queries the OpenAI GPT chat completion API using the given ``system_message`` and ``user_message``.
     Optionally it is possible to provide a number of ``image_paths`` which will be sent to the model as part of the 
@@ -155,10 +261,111 @@ def query_gpt(api_key: str,
     :param message_history: A list of messages that have already been exchanged between the system and the user.
     :param model: The model that should be used for the query. The default is the "gpt-4-vision-preview" model
         which is the only model that is able to process images as part of the query input.
+    :param url: The URL of the chat completion API endpoint.
+    :param queue: An optional GptQueue instance. If given, the query is not sent immediately but submitted to 
+        that queue instead (the api_key, url and cache of the queue are used in that case). 
+    :param cache: An optional GptCache instance. If the cache already contains the response to the same 
+        query, that response is returned without sending the query and without even preparing the images, 
+        which is why the returned messages do not contain the images in that case. Otherwise the response 
+        is added to the cache.
+    :param image_size: The images are downscaled such that their shorter side is at most this many pixels 
+        before sending them (see ``prepare_image``). If this is None, they are sent in full resolution.
     
     :returns: A tuple of the description string and the list of messages that were exchanged during the
         query process, which includes not only the initial user messages but also the assistants response
-        messages.
+        messages. If a queue is given, a Future of that tuple is returned instead.
+    """
+    if queue is not None:
+        return queue.submit(
+            system_message=system_message,
+            user_message=user_message,
+            image_paths=image_paths,
+            max_tokens=max_tokens,
+            message_history=message_history,
+            model=model,
+            image_size=image_size,
+        )
+    
+    key = None
+    if cache is not None:
+        messages = build_gpt_messages(system_message, user_message, message_history=message_history)
+        key = cache.key(model, messages, image_paths, max_tokens, image_size)
+        data = cache.get(key)
+        if data is not None:
+            return parse_gpt_response(data, messages)
+    
+    # Only on a cache miss the images are actually prepared for the request payload.
+    payload, messages = build_gpt_payload(
+        system_message=system_message,
+        user_message=user_message,
+        image_paths=image_paths,
+        max_tokens=max_tokens,
+        message_history=message_history,
+        model=model,
+        image_size=image_size,
+    )
+    
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {api_key}'
+    }
+    response = requests.post(url, headers=headers, json=payload)
+    data = response.json()
+    
+    result = parse_gpt_response(data, messages)
+    if cache is not None:
+        cache.set(key, data)
+        
+    return result
+
+
+def build_gpt_payload(system_message: str,
+                      user_message: str,
+                      image_paths: list[str] = [],
+                      max_tokens: int = 500,
+                      message_history: list[dict] = [],
+                      model: str = 'gpt-4-vision-preview',
+                      image_size: t.Optional[int] = IMAGE_MAX_SIZE,
+                      ) -> tuple[dict, list[dict]]:
+    """
+    Creates the JSON payload of a chat completion API request from the given messages. See ``query_gpt`` 
+    for a description of the parameters.
+    
+    :returns: A tuple of the payload dict and the list of messages contained in that payload.
+    """
+    # Additionally to the pure text message, it is also possible to pass multiple image objects as part of the
+    # user message. This is done by encoding the image as a base64 string and then passing it as a data url.
+    # So if additional images have been passed as arguments they are sent as part of the user query.
+    image_urls = [
+        f'data:image/png;base64,{prepare_image(image_path, max_size=image_size)}'
+        for image_path in image_paths
+    ]
+    messages = build_gpt_messages(
+        system_message=system_message,
+        user_message=user_message,
+        image_urls=image_urls,
+        message_history=message_history,
+    )
+    
+    payload = {
+        'model': model,
+        'messages': messages,
+        'max_tokens': max_tokens,
+    }
+    
+    return payload, messages
+
+
+def build_gpt_messages(system_message: str,
+                       user_message: str,
+                       image_urls: list[str] = [],
+                       message_history: list[dict] = [],
+                       ) -> list[dict]:
+    """
+    Creates the list of messages of a chat completion API request, consisting of the ``system_message``, the 
+    ``message_history`` and the ``user_message`` together with the already encoded ``image_urls``.
+    
+    :returns: The list of message dicts
     """
     user_content = [
         {
@@ -166,16 +373,13 @@ def query_gpt(api_key: str,
             'text': user_message,
         }
     ]
-    # Additionally to the pure text message, it is also possible to pass multiple image objects as part of the
-    # user message. This is done by encoding the image as a base64 string and then passing it as a data url.
-    # So if additional images have been passed as arguments they are sent as part of the user query.
-    for image_path in image_paths:
+    for image_url in image_urls:
         user_content.append({
             'type': 'image_url',
-            'image_url': f'data:image/png;base64,{encode_image(image_path)}',
+            'image_url': image_url,
         })
     
-    messages = [
+    return [
         {
             'role': 'system',
             'content': [{'type': 'text', 'text': system_message}]
@@ -186,19 +390,20 @@ def query_gpt(api_key: str,
             'content': user_content,
         }
     ]
+
+
+def parse_gpt_response(data: dict, 
+                       messages: list[dict],
+                       ) -> tuple[str, list[dict]]:
+    """
+    Given the JSON response ``data`` of the chat completion API and the list of ``messages`` that were sent 
+    with the corresponding request, this function extracts the content of the response message. The response 
+    message is appended to the given list of messages.
     
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {api_key}'
-    }
-    payload = {
-        'model': model,
-        'messages': messages,
-        'max_tokens': max_tokens,
-    }
-    response = requests.post('https://api.openai.com/v1/chat/completions', headers=headers, json=payload)
-    data = response.json()
+    :raises RuntimeError: If the response data contains an error.
     
+    :returns: A tuple of the response content string and the list of messages.
+    """
     # The response data would only contain the "error" field in case something went wrong with the query.
     if 'error' in data:
         raise RuntimeError('GPT Query Error:' + str(data['error']))
@@ -213,3 +418,467 @@ def query_gpt(api_key: str,
     content: str = message['message']['content']
     
     return content, messages
+
+
+def estimate_tokens(payload: dict) -> int:
+    """
+    Returns a rough estimate of the number of tokens that a request with the given ``payload`` will consume, 
+    which is the number of text characters divided by 4 plus the maximum number of generated tokens.
+    """
+    num_chars = sum(
+        len(item.get('text', ''))
+        for message in payload['messages']
+        if isinstance(message.get('content'), list)
+        for item in message['content']
+    )
+    return num_chars // 4 + payload.get('max_tokens', 0)
+
+
+def map_future(future: Future, func: t.Callable[[t.Any], t.Any]) -> Future:
+    """
+    Returns a new Future which resolves to the result of applying ``func`` to the result of the given 
+    ``future``. If either the original future or the function raise an exception, the new future 
+    fails with that exception.
+    """
+    mapped = Future()
+    
+    def callback(_future: Future):
+        try:
+            mapped.set_result(func(_future.result()))
+        except Exception as exc:
+            mapped.set_exception(exc)
+            
+    future.add_done_callback(callback)
+    return mapped
+
+
+def resolve_futures(dicts: list[dict],
+                    defaults: dict[str, t.Any],
+                    logger: logging.Logger = NULL_LOGGER,
+                    ) -> list[dict]:
+    """
+    Waits for all the Future values of the given ``keys`` in the given list of ``dicts`` (e.g. the concept 
+    dicts) and replaces them with their results in place. If a future failed, the value is replaced with 
+    the corresponding value from the ``defaults`` dict instead - or removed if that default value is None.
+    
+    :param dicts: A list of dicts whose values may be futures.
+    :param defaults: A dict whose keys are the keys of the values to resolve and whose values are the 
+        fallback values for failed futures.
+    :param logger: An optional logger instance.
+    
+    :returns: The same list of dicts
+    """
+    for data in dicts:
+        for key, default in defaults.items():
+            value = data.get(key, None)
+            if not isinstance(value, Future):
+                continue
+            
+            try:
+                data[key] = value.result()
+            except Exception as exc:
+                logger.info(f' * error "{exc}" while resolving "{key}" - using default')
+                if default is None:
+                    del data[key]
+                else:
+                    data[key] = default
+                    
+    return dicts
+
+
+class GptCache:
+    """
+    A persistent cache for the responses of the GPT chat completion API. Each response is stored as a 
+    separate JSON file in the given ``path`` folder, whose name is the hash of the model name, the messages 
+    (where the images are replaced by the hashes of their file content), the max_tokens and the image size of 
+    the request. The key can therefore be computed before the images are prepared for the request payload.
+    
+    Since the cache is persistent, re-running the same queries - for example when re-running a concept 
+    extraction experiment - returns the responses immediately and does not require network access at all. 
+    The number of cache hits and misses is counted and can be summarized with the ``report`` method.
+    
+    .. code-block:: python
+    
+        cache = GptCache(path='/tmp/gpt_cache')
+        content, messages = query_gpt(api_key, system_message, user_message, cache=cache)
+        print(cache.report())
+    
+    :param path: The absolute string path of the cache folder, which is created if it does not exist yet.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        
+        self.num_hits: int = 0
+        self.num_misses: int = 0
+        # The cache may be used from multiple threads at once when used by a GptQueue.
+        self.lock = threading.Lock()
+        
+    def key(self, 
+            model: str,
+            messages: list[dict], 
+            image_paths: list[str] = [],
+            max_tokens: int = 500,
+            image_size: t.Optional[int] = IMAGE_MAX_SIZE,
+            ) -> str:
+        """
+        Returns the cache key for a request to the given ``model`` with the given ``messages``, the images 
+        with the given ``image_paths`` in the user message, the given ``max_tokens`` and ``image_size``.
+        """
+        image_hashes = [image_hash(image_path) for image_path in image_paths]
+        # The (large) base64 image data urls in the messages are not part of the key itself. The images of the 
+        # user message are identified by the hashes of the image files instead and the images which are part 
+        # of the message history by the hashes of their urls.
+        messages = [
+            {
+                **message,
+                'content': [
+                    {
+                        'type': 'image_url', 
+                        'hash': hashlib.sha256(json.dumps(item['image_url']).encode()).hexdigest(),
+                    } 
+                    if item.get('type') == 'image_url' else item
+                    for item in message['content']
+                ]
+            }
+            if isinstance(message.get('content'), list) else message
+            for message in messages
+        ]
+        return content_hash(model, messages, image_hashes, max_tokens, image_size)
+    
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.json')
+    
+    def get(self, key: str) -> t.Optional[dict]:
+        """
+        Returns the cached response data for the given ``key`` or None if there is no cached response.
+        """
+        path = self.get_path(key)
+        if os.path.exists(path):
+            with open(path) as file:
+                data = json.load(file)
+            with self.lock:
+                self.num_hits += 1
+            return data
+        
+        with self.lock:
+            self.num_misses += 1
+        return None
+    
+    def set(self, key: str, data: dict) -> None:
+        """
+        Stores the given response ``data`` under the given ``key``. Error responses are not stored.
+        """
+        if 'error' in data:
+            return
+        
+        # Writing to a temporary file first makes sure that an interrupted write never leaves a 
+        # corrupted cache file behind.
+        path = self.get_path(key)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(temp_path, path)
+        
+    def report(self) -> str:
+        """
+        Returns a string summary of the number of cache hits and misses.
+        """
+        num_total = self.num_hits + self.num_misses
+        ratio = self.num_hits / num_total if num_total else 0.0
+        return f'GPT cache: {self.num_hits} hits, {self.num_misses} misses ({ratio:.0%} hit ratio)'
+
+
+class RateLimiter:
+    """
+    An asyncio token bucket rate limiter which limits both the number of requests and the number of 
+    (estimated) tokens per minute. The buckets are continuously refilled such that the full capacity 
+    is available again after one minute. A limit of None means that there is no limit.
+    
+    :param requests_per_minute: The maximum number of requests per minute
+    :param tokens_per_minute: The maximum number of tokens per minute
+    """
+    def __init__(self,
+                 requests_per_minute: t.Optional[float] = None,
+                 tokens_per_minute: t.Optional[float] = None,
+                 ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        
+        self.requests_available: float = requests_per_minute or 0
+        self.tokens_available: float = tokens_per_minute or 0
+        self.time_last: float = time.monotonic()
+        
+        # This lock makes sure that the waiting requests acquire their capacity in the order in which 
+        # they arrived.
+        self.lock = asyncio.Lock()
+        
+    def refill(self) -> None:
+        time_now = time.monotonic()
+        elapsed = time_now - self.time_last
+        self.time_last = time_now
+        
+        if self.requests_per_minute:
+            self.requests_available = min(
+                self.requests_per_minute, 
+                self.requests_available + elapsed * self.requests_per_minute / 60
+            )
+        if self.tokens_per_minute:
+            self.tokens_available = min(
+                self.tokens_per_minute, 
+                self.tokens_available + elapsed * self.tokens_per_minute / 60
+            )
+            
+    async def acquire(self, tokens: int = 0) -> None:
+        """
+        Waits until there is the capacity for one more request with the given number of ``tokens``
+        and then consumes that capacity.
+        """
+        async with self.lock:
+            # A single request may never need more than the full capacity, otherwise it would wait forever.
+            if self.tokens_per_minute:
+                tokens = min(tokens, self.tokens_per_minute)
+                
+            while True:
+                self.refill()
+                delay = 0.0
+                if self.requests_per_minute and self.requests_available < 1:
+                    delay = max(delay, (1 - self.requests_available) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute and self.tokens_available < tokens:
+                    delay = max(delay, (tokens - self.tokens_available) * 60 / self.tokens_per_minute)
+                    
+                if delay <= 0:
+                    break
+                
+                await asyncio.sleep(delay)
+                
+            self.requests_available -= 1
+            self.tokens_available -= tokens
+
+
+class GptRetryError(Exception):
+    """
+    Raised for a request which failed with a transient error and which should therefore be retried. 
+    The optional ``retry_after`` is the number of seconds that the server asked to wait.
+    """
+    def __init__(self, message: str, retry_after: t.Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GptQueue:
+    """
+    A queue for concurrent GPT chat completion requests. The requests are submitted from the (synchronous) 
+    calling code with the ``submit`` method, which immediately returns a Future. In the background, the 
+    requests are executed by an asyncio event loop in a separate thread, with at most ``max_concurrency`` 
+    requests running at the same time and subject to the request and token rate limits.
+    
+    Requests that fail with a transient error (connection errors, timeouts, rate limits or server errors) 
+    are retried up to ``max_retries`` times with an exponential backoff.
+    
+    .. code-block:: python
+    
+        with GptQueue(api_key=api_key, max_concurrency=4) as queue:
+            futures = [queue.submit(system_message, message) for message in user_messages]
+            
+        results = [future.result() for future in futures]
+    
+    :param api_key: The OpenAI API key
+    :param url: The URL of the chat completion API endpoint
+    :param max_concurrency: The maximum number of requests that are executed at the same time
+    :param max_retries: The maximum number of times that a failed request is retried
+    :param backoff_base: The delay in seconds before the first retry, which is doubled for every 
+        subsequent retry.
+    :param backoff_max: The maximum delay in seconds between two retries
+    :param requests_per_minute: The optional maximum number of requests per minute
+    :param tokens_per_minute: The optional maximum number of estimated tokens per minute
+    :param timeout: The timeout in seconds for the individual requests
+    :param cache: An optional GptCache. Cached responses are returned immediately without being queued.
+    :param logger: An optional logger instance
+    """
+    def __init__(self,
+                 api_key: str,
+                 url: str = OPENAI_URL,
+                 max_concurrency: int = 4,
+                 max_retries: int = 5,
+                 backoff_base: float = 1.0,
+                 backoff_max: float = 60.0,
+                 requests_per_minute: t.Optional[float] = None,
+                 tokens_per_minute: t.Optional[float] = None,
+                 timeout: float = 120.0,
+                 cache: t.Optional[GptCache] = None,
+                 logger: logging.Logger = NULL_LOGGER,
+                 ):
+        self.api_key = api_key
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.cache = cache
+        self.logger = logger
+        
+        # All the submitted futures, so that it is possible to wait for all of them at the end.
+        self.futures: list[Future] = []
+        self.num_retries: int = 0
+        
+        # The blocking HTTP requests themselves are executed in this thread pool, while the event loop only 
+        # takes care of the scheduling, the rate limiting and the retries.
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_loop, daemon=True)
+        self.thread.start()
+        
+        # The asyncio primitives have to be created within the event loop that will use them.
+        self.semaphore: t.Optional[asyncio.Semaphore] = None
+        self.rate_limiter: t.Optional[RateLimiter] = None
+        asyncio.run_coroutine_threadsafe(
+            self.setup(requests_per_minute, tokens_per_minute), 
+            self.loop
+        ).result()
+        
+    def run_loop(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        
+    async def setup(self, 
+                    requests_per_minute: t.Optional[float],
+                    tokens_per_minute: t.Optional[float],
+                    ) -> None:
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+        )
+        
+    def submit(self,
+               system_message: str,
+               user_message: str,
+               image_paths: list[str] = [],
+               max_tokens: int = 500,
+               message_history: list[dict] = [],
+               model: str = 'gpt-4-vision-preview',
+               image_size: t.Optional[int] = IMAGE_MAX_SIZE,
+               ) -> Future:
+        """
+        Submits a new chat completion request to the queue. See ``query_gpt`` for a description of 
+        the parameters.
+        
+        :returns: A Future which resolves to the tuple of the response content and the list of messages.
+        """
+        key = None
+        if self.cache is not None:
+            messages = build_gpt_messages(system_message, user_message, message_history=message_history)
+            key = self.cache.key(model, messages, image_paths, max_tokens, image_size)
+            data = self.cache.get(key)
+            if data is not None:
+                future = Future()
+                future.set_result(parse_gpt_response(data, messages))
+                return future
+        
+        # Only on a cache miss the images are actually prepared for the request payload.
+        payload, messages = build_gpt_payload(
+            system_message=system_message,
+            user_message=user_message,
+            image_paths=image_paths,
+            max_tokens=max_tokens,
+            message_history=message_history,
+            model=model,
+            image_size=image_size,
+        )
+        
+        future = asyncio.run_coroutine_threadsafe(self.query(payload, messages, key), self.loop)
+        self.futures.append(future)
+        
+        return future
+        
+    async def query(self, 
+                    payload: dict, 
+                    messages: list[dict], 
+                    key: t.Optional[str] = None,
+                    ) -> tuple[str, list[dict]]:
+        tokens = estimate_tokens(payload)
+        async with self.semaphore:
+            
+            attempt = 0
+            while True:
+                await self.rate_limiter.acquire(tokens)
+                try:
+                    data = await self.loop.run_in_executor(self.executor, self.post, payload)
+                    result = parse_gpt_response(data, messages)
+                    if self.cache is not None:
+                        self.cache.set(key, data)
+                        
+                    return result
+                
+                except (GptRetryError, requests.ConnectionError, requests.Timeout) as exc:
+                    if attempt >= self.max_retries:
+                        raise
+                    
+                    # Exponential backoff with a random jitter, such that the concurrent requests which failed 
+                    # at the same time do not all retry at the same time as well.
+                    delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                    delay *= 0.5 + random.random() / 2
+                    if isinstance(exc, GptRetryError) and exc.retry_after is not None:
+                        delay = max(delay, exc.retry_after)
+                    
+                    self.logger.info(f' * GPT request failed with "{exc}" - retrying in {delay:.1f}s...')
+                    self.num_retries += 1
+                    attempt += 1
+                    await asyncio.sleep(delay)
+                    
+    def post(self, payload: dict) -> dict:
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.api_key}'
+        }
+        response = requests.post(self.url, headers=headers, json=payload, timeout=self.timeout)
+        if response.status_code in RETRY_STATUS_CODES:
+            # The Retry-After header may also be an HTTP date, in which case it is simply ignored.
+            raise GptRetryError(
+                f'status code {response.status_code}',
+                retry_after=safe_int(response.headers.get('Retry-After', '')),
+            )
+        
+        return response.json()
+    
+    def join(self) -> list[Future]:
+        """
+        Blocks until all the submitted requests are done (successfully or not).
+        
+        :returns: The list of all the submitted futures
+        """
+        wait_futures(self.futures)
+        return self.futures
+    
+    def close(self) -> None:
+        """
+        Stops the background event loop. Requests that are still pending at this point are cancelled, such 
+        that the result of their futures raises a ``CancelledError`` instead of blocking forever.
+        """
+        if self.loop.is_closed():
+            return
+        
+        asyncio.run_coroutine_threadsafe(self.cancel(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=False)
+    
+    async def cancel(self) -> None:
+        # Cancelling the tasks of the pending requests also cancels the futures that were returned by "submit".
+        # Requests which are already being posted in the thread pool cannot be interrupted, but their results 
+        # are discarded.
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.join()
+        self.close()
@@ -19,10 +19,67 @@ from megan_global_explanations.utils import NULL_LOGGER
 from megan_global_explanations.utils import extend_graph_info
 from megan_global_explanations.utils import TEMPLATE_ENV
 from megan_global_explanations.utils import DEFAULT_CHANNEL_INFOS
+from megan_global_explanations.utils import sort_concepts_by_similarity
 from megan_global_explanations.prototype.optimize import genetic_optimize
 from megan_global_explanations.prototype.optimize import embedding_distances_fitness_mse
 from megan_global_explanations.gpt import query_gpt
+from megan_global_explanations.gpt import map_future
+from megan_global_explanations.gpt import resolve_futures
+from megan_global_explanations.gpt import GptQueue
+from megan_global_explanations.gpt import GptCache
 
+def annotate_graphs(model: Megan,
+                    graphs: t.List[tv.GraphDict],
+                    dataset_type: t.Literal['regression', 'classification'] = 'regression',
+                    ) -> t.List[tv.GraphDict]:
+    """
+    Runs the given ``model`` forward pass for the given list of ``graphs`` and attaches all the resulting 
+    information as additional attributes to the graph dicts themselves. This includes the prediction 
+    ("graph_output", "graph_prediction"), the leave-one-out deviations and the channel fidelities 
+    ("graph_deviation", "graph_fidelity"), the embeddings ("graph_embeddings") and the normalized 
+    explanation masks ("node_importances", "edge_importances").
+    
+    :param model: The MEGAN model to be used for the forward pass
+    :param graphs: A list of graph dicts which will be modified in place
+    :param dataset_type: Either "regression" or "classification", which determines how the prediction 
+        and the fidelity values are derived from the model outputs.
+    
+    :returns: The same list of graph dicts
+    """
+    if len(graphs) == 0:
+        return graphs
+    
+    infos = model.forward_graphs(graphs)
+    devs = model.leave_one_out_deviations(graphs)
+    
+    # We are attaching all this additional information that we obtain from the dataset here as additional 
+    # attributes of the graphs dict objects themselves so that later on all the necessary information can 
+    # be accessed from those.
+    for graph, info, dev in zip(graphs, infos, devs):
+        
+        graph['graph_output'] = info['graph_output']
+        # besides the raw output vector for the prediction, we also want to store the actual prediction 
+        # outcome. This differs based on what kind of task we are dealing with here. 
+        if dataset_type == 'regression':
+            graph['graph_prediction'] = info['graph_output'][0]
+        elif dataset_type == 'classification':
+            graph['graph_prediction'] = np.argmax(info['graph_output'])
+        
+        # correspondingly, the calculation of the fidelity is also different for regression and classification
+        graph['graph_deviation'] = dev
+        if dataset_type == 'regression':
+            graph['graph_fidelity'] = np.array([-dev[0, 0], +dev[0, 1]])
+        elif dataset_type == 'classification':
+            matrix = np.array(dev)
+            graph['graph_fidelity'] = np.diag(matrix)
+        
+        # Also we want to store all the information about the explanations channels, which includes the 
+        # explanations masks themselves, but also the embedding vectors  
+        graph['graph_embeddings'] = info['graph_embedding']
+        graph['node_importances'] = array_normalize(info['node_importance'])
+        graph['edge_importances'] = array_normalize(info['edge_importance'])
+        
+    return graphs
 
 
 def extract_concepts(model: Megan,
@@ -36,6 +93,7 @@ def extract_concepts(model: Megan,
                      cluster_selection_method: str = 'leaf',
                      channel_infos: t.Dict[int, dict] = DEFAULT_CHANNEL_INFOS,
                      sort_similarity: bool = True,
+                     sort_method: str = 'greedy',
                      logger: logging.Logger = NULL_LOGGER,
                      ) -> t.Dict[int, dict]:
     """
@@ -84,6 +142,9 @@ def extract_concepts(model: Megan,
         the channel. If no information is given for a channel, the default values are used.
     :sort_similarity: A boolean flag that determines whether the concepts should be sorted by similarity. If this
         flag is set to True, the concepts will be sorted such that the most similar concepts are next to each other.
+    :param sort_method: The string identifier of the ordering method that is used for the similarity sorting. 
+        Options are "greedy" (nearest neighbor walk), "two_opt" (greedy walk refined by the 2-opt heuristic) 
+        and "leaf" (optimal leaf ordering of a hierarchical clustering). See ``utils.order_centroids``.
     :param logger: A logger object that is used to log the progress of the concept extraction process.
     
     
@@ -101,35 +162,11 @@ def extract_concepts(model: Megan,
     graphs = [index_data_map[index]['metadata']['graph'] for index in indices]
     
     logger.info(f'running model forward pass for the dataset with {len(graphs)} elements...')
-    infos = model.forward_graphs(graphs)
-    devs = model.leave_one_out_deviations(graphs)
-    
-    # We are attaching all this additional information that we obtain from the dataset here as additional 
-    # attributes of the graphs dict objects themselves so that later on all the necessary information can 
-    # be accessed from those.
-    for index, graph, info, dev in zip(indices, graphs, infos, devs):
-        
-        graph['graph_output'] = info['graph_output']
-        # besides the raw output vector for the prediction, we also want to store the actual prediction 
-        # outcome. This differs based on what kind of task we are dealing with here. 
-        if dataset_type == 'regression':
-            graph['graph_prediction'] = info['graph_output'][0]
-        elif dataset_type == 'classification':
-            graph['graph_prediction'] = np.argmax(info['graph_output'])
-        
-        # correspondingly, the calculation of the fidelity is also different for regression and classification
-        graph['graph_deviation'] = dev
-        if dataset_type == 'regression':
-            graph['graph_fidelity'] = np.array([-dev[0, 0], +dev[0, 1]])
-        elif dataset_type == 'classification':
-            matrix = np.array(dev)
-            graph['graph_fidelity'] = np.diag(matrix)
-        
-        # Also we want to store all the information about the explanations channels, which includes the 
-        # explanations masks themselves, but also the embedding vectors  
-        graph['graph_embeddings'] = info['graph_embedding']
-        graph['node_importances'] = array_normalize(info['node_importance'])
-        graph['edge_importances'] = array_normalize(info['edge_importance'])
+    annotate_graphs(
+        model=model,
+        graphs=graphs,
+        dataset_type=dataset_type,
+    )
 
     # ~ concept clustering
     
@@ -205,37 +242,204 @@ def extract_concepts(model: Megan,
             
     if sort_similarity:
         
-        logger.info('sorting the concepts by similarity...')
-        concepts_sorted = []
-        concept_index = 0
-        for channel_index in range(num_channels):
+        # Within each channel the concepts are re-ordered such that concepts with similar centroids appear 
+        # next to each other. The distance matrix between the centroids is only computed once per channel.
+        logger.info(f'sorting the concepts by similarity with the "{sort_method}" method...')
+        concepts = sort_concepts_by_similarity(
+            concepts=concepts,
+            num_channels=num_channels,
+            metric=cluster_metric,
+            method=sort_method,
+        )
+            
+    return concepts
+            
             
-            concepts_channel = [concept for concept in concepts if concept['channel_index'] == channel_index]
+def update_concepts(concepts: t.List[dict],
+                    index_data_map: t.Dict[int, dict],
+                    indices: t.List[int],
+                    num_channels: int,
+                    dataset_type: t.Literal['regression', 'classification'] = 'regression',
+                    fidelity_threshold: float = 0.0,
+                    min_samples: int = 0,
+                    min_cluster_size: int = 0,
+                    cluster_metric: str = 'manhattan',
+                    cluster_selection_method: str = 'leaf',
+                    radius_quantile: float = 0.95,
+                    drift_threshold: float = 0.1,
+                    embedding_key: str = 'graph_embeddings',
+                    channel_infos: t.Dict[int, dict] = DEFAULT_CHANNEL_INFOS,
+                    logger: logging.Logger = NULL_LOGGER,
+                    ) -> t.Tuple[t.List[dict], t.List[int]]:
+    """
+    Incrementally updates an existing list of ``concepts`` with the new dataset elements identified by the 
+    given ``indices`` instead of re-running the whole concept extraction. The graphs of these new elements 
+    in the ``index_data_map`` need to already be annotated with the model outputs (see ``annotate_graphs``), 
+    only the existing concepts' "centroid" and "embeddings" are required.
+    
+    **HOW IT WORKS**
+    
+    For each channel, the new embeddings which pass the fidelity threshold are assigned to the closest 
+    existing concept centroid, but only if they are within the radius of that concept. The radius of a 
+    concept is the ``radius_quantile`` of the distances of its current members to its centroid. All the 
+    new elements that could not be assigned to any of the existing concepts (the residue) are then 
+    clustered with HDBSCAN to find entirely new concepts, which are appended to the end of the list.
+    
+    The centroids of the concepts that received new members are updated. If the centroid moved more than 
+    ``drift_threshold`` times the concept radius, the concept is considered to have drifted and its 
+    prototype should be re-optimized.
+    
+    :param concepts: The list of existing concept dicts, as for example loaded by the ``ConceptReader``. 
+        The concepts will be modified in place.
+    :param index_data_map: The index data map of the dataset, which has to contain the new elements.
+    :param indices: The dataset indices of the new elements.
+    :param num_channels: The number of explanation channels of the model.
+    :param dataset_type: Either "regression" or "classification"
+    :param fidelity_threshold: The minimal fidelity of a new element for it to be considered at all.
+    :param min_samples: The HDBSCAN min_samples parameter for the clustering of the residue.
+    :param min_cluster_size: The HDBSCAN min_cluster_size parameter for the clustering of the residue.
+    :param cluster_metric: The distance metric used for the assignment and for the clustering.
+    :param cluster_selection_method: The HDBSCAN cluster selection method for the clustering of the residue.
+    :param radius_quantile: The quantile of the member distances that defines the radius of a concept.
+    :param drift_threshold: The relative centroid shift (in units of the concept radius) above which a 
+        concept is considered to have drifted.
+    :param embedding_key: The key of the graph dict attribute that contains the (D, K) embeddings.
+    :param channel_infos: A dictionary that contains information about the channels of the model.
+    :param logger: A logger object that is used to log the progress.
+    
+    :returns: A tuple (concepts, update_indices) where the first element is the updated list of concepts 
+        and the second element is a list with the "index" values of all the concepts whose prototypes need 
+        to be (re-)generated, which are the drifted concepts and the newly discovered ones.
+    """
+    indices = np.array(indices)
+    graphs = [index_data_map[index]['metadata']['graph'] for index in indices]
+    
+    update_indices: t.List[int] = []
+    next_index = max([concept['index'] for concept in concepts], default=-1) + 1
+    new_concepts: t.List[dict] = []
+    
+    for channel_index in range(num_channels):
+        
+        logger.info(f'for channel {channel_index}')
+        mask_channel = np.array([graph['graph_fidelity'][channel_index] > fidelity_threshold for graph in graphs], dtype=bool)
+        indices_channel = indices[mask_channel]
+        if len(indices_channel) == 0:
+            continue
+        
+        # embeddings_channel: (N, D)
+        embeddings_channel = np.array([graphs[i][embedding_key][:, channel_index] for i in np.where(mask_channel)[0]])
+        
+        # ~ assignment to the existing concepts
+        # assigned: (N, ) - the position in concepts_channel of the concept that an element was assigned to or -1
+        concepts_channel = [concept for concept in concepts if concept['channel_index'] == channel_index]
+        assigned = np.full(shape=(len(indices_channel), ), fill_value=-1, dtype=int)
+        if len(concepts_channel) != 0:
             
-            # We will just randomly start with the first cluster and then iteratively traverse the list of 
-            # the clusters by always selecting the next cluster according to which one is the closest to the 
-            # the current one - out of the remaining clusters.
-            concept = concepts_channel.pop(0)
+            # centroids: (C, D)
+            centroids = np.array([concept['centroid'] for concept in concepts_channel])
+            radii = np.array([
+                np.quantile(pairwise_distances(np.array(concept['embeddings']), centroid[None, :], metric=cluster_metric), radius_quantile)
+                for concept, centroid in zip(concepts_channel, centroids)
+            ])
             
-            while len(concepts_channel) != 0:
+            # distances: (N, C)
+            distances = pairwise_distances(embeddings_channel, centroids, metric=cluster_metric)
+            closest = np.argmin(distances, axis=1)
+            within = distances[np.arange(len(closest)), closest] <= radii[closest]
+            assigned[within] = closest[within]
+        
+            for c, concept in enumerate(concepts_channel):
+                mask_concept = (assigned == c)
+                num_new = int(np.sum(mask_concept))
+                if num_new == 0:
+                    continue
+                
+                indices_concept = indices_channel[mask_concept]
+                embeddings_concept = np.array(concept['embeddings'])
+                num_old = len(embeddings_concept)
                 
-                centroid = concept['centroid']
-                centroid_distances = pairwise_distances(
-                    np.expand_dims(centroid, axis=0),
-                    [c['centroid'] for c in concepts_channel],
-                    metric=cluster_metric,
-                )
+                concept['embeddings'] = np.concatenate([embeddings_concept, embeddings_channel[mask_concept]], axis=0)
+                concept['index_tuples'] = list(concept['index_tuples']) + [(index, channel_index) for index in indices_concept]
+                concept['elements'] = list(concept['elements']) + [index_data_map[index] for index in indices_concept]
+                if 'graphs' in concept:
+                    concept['graphs'] = list(concept['graphs']) + [index_data_map[index]['metadata']['graph'] for index in indices_concept]
                 
-                index = np.argmin(centroid_distances[0])
-                concept = concepts_channel.pop(index)
-                concept['index'] = concept_index
-                concept_index += 1
+                # The contribution of the concept is the average over all the members, which we can update 
+                # from the previous average without needing the deviations of the previous members.
+                if 'contribution' in concept:
+                    contributions = [_graph_contribution(index_data_map[index]['metadata']['graph'], channel_index, dataset_type) 
+                                     for index in indices_concept]
+                    concept['contribution'] = (concept['contribution'] * num_old + np.sum(contributions)) / (num_old + num_new)
                 
-                concepts_sorted.append(concept)
+                centroid_old = centroids[c]
+                centroid_new = np.mean(concept['embeddings'], axis=0)
+                concept['centroid'] = centroid_new
                 
-        concepts = concepts_sorted
+                drift = pairwise_distances(centroid_old[None, :], centroid_new[None, :], metric=cluster_metric)[0, 0]
+                drift = drift / max(radii[c], 1e-12)
+                logger.info(f' * concept {concept["index"]} - {num_new} new elements - drift: {drift:.3f}')
+                if drift > drift_threshold:
+                    update_indices.append(concept['index'])
+        
+        # ~ clustering the residue
+        # All the elements that could not be assigned to any of the existing concepts may form new concepts 
+        # of their own. The clustering is only done on this residue and not the entire dataset.
+        mask_residue = (assigned < 0)
+        num_residue = int(np.sum(mask_residue))
+        logger.info(f' * assigned {len(assigned) - num_residue} elements, {num_residue} residue elements')
+        if num_residue < max(min_cluster_size, 2):
+            continue
+        
+        indices_residue = indices_channel[mask_residue]
+        embeddings_residue = embeddings_channel[mask_residue]
+        clusterer = hdbscan.HDBSCAN(
+            min_samples=min_samples,
+            min_cluster_size=min_cluster_size,
+            metric=cluster_metric,
+            cluster_selection_method=cluster_selection_method,
+        )
+        labels = clusterer.fit_predict(embeddings_residue)
+        clusters = [label for label in set(labels) if label >= 0]
+        logger.info(f' * found {len(clusters)} new clusters in the residue')
+        
+        for cluster_label in clusters:
+            mask_cluster = (labels == cluster_label)
+            indices_cluster = indices_residue[mask_cluster]
+            embeddings_cluster = embeddings_residue[mask_cluster]
+            elements_cluster = [index_data_map[index] for index in indices_cluster]
+            graphs_cluster = [data['metadata']['graph'] for data in elements_cluster]
             
-    return concepts
+            concept: dict = {
+                'index': next_index,
+                'channel_index': channel_index,
+                'index_tuples': [(index, channel_index) for index in indices_cluster],
+                'embeddings': embeddings_cluster,
+                'centroid': np.mean(embeddings_cluster, axis=0),
+                'contribution': np.mean([_graph_contribution(graph, channel_index, dataset_type) for graph in graphs_cluster]),
+                'elements': elements_cluster,
+                'graphs': graphs_cluster,
+                'name': channel_infos[channel_index]['name'],
+                'color': channel_infos[channel_index]['color'],
+            }
+            new_concepts.append(concept)
+            update_indices.append(next_index)
+            next_index += 1
+    
+    return concepts + new_concepts, update_indices
+
+
+def _graph_contribution(graph: tv.GraphDict,
+                        channel_index: int,
+                        dataset_type: str,
+                        ) -> float:
+    """
+    Returns the contribution of the given explanation channel ``channel_index`` to the prediction of the 
+    given (annotated) ``graph``, which is the channel's leave-one-out deviation.
+    """
+    if dataset_type == 'regression':
+        return graph['graph_deviation'][0, channel_index]
+    elif dataset_type == 'classification':
+        return graph['graph_deviation'][channel_index, channel_index]
             
             
 # Given the already clustered concepts, the model and the dataset, this function generates the prototypes for 
@@ -431,10 +635,16 @@ def generate_concept_hypotheses(concepts: list[dict],
                                 system_template: str = 'system_message_chemistry.j2',
                                 user_template: str = 'user_message_chemistry.j2',
                                 logger: logging.Logger = NULL_LOGGER,
+                                queue: t.Optional[GptQueue] = None,
+                                cache: t.Optional[GptCache] = None,
                                 ):
     """
     This function will 
     
+    If a GptQueue ``queue`` is given, the requests for all the concepts are first submitted to that queue 
+    and their results are only awaited at the very end, which allows the requests to be processed 
+    concurrently. If a GptCache ``cache`` is given, the responses for previously sent requests are taken 
+    from that cache (a queue uses its own cache instead).
     """
     
     system_temp = TEMPLATE_ENV.get_template(system_template)
@@ -470,11 +680,24 @@ def generate_concept_hypotheses(concepts: list[dict],
             'contribution': contribution,   
         })
 
+        # With a queue, the request is only submitted here and the hypothesis is the future of the result 
+        # for now, which will be resolved after all the requests have been submitted.
+        if queue is not None:
+            future = query_gpt(
+                api_key=openai_key,
+                system_message=system_message,
+                user_message=user_message,
+                queue=queue,
+            )
+            concept['hypothesis'] = map_future(future, lambda result: result[0])
+            continue
+
         try:
             hypothesis, messages = query_gpt(
                 api_key=openai_key,
                 system_message=system_message,
                 user_message=user_message,
+                cache=cache,
             )
         except Exception as exc:
             logger.info(f'   error during hypothesis generation: {exc}')
@@ -488,5 +711,9 @@ def generate_concept_hypotheses(concepts: list[dict],
         logger.info(f'   obtained a hypothesis with {len(hypothesis)} characters')
         concept['hypothesis'] = hypothesis
 
+    if queue is not None:
+        logger.info(f' * waiting for the hypotheses of the queued requests...')
+        resolve_futures(concepts, defaults={'hypothesis': None}, logger=logger)
+
 
     return concepts
\ No newline at end of file
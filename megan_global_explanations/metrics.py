@@ -0,0 +1,161 @@
+"""
+This module implements the quality metrics for the concept clusterings. All the metrics are computed from the
+columnar representation of a concept clustering, which is a single (N, D) array of all the member embeddings
+together with an (N, ) array of the corresponding cluster labels. Based on that, the metrics only require the
+cluster centroids and the distances of the members to those centroids - with the exception of the silhouette
+score, which requires all pairwise distances and is therefore computed on a random subsample for large N.
+"""
+import typing as t
+
+import numpy as np
+from sklearn.metrics import pairwise_distances
+from sklearn.metrics.pairwise import paired_distances
+from sklearn.metrics import silhouette_score
+
+import megan_global_explanations.typing as tg
+
+
+def concepts_to_columns(concepts: tg.ConceptData,
+                        ) -> t.Tuple[np.ndarray, np.ndarray]:
+    """
+    Given a list of ``concepts``, this function returns the columnar representation of the member
+    embeddings of those concepts as the tuple (embeddings, labels). The embeddings are one array of
+    shape (N, D) with the embeddings of the members of all the concepts and the labels are an array
+    of shape (N, ) which contains the position of the corresponding concept within the given list.
+
+    :param concepts: A list of concept dicts which each have to contain the "embeddings" of the members
+
+    :returns: A tuple (embeddings, labels)
+    """
+    embeddings_list = [np.asarray(concept['embeddings']) for concept in concepts]
+    embeddings = np.concatenate(embeddings_list, axis=0)
+    labels = np.repeat(np.arange(len(concepts)), [len(e) for e in embeddings_list])
+
+    return embeddings, labels
+
+
+def cluster_centroids(embeddings: np.ndarray,
+                      labels: np.ndarray,
+                      ) -> np.ndarray:
+    """
+    Computes the centroids of all the clusters given by the (N, D) ``embeddings`` and the (N, ) ``labels``,
+    where the labels have to be the integers 0 to K-1.
+
+    :returns: An array of shape (K, D) with the centroids of the clusters
+    """
+    num_clusters = np.max(labels) + 1
+    sums = np.zeros(shape=(num_clusters, embeddings.shape[1]))
+    np.add.at(sums, labels, embeddings)
+    counts = np.bincount(labels, minlength=num_clusters)
+
+    return sums / counts[:, None]
+
+
+def intra_centroid_distances(embeddings: np.ndarray,
+                             labels: np.ndarray,
+                             centroids: np.ndarray,
+                             metric: str = 'euclidean',
+                             ) -> np.ndarray:
+    """
+    Computes the average distance of the members of each cluster to the centroid of that cluster.
+
+    :param embeddings: The (N, D) array of the member embeddings
+    :param labels: The (N, ) array of the integer cluster labels
+    :param centroids: The (K, D) array of the cluster centroids
+    :param metric: The distance metric, which has to be supported by sklearn's paired_distances
+
+    :returns: An array of shape (K, ) with the average member distances for each cluster
+    """
+    num_clusters = len(centroids)
+    # distances: (N, ) - the distance of each element to its own centroid only
+    distances = paired_distances(embeddings, centroids[labels], metric=metric)
+    sums = np.bincount(labels, weights=distances, minlength=num_clusters)
+    counts = np.bincount(labels, minlength=num_clusters)
+
+    return sums / counts
+
+
+def inter_centroid_distances(centroids: np.ndarray,
+                             metric: str = 'euclidean',
+                             ) -> np.ndarray:
+    """
+    Computes the pairwise distances between all the cluster ``centroids``.
+
+    :returns: An array of shape (K, K) with the centroid distances
+    """
+    return pairwise_distances(centroids, metric=metric)
+
+
+def davies_bouldin_index(intra_distances: np.ndarray,
+                         inter_distances: np.ndarray,
+                         ) -> float:
+    """
+    Computes the Davies-Bouldin index from the already computed average ``intra_distances`` of the
+    clusters and the ``inter_distances`` between the cluster centroids. Lower values indicate a
+    better separation of the clusters.
+
+    :returns: The float index value
+    """
+    # Just like in the reference implementation, coinciding centroids (including the diagonal) are not 
+    # considered for the maximum by treating their distance as infinite.
+    inter_distances = np.where(inter_distances == 0, np.inf, inter_distances)
+    ratios = (intra_distances[:, None] + intra_distances[None, :]) / inter_distances
+
+    return float(np.mean(np.max(ratios, axis=1)))
+
+
+def clustering_metrics(embeddings: np.ndarray,
+                       labels: np.ndarray,
+                       metric: str = 'euclidean',
+                       silhouette_sample_size: t.Optional[int] = 10_000,
+                       random_state: t.Optional[int] = None,
+                       ) -> dict:
+    """
+    Computes the quality metrics of the clustering given by the (N, D) ``embeddings`` and the (N, )
+    integer ``labels``, which have to be the integers 0 to K-1 for K >= 2 clusters.
+
+    The returned dict contains the following items:
+    - silhouette: The silhouette score. For more than ``silhouette_sample_size`` elements, this is only
+      computed on a random subsample of that size since it requires all pairwise distances.
+    - dbi: The Davies-Bouldin index
+    - intra_distances: A list with the average member distance to the centroid for each cluster
+    - nearest_distances: A list with the distance to the closest other centroid for each cluster
+    - inter_distance_mean: The average distance between all the pairs of centroids
+
+    :param embeddings: The (N, D) array of the member embeddings
+    :param labels: The (N, ) array of the integer cluster labels
+    :param metric: The distance metric to be used for all the metrics
+    :param silhouette_sample_size: The maximum number of elements to compute the silhouette score on.
+        If this is None, the silhouette is always computed on all the elements.
+    :param random_state: An optional seed for the silhouette subsample
+
+    :returns: A dict with the metric values
+    """
+    labels = np.asarray(labels)
+    num_elements = len(labels)
+
+    centroids = cluster_centroids(embeddings, labels)
+    intra_distances = intra_centroid_distances(embeddings, labels, centroids, metric=metric)
+    inter_distances = inter_centroid_distances(centroids, metric=metric)
+
+    sample_size = None
+    if silhouette_sample_size is not None and num_elements > silhouette_sample_size:
+        sample_size = silhouette_sample_size
+
+    silhouette = silhouette_score(
+        embeddings, labels,
+        metric=metric,
+        sample_size=sample_size,
+        random_state=random_state,
+    )
+
+    num_clusters = len(centroids)
+    inter_distances_masked = inter_distances + np.diag(np.full(num_clusters, np.inf))
+
+    return {
+        'silhouette': float(silhouette),
+        'dbi': davies_bouldin_index(intra_distances, inter_distances),
+        'intra_distances': intra_distances.tolist(),
+        'nearest_distances': np.min(inter_distances_masked, axis=1).tolist(),
+        'inter_distance_mean': float(np.sum(inter_distances) / (num_clusters * (num_clusters - 1))),
+    }
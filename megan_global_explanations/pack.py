@@ -1,5 +1,4 @@
 import os
-import random
 import logging
 import typing as t
 
@@ -7,8 +6,6 @@ import hdbscan
 import numpy as np
 import tensorflow as tf
 import tensorflow.keras as ks
-from scipy.special import softmax
-from scipy.spatial.distance import euclidean
 from hdbscan import HDBSCAN
 from kgcnn.layers.modules import DenseEmbedding
 from graph_attention_student.training import EpochCounterCallback
@@ -35,6 +32,41 @@ def gather_arrays(inp: t.Union[tf.Tensor, np.ndarray, t.List[tf.Tensor]],
         return tf.gather(inp, indices)
 
 
+def to_tensors(inp: t.Union[tf.Tensor, np.ndarray, t.List[tf.Tensor]]):
+    """
+    Converts the given ``inp``, which may be a (nested) list of arrays and (ragged) tensors, into a nested tuple 
+    of tensors, which can be used as the captured value of a ``tf.data`` pipeline. Lists are converted into tuples 
+    because tf.data would otherwise try to stack them into a single tensor.
+    """
+    if isinstance(inp, (list, tuple)):
+        return tuple(to_tensors(v) for v in inp)
+    elif isinstance(inp, np.ndarray):
+        return tf.constant(inp)
+    else:
+        return inp
+
+
+def weighted_cluster_centers(embeddings: np.ndarray,
+                             labels: np.ndarray,
+                             strengths: np.ndarray,
+                             ) -> np.ndarray:
+    """
+    Computes the centers of all the clusters given by the (N, D) ``embeddings`` and the (N, ) ``labels`` as the 
+    average of the cluster members weighted by their membership ``strengths``. This is the same as HDBSCAN's 
+    "weighted_cluster_centroid" but for all the clusters at once. Noise elements (label -1) are excluded.
+    
+    :returns: The (C, D) matrix of the cluster centers
+    """
+    num_clusters = int(np.max(labels, initial=-1)) + 1
+    is_member = labels >= 0
+    strengths = strengths[is_member]
+    sums = np.zeros(shape=(num_clusters, embeddings.shape[1]))
+    np.add.at(sums, labels[is_member], embeddings[is_member] * strengths[:, None])
+    weights = np.bincount(labels[is_member], weights=strengths, minlength=num_clusters)
+    
+    return sums / weights[:, None]
+
+
 class ClusterPackingMixin:
 
     def __init__(self):
@@ -69,6 +101,8 @@ class ClusterPackingTrainer:
                  model: ClusterPackingMixin,
                  num_channels: int = 1,
                  cluster_batch_size: int = 2048,
+                 cluster_epoch_step: int = 10,
+                 label_batch_size: int = 2048,
                  min_samples: float = 10,
                  epochs_warmup: int = 50,
                  factor: float = 0.1,
@@ -79,6 +113,8 @@ class ClusterPackingTrainer:
         self.num_channels = num_channels
         self.set_model(model)
         self.cluster_batch_size = cluster_batch_size
+        self.cluster_epoch_step = cluster_epoch_step
+        self.label_batch_size = label_batch_size
         self.min_samples = min_samples
         self.epochs_warmup = epochs_warmup
         self.factor = factor
@@ -87,6 +123,23 @@ class ClusterPackingTrainer:
         
         self.clusterer = None
         self.compile_kwargs = {}
+        # The most recent cluster centers and the epoch at which the clustering was created. As long as the model 
+        # has not been trained any further, the clustering can be re-used instead of being created again.
+        self.cluster_centers: t.Optional[np.ndarray] = None
+        self.cluster_epoch: t.Optional[int] = None
+        
+        # The cluster targets of the training data. The labels are the (N, K) cluster indices of the embeddings of 
+        # all the N samples and K channels (-1 for no cluster) and the centers are the (C, D) cluster centers. Both 
+        # are variables because they are read by the tf.data pipeline, which means that they can be updated during 
+        # the training without having to re-create the dataset or to restart the model training.
+        self.x: t.Any = None
+        self.num_samples: int = 0
+        self.labels: t.Optional[np.ndarray] = None
+        self.label_offset: int = 0
+        # The indices of the samples from which the most recent clustering was created
+        self.cluster_indices: t.Optional[np.ndarray] = None
+        self.var_labels: t.Optional[tf.Variable] = None
+        self.var_centers: t.Optional[tf.Variable] = None
         
         # These are parameters of the "fit" method and will only be set to the true values when that method is actually called.
         self.batch_size: int = 0
@@ -174,14 +227,9 @@ class ClusterPackingTrainer:
         
         return loss
         
-    def on_epoch_end(self, *args, **kwargs):
-        # At the beggining of the epoch we want to perform the clustering which will then be 
-        # used as the reference for the compression for that entire epoch.
-        if self.callback.epoch >= self.epochs_warmup and not self.is_warm:
-            self.var_factor.assign(self.factor)
-            
-            self.model.stop_training = True
-            self.is_warm = True
+    def on_epoch_end(self, epoch: int, logs: t.Optional[dict] = None):
+        # The epoch of the callback is the number of completed epochs
+        self.callback.epoch = epoch + 1
         
         # If the warmup epoch is not yet reached we make sure that the packing loss is not active by 
         # setting the loss factor to a very low value.
@@ -189,12 +237,20 @@ class ClusterPackingTrainer:
             # I think we cant assign flat out zero here because then the static graph will just not build
             # that branch at all so instead we set it to a very low value which is the same as zero in practice
             self.var_factor.assign(1e-200)
+            return
+        
+        # Once the warmup is done, the packing loss is activated and from then on the clustering is re-created 
+        # every "cluster_epoch_step" epochs, which takes effect for the following batches of the same training 
+        # run. In between, the labels of the next chunk of the dataset are updated.
+        if not self.is_warm:
+            self.log(f'warmup finished at epoch {self.epoch}. activating the packing loss...')
+            self.var_factor.assign(self.factor)
+            self.is_warm = True
             
-        # Then if the total number of epochs has been reached we obv. need to stop the training process of the 
-        # model for good.
-        if self.epoch > self.epochs:
-            self.log(f'max. number of epochs ({self.epochs}) reached. stopping model training...')
-            self.model.stop_training = True
+        if (self.epoch - self.epochs_warmup) % self.cluster_epoch_step == 0:
+            self.update_clusters()
+        else:
+            self.update_labels()
     
     def create_clusters(self, inputs) -> np.ndarray:
         embeddings = self.model.embedd(inputs).numpy()
@@ -207,118 +263,166 @@ class ClusterPackingTrainer:
             prediction_data=True,
         )
         self.clusterer.fit(embeddings)
-        labels = self.clusterer.labels_
         
-        # Now we need to get the center point for each of those clusters
-        clusters = list(set(labels))
-        centers = []
-        for label in clusters:
-            
-            if label < 0:
-                continue
-            
-            cluster_center = self.clusterer.weighted_cluster_centroid(label)
-            centers.append(cluster_center)
-            
-        # Slightly shift the centers away from each other
-        centers = np.array(centers)
-        centers_shifted = []
-        for i, center in enumerate(centers):
-            other_centers = [vec for j, vec in enumerate(centers) if j != i]
-            distances = [1 / (1e-6 + euclidean(center, vec)) for vec in other_centers]
-            distances = softmax(distances)
-            
-            vectors = [ (center - vec) * (dist / np.linalg.norm(center - vec)) for vec, dist in zip(other_centers, distances)]
-            direction = np.mean(vectors, axis=0)
-            # print(direction)
-            centers_shifted.append(center + direction * np.linalg.norm(center))
-            
-        centers_shifted = np.array(centers_shifted)
+        # Now we need to get the center point for each of those clusters, which is the average of the cluster members 
+        # weighted by their membership strength.
+        centers = weighted_cluster_centers(embeddings, self.clusterer.labels_, self.clusterer.probabilities_)
+        
+        self.cluster_centers = centers
+        self.cluster_epoch = self.epoch
         return centers
     
-    def generate(self, x, y, batch_size: int = 32):
-        
+    def set_data(self, x, y):
+        """
+        Sets the training data ``x`` and ``y`` for which the cluster targets are maintained and resets the targets 
+        to the state where none of the embeddings belongs to a cluster.
+        """
         num_samples = len(y) if not isinstance(y, (list, tuple)) else len(y[0])
-        indices = list(range(num_samples))
-        
-        cluster_centers = None
-        one_hot = None
-        mask = None
-        centers = None
+        self.x = x
+        self.num_samples = num_samples
+        
+        self.labels = np.full(shape=(num_samples, self.num_channels), fill_value=-1, dtype=np.int32)
+        self.label_offset = 0
+        self.var_labels = tf.Variable(self.labels, trainable=False)
+        self.var_centers = tf.Variable(
+            tf.zeros(shape=(1, 1)), 
+            shape=tf.TensorShape([None, None]), 
+            trainable=False,
+        )
         
-        clustering_indices = random.sample(indices, k=self.cluster_batch_size)
-        clustering_inputs = gather_arrays(x, clustering_indices)
-        cluster_centers = self.create_clusters(clustering_inputs)
-        self.logger.info(f' * created clustering with shape: {cluster_centers.shape}')
+    def embedd_samples(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Returns the (S, K, D) embeddings of the training samples with the given ``indices``.
+        """
+        inputs = gather_arrays(self.x, indices)
+        embeddings = self.model.embedd(inputs).numpy()
+        # The model returns the embeddings of the channels one after the other: (K * S, D)
+        embeddings = embeddings.reshape((self.num_channels, len(indices), -1))
         
-        num_clusters = len(cluster_centers)
-        self.logger.info(f' * modified and recompiled model')
+        return np.transpose(embeddings, (1, 0, 2))
+    
+    def update_clusters(self) -> None:
+        """
+        Re-creates the clustering from the embeddings of a random sample of ``cluster_batch_size`` training samples 
+        and updates the cluster targets. The sampled elements directly get their new cluster labels. The labels of 
+        all the other elements still refer to the previous clustering and are therefore mapped to the closest new 
+        cluster center. They are then gradually refined by ``update_labels``.
+        
+        :returns: None
+        """
+        # The clustering only has to be created again if the model has been trained since the last one was created. 
+        # Otherwise, only the labels of the next chunk are updated with the existing clustering.
+        if self.clusterer is not None and self.cluster_epoch == self.epoch:
+            self.log(f're-using clustering from epoch {self.cluster_epoch}')
+            self.update_labels()
+            return
+        
+        centers_previous = self.cluster_centers
+        indices = np.random.choice(self.num_samples, size=min(self.cluster_batch_size, self.num_samples), replace=False)
+        
+        # create_clusters works on the embeddings in the channel-major order of the model
+        centers = self.create_clusters(gather_arrays(self.x, indices))
+        labels_sample = self.clusterer.labels_.reshape((self.num_channels, len(indices))).T
+        
+        if len(centers) == 0:
+            self.labels[:] = -1
+        elif centers_previous is not None and len(centers_previous) > 0:
+            # mapping: (C_prev, ) - the closest new cluster for each of the previous clusters
+            distances = np.sum(np.abs(centers_previous[:, None, :] - centers[None, :, :]), axis=-1)
+            mapping = np.argmin(distances, axis=1)
+            self.labels = np.where(self.labels < 0, -1, mapping[np.maximum(self.labels, 0)]).astype(np.int32)
+            
+        self.labels[indices] = labels_sample
+        self.cluster_indices = indices
+        self.assign_targets()
+        self.log(f'created clustering with shape {centers.shape} from {len(indices)} samples')
+        
+    def update_labels(self) -> None:
+        """
+        Updates the cluster labels of the next chunk of ``label_batch_size`` training samples by predicting the 
+        clusters of their current embeddings. The chunks cycle through the whole training dataset, so that only 
+        a part of the dataset has to be embedded at a time.
+        
+        :returns: None
+        """
+        if self.clusterer is None or self.cluster_centers is None or len(self.cluster_centers) == 0:
+            return
+        
+        indices = (self.label_offset + np.arange(min(self.label_batch_size, self.num_samples))) % self.num_samples
+        self.label_offset = int(indices[-1] + 1) % self.num_samples
+        
+        embeddings = self.embedd_samples(indices)
+        labels, _ = hdbscan.approximate_predict(self.clusterer, embeddings.reshape((-1, embeddings.shape[-1])))
+        self.labels[indices] = labels.reshape((len(indices), self.num_channels))
+        self.assign_targets()
+        
+    def assign_targets(self) -> None:
+        """
+        Assigns the current cluster labels and centers to the variables that are read by the tf.data pipeline.
+        """
+        self.var_labels.assign(self.labels)
+        if len(self.cluster_centers) > 0:
+            self.var_centers.assign(tf.constant(self.cluster_centers, dtype=tf.float32))
+    
+    def generate(self, x, y, batch_size: int = 32) -> tf.data.Dataset:
+        """
+        Sets the training data ``x`` and ``y`` and returns the infinite dataset of the training batches, whose 
+        cluster targets are updated during the training (see ``on_epoch_end``). If the warmup is already done, the 
+        initial clustering is created and the packing loss is activated right away.
+        """
+        self.set_data(x, y)
+        if self.epoch >= self.epochs_warmup:
+            self.update_clusters()
+            self.var_factor.assign(self.factor)
+            self.is_warm = True
         
-        num_clusters = len(cluster_centers)
-        embeddings = self.model.embedd(x).numpy()
-        self.logger.info(f' * calculated dataset embeddings with shape: {embeddings.shape}')
-
-        labels, _ = hdbscan.approximate_predict(self.clusterer, embeddings)
-        identity_matrix = np.eye(num_clusters)
+        self.logger.info('starting tf.data input pipeline')
+        return self.create_dataset(x, y, batch_size=batch_size)
+    
+    def create_dataset(self, 
+                       x: t.Any, 
+                       y: t.Any, 
+                       batch_size: int = 32,
+                       ) -> tf.data.Dataset:
+        """
+        Creates the infinite ``tf.data.Dataset`` of the training batches (x_batch, y_batch, (centers_batch, mask_batch)) 
+        from the model inputs ``x`` and the targets ``y``. The dataset only iterates over the shuffled sample indices 
+        and all the gathering, including that of the ragged input tensors, is done by a parallel map on the TF side. 
+        The cluster targets are read from the label and center variables (see ``set_data``), so that updates of the 
+        clustering are picked up by the next batches. Unlike the previous python generator, the last partial batch of 
+        every epoch is kept.
+        
+        :param x: The model inputs, which may be a (nested) list of (ragged) tensors or arrays
+        :param y: The model targets, which may be a (nested) list of tensors or arrays
+        :param batch_size: The number of samples per batch
+        
+        :returns: The dataset
+        """
+        num_samples = len(y) if not isinstance(y, (list, tuple)) else len(y[0])
         
-        one_hot = identity_matrix[labels]
-        centers = cluster_centers[labels]
-        # centers = np.concatenate((centers, centers), axis=-1)
-        mask = np.where(labels < 0, 0.0, 1.0)
-        self.logger.info(f' * calculated cluster labels for embeddings: {one_hot.shape}')
+        x_tensors = to_tensors(x)
+        y_tensors = to_tensors(y)
+        var_labels = self.var_labels
+        var_centers = self.var_centers
+        
+        def gather_batch(indices: tf.Tensor):
+            x_batch = tf.nest.map_structure(lambda value: tf.gather(value, indices), x_tensors)
+            y_batch = tf.nest.map_structure(lambda value: tf.gather(value, indices), y_tensors)
+            # The targets are flattened into the channel-major order of the embeddings: (K * B, D) and (K * B, )
+            labels_batch = tf.reshape(tf.transpose(tf.gather(var_labels, indices)), (-1, ))
+            centers_batch = tf.gather(var_centers, tf.maximum(labels_batch, 0))
+            mask_batch = tf.cast(labels_batch >= 0, tf.float32)
+            
+            return x_batch, y_batch, (centers_batch, mask_batch)
         
-        self.logger.info('starting custom batch generator')
-        epoch = 0
+        dataset = tf.data.Dataset.range(num_samples)
+        dataset = dataset.shuffle(num_samples, reshuffle_each_iteration=True)
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(gather_batch, num_parallel_calls=tf.data.AUTOTUNE)
+        dataset = dataset.repeat()
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
         
-        while True:
-            
-            # shuffle the dataset
-            indices_epoch = indices.copy()
-            random.shuffle(indices_epoch)
-            x_epoch = gather_arrays(x, indices_epoch)
-            y_epoch = gather_arrays(y, indices_epoch)
-            
-
-            # if self.epoch == self.epochs_warmup and not self.is_warm:
-            #     self.is_warm = True
-            #     self.model.stop_training = True
-            #     return
-            
-            # if self.epoch > epochs:
-                
-                
-            indices_epoch_cluster = [i + k * num_samples for k in range(self.num_channels) for i in indices_epoch]
-            # print(indices_epoch_cluster)
-            one_hot_epoch = one_hot[indices_epoch]
-            centers_epoch = centers[indices_epoch_cluster]
-            mask_epoch = mask[indices_epoch_cluster]
-
-            i_batch = 0
-            while i_batch < num_samples:
-                num_batch = min(batch_size, num_samples - i_batch)
-                if num_batch < batch_size:
-                    i_batch += num_batch
-                    continue
-                
-                indices_batch = list(range(i_batch, i_batch+num_batch))
-                x_batch = gather_arrays(x_epoch, indices_batch)
-                y_batch = gather_arrays(y_epoch, indices_batch)
-                
-                one_hot_batch = one_hot_epoch[indices_batch]
-                indices_batch_cluster = [i + k * num_samples for k in range(self.num_channels) for i in indices_batch]
-                
-                centers_batch = centers_epoch[indices_batch_cluster]
-                mask_batch = mask_epoch[indices_batch_cluster]
-                # mask_batch = mask_epoch[indices_batch]
-                # centers_batch = centers_epoch[indices_batch]
-                
-                # yield (x_batch, y_batch, cluster_centers)
-                yield (x_batch, y_batch, (centers_batch, mask_batch))
-                
-                i_batch += num_batch
-                
-            epoch += 1
-
+        return dataset
 
     def compile(self, *args, **kwargs):
         self.compile_kwargs = kwargs
@@ -328,20 +432,21 @@ class ClusterPackingTrainer:
     
     def fit(self, x, y, **kwargs):
         num_samples = len(y) if not isinstance(y, (list, tuple)) else len(y[0])
-        self.batch_size = kwargs['batch_size']
+        self.batch_size = kwargs.pop('batch_size')
         self.epochs = kwargs['epochs']
-
         
         if 'callbacks' in kwargs:
             kwargs['callbacks'].append(self.callback)
         else:
             kwargs['callbacks'] = [self.callback]
-            
-        while self.epoch < self.epochs:
-            self.logger.info(f'restarting model training at epoch {self.epoch}/{self.epochs}...')
-            generator = self.generate(x, y, batch_size=self.batch_size)
-            self.model.fit(
-                generator,
-                **kwargs,
-                steps_per_epoch=num_samples // self.batch_size,
-            )
\ No newline at end of file
+        
+        # This is a single continuous training run. The warmup and the re-clustering are handled by the callback, 
+        # which updates the loss factor and the cluster targets in place.
+        self.logger.info(f'starting model training at epoch {self.epoch}/{self.epochs}...')
+        dataset = self.generate(x, y, batch_size=self.batch_size)
+        return self.model.fit(
+            dataset,
+            **kwargs,
+            initial_epoch=self.epoch,
+            steps_per_epoch=int(np.ceil(num_samples / self.batch_size)),
+        )
@@ -0,0 +1,237 @@
+"""
+This module implements the JSON serialization of the numpy-heavy data structures of this package, such as the
+concept dicts, the raw graph dicts and the DeepECT states. Converting every array with ``tolist`` during
+the JSON encoding is very slow for large embedding arrays. Therefore, all the arrays with at least a certain
+number of elements are instead saved into a binary ".npz" sidecar file next to the JSON file and the JSON
+file only contains a reference to them. All the smaller arrays are still encoded as nested lists.
+
+If the optional "orjson" package is installed, it is used as the JSON backend, which natively supports numpy
+arrays and is considerably faster than the standard library json module.
+
+.. code-block:: python
+
+    dump_json({'embeddings': np.random.random((10_000, 64))}, '/tmp/data.json')
+    data = load_json('/tmp/data.json')
+
+Additionally, this module implements a simple append-only binary log of frames (dicts of arrays), which is used 
+for data that is recorded incrementally such as the history of a DeepECT training. The frames are appended one 
+at a time with ``append_frame`` and read back lazily with ``iterate_frames``.
+"""
+import os
+import json
+import typing as t
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Arrays with at least this number of elements are saved in the binary sidecar file instead of the JSON file.
+ARRAY_THRESHOLD: int = 1000
+# The key of the dicts which replace the sidecar arrays in the JSON data.
+ARRAY_KEY: str = '__array__'
+
+
+class ArrayJsonEncoder(json.JSONEncoder):
+    """
+    JSON encoder for the standard library json module, which encodes numpy arrays and scalars as well as
+    tensors (any object with a "numpy" method) as the corresponding lists and python scalars.
+    """
+    def default(self, obj: t.Any) -> t.Any:
+        return encode_default(obj)
+
+
+def encode_default(obj: t.Any) -> t.Any:
+    """
+    Converts the given ``obj``, which cannot be JSON encoded directly, into a JSON encodable value. This is
+    used as the "default" function of both JSON backends.
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif hasattr(obj, 'numpy'):
+        return encode_default(np.asarray(obj.numpy()))
+
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def get_sidecar_path(path: str) -> str:
+    """
+    Returns the path of the binary sidecar file of the JSON file with the given ``path``.
+    """
+    return os.path.splitext(path)[0] + '.npz'
+
+
+def extract_arrays(data: t.Any,
+                   arrays: t.Dict[str, np.ndarray],
+                   threshold: int = ARRAY_THRESHOLD,
+                   ) -> t.Any:
+    """
+    Returns a copy of the nested structure ``data`` in which all the numpy arrays (and tensors) with at least
+    ``threshold`` elements are replaced by reference dicts. The arrays themselves are added to the given
+    ``arrays`` dict under the names that are referenced. The input data is not modified.
+
+    :param data: The nested structure of dicts, lists and tuples
+    :param arrays: The dict to which the extracted arrays are added
+    :param threshold: The minimum number of elements of an array to be extracted
+
+    :returns: The structure with the references
+    """
+    if isinstance(data, dict):
+        return {key: extract_arrays(value, arrays, threshold) for key, value in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return [extract_arrays(value, arrays, threshold) for value in data]
+
+    if hasattr(data, 'numpy') and not isinstance(data, np.ndarray):
+        data = np.asarray(data.numpy())
+
+    if isinstance(data, np.ndarray) and data.size >= threshold and data.dtype != object:
+        name = f'a{len(arrays)}'
+        arrays[name] = data
+        return {ARRAY_KEY: name}
+
+    return data
+
+
+def resolve_arrays(data: t.Any, arrays: t.Mapping[str, np.ndarray]) -> t.Any:
+    """
+    Replaces all the array reference dicts in the nested structure ``data`` with the corresponding arrays
+    from the given ``arrays`` mapping in place and returns the resulting structure.
+    """
+    if isinstance(data, dict):
+        if len(data) == 1 and ARRAY_KEY in data:
+            return arrays[data[ARRAY_KEY]]
+
+        for key, value in data.items():
+            data[key] = resolve_arrays(value, arrays)
+
+    elif isinstance(data, list):
+        for index, value in enumerate(data):
+            data[index] = resolve_arrays(value, arrays)
+
+    return data
+
+
+def dumps_json(data: t.Any) -> bytes:
+    """
+    Encodes the given ``data`` as JSON bytes, using the fast orjson backend if it is installed. Numpy arrays
+    are encoded as lists.
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            data,
+            default=encode_default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+        )
+
+    return json.dumps(data, cls=ArrayJsonEncoder).encode('utf-8')
+
+
+def loads_json(content: t.Union[str, bytes]) -> t.Any:
+    """
+    Decodes the given JSON ``content``, using the fast orjson backend if it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+
+    return json.loads(content)
+
+
+def dump_json(data: t.Any,
+              path: str,
+              threshold: t.Optional[int] = ARRAY_THRESHOLD,
+              ) -> None:
+    """
+    Saves the given ``data`` as a JSON file to the given ``path``. All the numpy arrays with at least
+    ``threshold`` elements are saved into the binary sidecar file (see ``get_sidecar_path``) and only
+    referenced from the JSON file. If the threshold is None, all arrays are encoded into the JSON file.
+
+    :param data: The JSON-like data, which may contain numpy arrays, numpy scalars and tensors
+    :param path: The absolute path of the JSON file
+    :param threshold: The minimum number of elements of the arrays to be saved in the sidecar file
+
+    :returns: None
+    """
+    arrays: t.Dict[str, np.ndarray] = {}
+    if threshold is not None:
+        data = extract_arrays(data, arrays, threshold)
+
+    sidecar_path = get_sidecar_path(path)
+    if arrays:
+        np.savez(sidecar_path, **arrays)
+    # A sidecar file of a previous version of the JSON file would otherwise be mistaken for the current one.
+    elif os.path.exists(sidecar_path):
+        os.remove(sidecar_path)
+
+    with open(path, mode='wb') as file:
+        file.write(dumps_json(data))
+
+
+def load_json(path: str) -> t.Any:
+    """
+    Loads the JSON file with the given ``path``, including all the arrays from the binary sidecar file
+    which are referenced in it. This also works for plain JSON files without a sidecar file.
+
+    :param path: The absolute path of the JSON file
+
+    :returns: The loaded data
+    """
+    with open(path, mode='rb') as file:
+        data = loads_json(file.read())
+
+    sidecar_path = get_sidecar_path(path)
+    if os.path.exists(sidecar_path):
+        with np.load(sidecar_path) as arrays:
+            data = resolve_arrays(data, arrays)
+
+    return data
+
+
+def append_frame(path: str, frame: t.Dict[str, t.Any]) -> None:
+    """
+    Appends the given ``frame`` to the append-only binary log file with the given ``path``, which is created if 
+    it does not exist yet. A frame is a flat dict whose values are either numpy arrays or JSON encodable values. 
+    Each frame is written as a sequence of ".npy" records: first a header with the JSON encoded values and the 
+    names of the arrays and then the arrays themselves.
+    
+    :param path: The absolute path of the log file
+    :param frame: The dict with the frame data
+    
+    :returns: None
+    """
+    arrays = {key: value for key, value in frame.items() if isinstance(value, np.ndarray)}
+    header = {
+        'values': {key: value for key, value in frame.items() if key not in arrays},
+        'arrays': list(arrays.keys()),
+    }
+    
+    with open(path, mode='ab') as file:
+        np.save(file, np.array(dumps_json(header).decode('utf-8')), allow_pickle=False)
+        for array in arrays.values():
+            np.save(file, array, allow_pickle=False)
+            
+
+def iterate_frames(path: str) -> t.Iterator[t.Dict[str, t.Any]]:
+    """
+    Iterates over all the frames of the binary log file with the given ``path`` (see ``append_frame``), reading 
+    only one frame at a time. An incomplete last frame, for example due to an interrupted process, is ignored.
+    
+    :param path: The absolute path of the log file
+    
+    :returns: A generator of the frame dicts
+    """
+    size = os.path.getsize(path)
+    with open(path, mode='rb') as file:
+        while file.tell() < size:
+            try:
+                header = loads_json(str(np.load(file, allow_pickle=False)))
+                frame = dict(header['values'])
+                for key in header['arrays']:
+                    frame[key] = np.load(file, allow_pickle=False)
+            except (ValueError, EOFError):
+                return
+            
+            yield frame
@@ -6,6 +6,7 @@ import string
 import tempfile
 import random
 import subprocess
+import hashlib
 from typing import List
 from collections import defaultdict
 import typing as t
@@ -14,6 +15,8 @@ import click
 import jinja2 as j2
 import numpy as np
 from sklearn.metrics import pairwise_distances
+from scipy.spatial.distance import squareform
+from scipy.cluster.hierarchy import linkage, optimal_leaf_ordering, leaves_list
 from graph_attention_student.training import EpochCounterCallback
 
 
@@ -112,6 +115,43 @@ def random_string(length: int,
     return ''.join(random.choices(chars, k=length))
 
 
+def content_hash(*values: t.Any) -> str:
+    """
+    Computes a hash string which uniquely identifies the *content* of the given ``values``. Nested 
+    dicts, lists and tuples are traversed recursively, numpy arrays are hashed by their raw bytes, 
+    dtype and shape and all other values are hashed by their type and string representation.
+    
+    This can be used as the key of content-addressed caches where the result should only be 
+    re-computed if any of the inputs have changed.
+    
+    :param values: Any number of values which should be part of the hash
+    
+    :returns: The hex digest string of the SHA256 hash
+    """
+    hasher = hashlib.sha256()
+    for value in values:
+        _update_content_hash(hasher, value)
+        
+    return hasher.hexdigest()
+
+
+def _update_content_hash(hasher: 'hashlib._Hash', value: t.Any) -> None:
+    if isinstance(value, np.ndarray):
+        hasher.update(f'ndarray:{value.dtype.str}:{value.shape}:'.encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        hasher.update(f'dict:{len(value)}:'.encode())
+        for key in sorted(value.keys(), key=str):
+            _update_content_hash(hasher, key)
+            _update_content_hash(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(f'{type(value).__name__}:{len(value)}:'.encode())
+        for item in value:
+            _update_content_hash(hasher, item)
+    else:
+        hasher.update(f'{type(value).__name__}:{value!r};'.encode())
+
+
 # == LATEX UTILITY ==
 # These functions are meant to provide a starting point for custom latex rendering. That is rendering latex
 # from python strings, which were (most likely) dynamically generated based on some kind of experiment data
@@ -173,33 +213,181 @@ def render_latex(kwargs: dict,
 
 
 
-def sort_cluster_centroids(cluster_centroid_map: dict,
-                           metric: str = 'manhattan'):
-    centroids = np.array(list(cluster_centroid_map.values()))
+# == CLUSTER UTILITY ==
+
+def order_centroids(centroids: t.Union[np.ndarray, t.List[np.ndarray]],
+                    metric: str = 'manhattan',
+                    method: t.Literal['greedy', 'two_opt', 'leaf'] = 'greedy',
+                    start: int = 0,
+                    max_iterations: int = 100,
+                    ) -> np.ndarray:
+    """
+    Given a list of cluster ``centroids`` this function determines an ordering of those centroids such 
+    that centroids which immediately follow each other in the ordering are as close to each other as 
+    possible. The distance matrix between all the centroids is only computed once.
+    
+    The following ordering ``method`` options are supported:
+    
+    - "greedy": Starting with the centroid at the ``start`` index, always the closest of the remaining 
+      centroids is chosen as the next one (nearest neighbor walk).
+    - "two_opt": The greedy ordering is additionally refined by the 2-opt heuristic for the open 
+      traveling salesman path, which reverses sub-sequences as long as that reduces the total path length.
+      The first element of the ordering remains at the ``start`` index.
+    - "leaf": The optimal leaf ordering of an average linkage hierarchical clustering of the centroids. 
+      This ignores the ``start`` parameter.
+    
+    :param centroids: An array of shape (C, D) or a list of C vectors of shape (D, )
+    :param metric: The string identifier of the distance metric as supported by sklearn's 
+        ``pairwise_distances`` function.
+    :param method: The string identifier of the ordering method to be used.
+    :param start: The index of the centroid with which the ordering should start.
+    :param max_iterations: The maximum number of improvement sweeps for the "two_opt" method.
+    
+    :returns: An integer array of shape (C, ) which is a permutation of the centroid indices.
+    """
+    centroids = np.array(centroids)
+    num = len(centroids)
+    if num <= 2:
+        return np.arange(num)
+    
+    # distances: (C, C)
     distances = pairwise_distances(centroids, centroids, metric=metric)
     
-    index_label_map = dict(enumerate(cluster_centroid_map.keys()))
+    if method == 'leaf':
+        condensed = squareform(distances, checks=False)
+        linkage_matrix = optimal_leaf_ordering(linkage(condensed, method='average'), condensed)
+        return leaves_list(linkage_matrix)
+    
+    elif method in ['greedy', 'two_opt']:
+        order = _greedy_order(distances, start=start)
+        if method == 'two_opt':
+            order = _two_opt_order(distances, order, max_iterations=max_iterations)
+            
+        return order
+    
+    else:
+        raise ValueError(f'Unknown centroid ordering method "{method}"!')
+
+
+def _greedy_order(distances: np.ndarray, start: int = 0) -> np.ndarray:
+    """
+    Nearest neighbor walk through the given ``distances`` matrix of shape (C, C) starting at the index 
+    ``start``. Already visited indices are masked out with an infinite distance.
+    """
+    num = len(distances)
+    visited = np.zeros(shape=(num, ), dtype=bool)
+    order = np.empty(shape=(num, ), dtype=int)
+    
+    current = start
+    for i in range(num):
+        order[i] = current
+        visited[current] = True
+        if i < num - 1:
+            current = int(np.argmin(np.where(visited, np.inf, distances[current])))
+            
+    return order
+
+
+def _two_opt_order(distances: np.ndarray, 
+                   order: np.ndarray,
+                   max_iterations: int = 100,
+                   ) -> np.ndarray:
+    """
+    Refines the given ``order`` (open path through the ``distances`` matrix) with the 2-opt heuristic. 
+    For every position i, all possible reversals of the sub-sequence [i, j] are evaluated at once and 
+    the one with the largest decrease of the path length is applied.
+    """
+    order = np.array(order)
+    num = len(order)
+    
+    for _ in range(max_iterations):
+        improved = False
+        for i in range(1, num - 1):
+            # Reversing the segment order[i:j+1] replaces the edges (a, b) and (c, n) with the edges 
+            # (a, c) and (b, n), where the edge (c, n) does not exist if j is the last position.
+            a, b = order[i - 1], order[i]
+            js = np.arange(i + 1, num)
+            cs = order[js]
+            ns = order[np.minimum(js + 1, num - 1)]
+            has_next = js < num - 1
+            
+            delta = distances[a, cs] - distances[a, b]
+            delta += np.where(has_next, distances[b, ns] - distances[cs, ns], 0.0)
+            
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-9:
+                j = js[k]
+                order[i:j + 1] = order[i:j + 1][::-1]
+                improved = True
+                
+        if not improved:
+            break
+        
+    return order
+
+
+def sort_cluster_centroids(cluster_centroid_map: dict,
+                           metric: str = 'manhattan',
+                           method: str = 'greedy',
+                           ) -> t.Dict[int, int]:
+    """
+    Given the ``cluster_centroid_map`` whose keys are the original cluster labels and the values are the 
+    corresponding centroid vectors, this function assigns new labels to the clusters such that clusters 
+    with consecutive labels have similar centroids. See ``order_centroids`` for the ordering ``method``.
+    
+    :returns: A dict whose keys are the original cluster labels and the values are the new labels.
+    """
+    labels = list(cluster_centroid_map.keys())
+    order = order_centroids(
+        list(cluster_centroid_map.values()), 
+        metric=metric, 
+        method=method,
+    )
     
     # This map will be the result of the function. The key of this dict is the original cluster label 
     # in which the clusters are labeled in the input cluster_centroid_map. THe value is the new label 
     # that is assigned to it through the centroid-based sorting
-    label_map: t.Dict[int, int] = {0: 0}
-    indices_inserted = set([0])
-    current_index: int = 0
-    for i, (label, centroid) in enumerate(cluster_centroid_map.items()):
-        
-        sorted_indices = np.argsort(distances[current_index])[1:]
-        for j in sorted_indices:
-            if j not in indices_inserted:
-                label_mod = index_label_map[j]
-                indices_inserted.add(j)
-                label_map[label_mod] = i + 1
-                current_index = j
-                break
-
+    label_map: t.Dict[int, int] = {labels[j]: i for i, j in enumerate(order)}
     return label_map
 
 
+def sort_concepts_by_similarity(concepts: t.List[dict],
+                                num_channels: int,
+                                metric: str = 'manhattan',
+                                method: str = 'greedy',
+                                ) -> t.List[dict]:
+    """
+    Sorts the given list of ``concepts`` such that - within each explanation channel - concepts with 
+    similar centroids appear next to each other. The concepts are grouped by their channel index and the 
+    ordering within a channel is determined by ``order_centroids``. The "index" attribute of the 
+    concepts is updated in place to reflect the new order.
+    
+    :param concepts: A list of concept dicts, which need to have the "centroid" and "channel_index" keys
+    :param num_channels: The number of explanation channels
+    :param metric: The distance metric used to compare the centroids
+    :param method: The ordering method, see ``order_centroids``
+    
+    :returns: The sorted list of concept dicts
+    """
+    concepts_sorted: t.List[dict] = []
+    for channel_index in range(num_channels):
+        concepts_channel = [concept for concept in concepts if concept['channel_index'] == channel_index]
+        if len(concepts_channel) == 0:
+            continue
+        
+        order = order_centroids(
+            [concept['centroid'] for concept in concepts_channel],
+            metric=metric,
+            method=method,
+        )
+        concepts_sorted += [concepts_channel[i] for i in order]
+        
+    for index, concept in enumerate(concepts_sorted):
+        concept['index'] = index
+        
+    return concepts_sorted
+
+
 class RecordIntermediateEmbeddingsCallback(EpochCounterCallback):
     
     def __init__(self, 
@@ -2,16 +2,21 @@ import os
 import random
 import tempfile
 import logging
+import multiprocessing as mp
 import typing as t
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 import umap
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import matplotlib as mpl
-from matplotlib.animation import FuncAnimation
 from scipy.spatial.distance import euclidean
+from sklearn.metrics import pairwise_distances_argmin
+from PIL import Image
 from weasyprint import HTML, CSS
+from pypdf import PdfWriter
 from visual_graph_datasets.visualization.base import draw_image
 from visual_graph_datasets.visualization.importances import plot_node_importances_border
 from visual_graph_datasets.visualization.importances import plot_edge_importances_border
@@ -19,7 +24,9 @@ from visual_graph_datasets.visualization.importances import PLOT_NODE_IMPORTANCE
 from visual_graph_datasets.visualization.importances import PLOT_EDGE_IMPORTANCES_OPTIONS
 from megan_global_explanations.utils import TEMPLATE_ENV, TEMPLATES_PATH
 from megan_global_explanations.utils import NULL_LOGGER
+from megan_global_explanations.utils import content_hash
 from megan_global_explanations.utils import DEFAULT_CHANNEL_INFOS
+from megan_global_explanations.serialization import iterate_frames
 
 
 def generate_contrastive_colors(num: int) -> t.List[str]:
@@ -55,58 +62,414 @@ def plot_distributions(ax: plt.Axes,
         ax.fill_between(xs, lowers, uppers, color=color, alpha=fill_alpha, linewidth=0.0)
 
 
-def animate_deepect_history(history: t.Dict[int, dict],
+def iterate_deepect_history(history: t.Union[t.Dict[int, list], str],
+                            ) -> t.Iterator[t.Tuple[int, t.List[dict]]]:
+    """
+    Iterates over the frames of a DeepECT training ``history``, which is either the in-memory history dict 
+    of a ``DeepEctTrainer`` or the path to a history log file that was written with the trainer's 
+    "history_path" option. In the latter case, the frames are only read from the file one at a time.
+    
+    :returns: A generator of tuples (epoch, clusters) where clusters is a list of dicts with the "index", 
+        "embeddings", "center" and "weight" of each leaf node
+    """
+    if not isinstance(history, str):
+        yield from history.items()
+        return
+    
+    for frame in iterate_frames(history):
+        clusters = [
+            {
+                'index':        int(node_index),
+                'embeddings':   frame['embeddings'][frame['labels'] == node_index],
+                'center':       frame['centers'][index],
+                'weight':       float(frame['weights'][index]),
+            }
+            for index, node_index in enumerate(frame['leafs'])
+        ]
+        yield int(frame['epoch']), clusters
+
+
+def fit_history_projection(history: t.Union[t.Dict[int, list], str],
+                           num_fit_samples: int = 10_000,
+                           random_state: t.Optional[int] = None,
+                           ) -> t.Tuple[np.ndarray, np.ndarray]:
+    """
+    Fits a single linear 2D projection (PCA) of the embeddings of all the frames of the given DeepECT 
+    ``history``, so that all the frames of an animation share the same coordinate system. The frames are only 
+    iterated once and the projection is fitted on a uniform random sample of at most ``num_fit_samples`` 
+    embeddings of all the frames (reservoir sampling). For 2-dimensional embeddings, the projection is the 
+    identity.
+    
+    :param history: The history dict or the path of a history log file (see ``iterate_deepect_history``)
+    :param num_fit_samples: The maximum number of embeddings to fit the projection on
+    :param random_state: An optional seed for the random sample
+    
+    :returns: A tuple (mean, components) of the (D, ) mean and the (D, 2) projection matrix, such that the 
+        projection is given as ``(embeddings - mean) @ components``
+    """
+    rng = np.random.default_rng(random_state)
+    sample: t.Optional[np.ndarray] = None
+    num_seen = 0
+    for _, clusters in iterate_deepect_history(history):
+        for data in clusters:
+            embeddings = np.array(data['embeddings'])
+            if len(embeddings.shape) != 2 or len(embeddings) == 0:
+                continue
+            
+            if sample is None:
+                sample = np.zeros(shape=(num_fit_samples, embeddings.shape[1]))
+            
+            # All the embeddings are first used to fill up the sample and afterwards every new embedding 
+            # replaces a random sample element with the probability num_fit_samples / num_seen.
+            indices = num_seen + np.arange(len(embeddings))
+            slots = np.where(indices < num_fit_samples, indices, rng.integers(0, indices + 1))
+            accepted = slots < num_fit_samples
+            sample[slots[accepted]] = embeddings[accepted]
+            num_seen += len(embeddings)
+    
+    if sample is None:
+        raise ValueError('The given DeepECT history does not contain any embeddings!')
+    
+    sample = sample[:num_seen]
+    num_dimensions = sample.shape[1]
+    if num_dimensions <= 2:
+        return np.zeros(shape=(num_dimensions, )), np.eye(num_dimensions, 2)
+    
+    mean = np.mean(sample, axis=0)
+    _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+    return mean, vt[:2].T
+
+
+def render_deepect_frame(path: str,
+                         title: str,
+                         clusters: t.List[dict],
+                         limits: t.Tuple[tuple, tuple],
+                         fig_size: tuple = (10, 10),
+                         ) -> str:
+    """
+    Renders a single frame of a DeepECT history animation, which consists of the given list of 2D ``clusters``,
+    into an image file at the given ``path``.
+    
+    :param path: The absolute path of the image file
+    :param title: The title of the frame
+    :param clusters: A list of cluster dicts with the "index", the 2D "embeddings", the 2D "center" and the "weight"
+    :param limits: A tuple ((x_min, x_max), (y_min, y_max)) of the axis limits which are shared by all frames
+    :param fig_size: The size of the figure
+    
+    :returns: The path of the image file
+    """
+    fig, ax = plt.subplots(ncols=1, nrows=1, figsize=fig_size)
+    ax.set_title(title)
+    
+    for data in clusters:
+        embeddings = data['embeddings']
+        if len(embeddings.shape) != 2:
+            continue
+        
+        # The color is determined by the node index so that each node keeps the same color across the frames
+        color = f'C{data["index"] % 10}'
+        ax.scatter(
+            embeddings[:, 0], 
+            embeddings[:, 1],
+            color=color,
+            label=f'node {data["index"]} ({data["weight"]:.2f}): {len(embeddings)}'
+        )
+        ax.scatter(
+            data['center'][0], data['center'][1],
+            color='black',
+            marker='s',
+            facecolor='none',
+            s=100,
+        )
+    
+    ax.set_xlim(limits[0])
+    ax.set_ylim(limits[1])
+    if clusters:
+        ax.legend()
+    
+    fig.savefig(path)
+    plt.close(fig)
+    
+    return path
+
+
+def assemble_frames(frame_paths: t.List[str],
+                    output_path: str,
+                    fps: int = 5,
+                    ) -> str:
+    """
+    Assembles the image files at the given ``frame_paths`` into an animation at the given ``output_path``. If the 
+    output path has the ".gif" extension, a GIF is created with pillow. Otherwise, the frames are encoded as a 
+    video with ffmpeg, which requires the frames to be named with consecutive numbers as "frame_000000.png" etc.
+    
+    :returns: The output path
+    """
+    if os.path.splitext(output_path)[1].lower() == '.gif':
+        images = (Image.open(frame_path) for frame_path in frame_paths)
+        first = next(images)
+        first.save(
+            output_path, 
+            save_all=True, 
+            append_images=images, 
+            duration=int(1000 / fps), 
+            loop=0
+        )
+    else:
+        subprocess.run([
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-framerate', str(fps),
+            '-i', os.path.join(os.path.dirname(frame_paths[0]), 'frame_%06d.png'),
+            # Most video codecs require even image dimensions
+            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+            '-pix_fmt', 'yuv420p',
+            output_path,
+        ], check=True)
+        
+    return output_path
+
+
+def animate_deepect_history(history: t.Union[t.Dict[int, dict], str],
                             output_path: str,
                             fig_size: tuple = (10, 10),
                             fps: int = 5,
-                            ):
+                            num_workers: int = 1,
+                            num_fit_samples: int = 10_000,
+                            logger: logging.Logger = NULL_LOGGER,
+                            ) -> str:
+    """
+    Creates an animation of the given DeepECT ``history`` at the given ``output_path``, which is a GIF file if the 
+    path has the ".gif" extension and otherwise a video file that is encoded with ffmpeg.
     
-    num_frames = len(history)
+    The history can either be the in-memory history dict of a ``DeepEctTrainer`` or the path of a history log file, 
+    in which case the frames are only ever read one at a time. All the frames are projected with the same 2D 
+    projection (see ``fit_history_projection``) and then rendered to individual image files - in parallel with a 
+    process pool for ``num_workers`` > 1 - which are finally assembled into the animation.
     
-    fig, ax = plt.subplots(ncols=1, nrows=1, figsize=fig_size)
+    :param history: The history dict or the path of a history log file
+    :param output_path: The absolute path of the animation file
+    :param fig_size: The size of the frame figures
+    :param fps: The number of frames per second
+    :param num_workers: The number of worker processes for the rendering of the frames
+    :param num_fit_samples: The maximum number of embeddings to fit the shared projection on
+    :param logger: An optional logger
     
-    xs = np.array([emb[0] for clusters in history.values() for data in clusters for emb in data['embeddings']])
-    ys = np.array([emb[1] for clusters in history.values() for data in clusters for emb in data['embeddings']])
+    :returns: The output path
+    """
+    mean, components = fit_history_projection(history, num_fit_samples=num_fit_samples)
     
-    x_min, x_max = np.max(xs), np.min(xs)
-    y_min, y_max = np.max(ys), np.min(ys)
+    def iterate_projected():
+        for frame, (epoch, clusters) in enumerate(iterate_deepect_history(history)):
+            clusters_projected = []
+            for data in clusters:
+                embeddings = np.array(data['embeddings'])
+                if len(embeddings.shape) != 2:
+                    continue
+                
+                clusters_projected.append({
+                    'index':        data['index'],
+                    'weight':       data['weight'],
+                    'embeddings':   (embeddings - mean) @ components,
+                    'center':       (np.array(data['center']) - mean) @ components,
+                })
+            
+            yield frame, epoch, clusters_projected
+    
+    # The axis limits have to be the same for all the frames and are therefore determined in a separate pass 
+    # over the projected frames.
+    lower, upper = np.full(2, np.inf), np.full(2, -np.inf)
+    for _, _, clusters in iterate_projected():
+        for data in clusters:
+            points = np.concatenate([data['embeddings'], data['center'][None, :]], axis=0)
+            lower = np.minimum(lower, np.min(points, axis=0))
+            upper = np.maximum(upper, np.max(points, axis=0))
     
-    def update(frame):
+    margin = 0.05 * np.maximum(upper - lower, 1e-6)
+    limits = tuple(zip(lower - margin, upper + margin))
+    
+    with tempfile.TemporaryDirectory() as temp_path:
         
-        epoch, clusters = list(history.items())[frame]
-            
-        ax.clear()
-        ax.set_title(f'Epoch: {epoch} - Frame: {frame}')
+        frame_paths: t.List[str] = []
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers,
+                                     mp_context=mp.get_context('spawn'),
+                                     initializer=_initialize_report_worker) as executor:
+                # The number of frames that are waiting to be rendered is bounded, so that the frames are 
+                # streamed through the process pool instead of all being read into memory at once.
+                pending = set()
+                for frame, epoch, clusters in iterate_projected():
+                    if len(pending) >= 2 * num_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    
+                    frame_path = os.path.join(temp_path, f'frame_{frame:06d}.png')
+                    pending.add(executor.submit(
+                        render_deepect_frame, 
+                        frame_path, f'Epoch: {epoch} - Frame: {frame}', clusters, limits, fig_size
+                    ))
+                    frame_paths.append(frame_path)
+                
+                for future in pending:
+                    future.result()
         
-        for data in clusters:
-            embeddings = np.array(data['embeddings'])
-            if len(embeddings.shape) != 2:
-                continue
-            
-            ax.scatter(
-                embeddings[:, 0], 
-                embeddings[:, 1],
-                label=f'node {data["index"]} ({data["weight"]:.2f}): {len(data["embeddings"])}'
-            )
-            ax.scatter(
-                data['center'][0], data['center'][1],
-                color='black',
-                marker='s',
-                facecolor='none',
-                s=100,
-            )
-            ax.set_xlim([x_min, x_max])
-            ax.set_ylim([y_min, y_max])
-            ax.legend()
-    
-    anim = FuncAnimation(
-        fig=fig,
-        func=update,
-        frames=num_frames,
-        blit=False,
+        else:
+            for frame, epoch, clusters in iterate_projected():
+                frame_path = os.path.join(temp_path, f'frame_{frame:06d}.png')
+                render_deepect_frame(frame_path, f'Epoch: {epoch} - Frame: {frame}', clusters, limits, fig_size)
+                frame_paths.append(frame_path)
+                
+        logger.info(f'rendered {len(frame_paths)} frames, assembling the animation...')
+        assemble_frames(frame_paths, output_path, fps=fps)
+    
+    return output_path
+
+
+def stratified_subsample(labels: np.ndarray,
+                         num_samples: int,
+                         random_state: t.Optional[int] = None,
+                         ) -> np.ndarray:
+    """
+    Given an array of integer ``labels``, this function returns the sorted indices of a random subsample of 
+    roughly ``num_samples`` elements, in which every label is represented proportionally to its frequency. 
+    Every label is represented by at least one element.
+    
+    :param labels: An array of shape (N, ) of the labels according to which the sample is stratified
+    :param num_samples: The number of elements in the subsample
+    :param random_state: An optional seed for the random number generator
+    
+    :returns: An integer array of the indices of the subsample elements
+    """
+    labels = np.asarray(labels)
+    num_elements = len(labels)
+    if num_samples >= num_elements:
+        return np.arange(num_elements)
+    
+    rng = np.random.default_rng(random_state)
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    quotas = np.minimum(counts, np.maximum(1, (counts * num_samples) // num_elements))
+    
+    indices = [
+        rng.choice(np.flatnonzero(inverse == u), size=quota, replace=False)
+        for u, quota in enumerate(quotas)
+    ]
+    return np.sort(np.concatenate(indices))
+
+
+def transform_batched(mapper: umap.UMAP,
+                      embeddings: np.ndarray,
+                      batch_size: int = 50_000,
+                      ) -> np.ndarray:
+    """
+    Transforms the given ``embeddings`` with the already fitted ``mapper`` in chunks of ``batch_size`` 
+    elements, which limits the memory usage of the transformation of very large numbers of elements.
+    
+    :returns: The array of the mapped embeddings
+    """
+    return np.concatenate([
+        mapper.transform(embeddings[start:start + batch_size])
+        for start in range(0, len(embeddings), batch_size)
+    ], axis=0)
+
+
+def fit_transform_mapper(mapper: umap.UMAP,
+                         embeddings: np.ndarray,
+                         labels: t.Optional[np.ndarray] = None,
+                         num_fit_samples: t.Optional[int] = None,
+                         batch_size: int = 50_000,
+                         random_state: t.Optional[int] = None,
+                         ) -> np.ndarray:
+    """
+    Fits the given ``mapper`` to the given ``embeddings`` and returns the mapped embeddings. 
+    
+    By default, the mapper is fitted on all the embeddings and the result of the fit is used directly as 
+    the mapping, without an additional transformation. If ``num_fit_samples`` is given and smaller than 
+    the number of embeddings, the mapper is only fitted on a subsample of that size, which is stratified 
+    by the optional ``labels``. The remaining embeddings are then transformed in batches.
+    
+    :param mapper: The mapper instance (e.g. umap.UMAP) to be fitted
+    :param embeddings: The array of shape (N, D) of the embeddings
+    :param labels: An optional array of shape (N, ) of labels to stratify the subsample, e.g. the 
+        concept clusters of the embeddings
+    :param num_fit_samples: The maximum number of embeddings on which the mapper is fitted
+    :param batch_size: The number of embeddings that are transformed at once
+    :param random_state: An optional seed for the random subsample
+    
+    :returns: The array of shape (N, 2) of the mapped embeddings
+    """
+    num_elements = len(embeddings)
+    if num_fit_samples is None or num_elements <= num_fit_samples:
+        return mapper.fit_transform(embeddings)
+    
+    if labels is None:
+        labels = np.zeros(num_elements, dtype=int)
+        
+    fit_indices = stratified_subsample(labels, num_fit_samples, random_state=random_state)
+    mapped_fit = mapper.fit_transform(embeddings[fit_indices])
+    
+    mapped = np.zeros(shape=(num_elements, mapped_fit.shape[1]), dtype=mapped_fit.dtype)
+    mapped[fit_indices] = mapped_fit
+    
+    rest_indices = np.setdiff1d(np.arange(num_elements), fit_indices, assume_unique=True)
+    if len(rest_indices) != 0:
+        mapped[rest_indices] = transform_batched(mapper, embeddings[rest_indices], batch_size=batch_size)
+    
+    return mapped
+
+
+def plot_embedding_points(ax: plt.Axes,
+                          points: np.ndarray,
+                          color: t.Any = 'black',
+                          alpha: float = 0.3,
+                          size: float = 10,
+                          max_points: int = 100_000,
+                          num_bins: int = 300,
+                          zorder: int = 0,
+                          ) -> None:
+    """
+    Draws the given 2D ``points`` onto the given ``ax``. Up to ``max_points``, the points are drawn 
+    as a rasterized scatter plot. For more points than that, drawing the individual markers would 
+    take a very long time, which is why the points are instead binned into a 2D histogram which is 
+    drawn as an image whose opacity indicates the (log) density of the points.
+    
+    :param ax: The matplotlib axes onto which to draw
+    :param points: An array of shape (N, 2) of the point coordinates
+    :param color: The color of the points
+    :param alpha: The alpha value of the scatter markers
+    :param size: The size of the scatter markers
+    :param max_points: The maximum number of points to be drawn as individual markers
+    :param num_bins: The number of bins along each axis for the density image
+    :param zorder: The zorder of the drawn artist
+    """
+    if len(points) <= max_points:
+        ax.scatter(
+            points[:, 0], points[:, 1],
+            color=color,
+            alpha=alpha,
+            s=size,
+            linewidths=0.0,
+            edgecolors='none',
+            rasterized=True,
+            zorder=zorder,
+        )
+        return
+    
+    # counts: (num_bins, num_bins) - note that histogram2d indexes as [x, y] which is why it has to be 
+    # transposed to be drawn as an image.
+    counts, x_edges, y_edges = np.histogram2d(points[:, 0], points[:, 1], bins=num_bins)
+    density = np.log1p(counts.T)
+    density /= np.max(density)
+    
+    image = np.zeros(shape=(*density.shape, 4))
+    image[:, :, :3] = mcolors.to_rgb(color)
+    image[:, :, 3] = density
+    ax.imshow(
+        image,
+        origin='lower',
+        extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+        aspect='auto',
+        interpolation='nearest',
+        zorder=zorder,
     )
-    anim.save(output_path, writer='ffmpeg', fps=fps)
-    return anim
 
 
 def concept_umap_visualization(concepts: list[dict],
@@ -122,6 +485,10 @@ def concept_umap_visualization(concepts: list[dict],
                                plot_concepts: bool = True,
                                base_figsize: int = 5,
                                alpha: float = 0.3,
+                               mappers: t.Optional[dict[int, umap.UMAP]] = None,
+                               num_fit_samples: t.Optional[int] = None,
+                               batch_size: int = 50_000,
+                               max_points: int = 100_000,
                                logger: logging.Logger = NULL_LOGGER,
                                ) -> tuple[plt.Figure, list[umap.UMAP]]:
     """
@@ -154,12 +521,22 @@ def concept_umap_visualization(concepts: list[dict],
         label with the cluster index.
     :param base_figsize: The base figure size to use for the visualization
     :param alpha: The alpha value to use for the scatter plot points
+    :param mappers: An optional dict whose keys are the channel indices and the values already fitted 
+        umap mappers for those channels (e.g. as loaded by the ConceptReader). For these channels, the 
+        embeddings are only transformed without fitting a new mapper.
+    :param num_fit_samples: If this is not None, the umap mappers are only fitted on a subsample of 
+        at most that many embeddings, which is stratified by the closest concept centroid. All the 
+        remaining embeddings are then only transformed.
+    :param batch_size: The number of embeddings that are transformed at once by the mappers
+    :param max_points: The maximum number of points which are drawn as an individual scatter plot. 
+        For more points than that, the points are drawn as a density image instead.
     :param logger: An optional logger instance to use for logging
     
     :returns: A tuple containing the matplotlib figure and a list of the umap mappers that were used
         for the dimensionality reduction
     """
     num_channels: int = len(set([concept['channel_index'] for concept in concepts]))
+    mappers_given = mappers
     
     fig, rows = plt.subplots(
         ncols=num_channels,
@@ -194,10 +571,15 @@ def concept_umap_visualization(concepts: list[dict],
         
         logger.info(f'* channel {channel_index}')
         
-        # It is possible to pass in an external mapper instance by defining a custom 
-        # attribute in the channel's information dict.
-        if 'mapper' in channel_info:
+        # It is possible to pass in an external mapper instance either through the mappers dict or by 
+        # defining a custom attribute in the channel's information dict.
+        if mappers_given is not None and channel_index in mappers_given:
+            mapper = mappers_given[channel_index]
+            mappings_channel = transform_batched(mapper, embeddings_channel, batch_size=batch_size)
+        
+        elif 'mapper' in channel_info:
             mapper = channel_info['mapper']
+            mappings_channel = transform_batched(mapper, embeddings_channel, batch_size=batch_size)
             
         # However, the default case is that we create a new mapper instance and fit it 
         # to the given embeddings.
@@ -211,18 +593,32 @@ def concept_umap_visualization(concepts: list[dict],
                 repulsion_strength=repulsion_strength,
                 spread=spread,
             )
+            # For the stratified subsampling, the elements are labeled by their closest concept centroid 
+            # of the current channel.
+            centroids_channel = [concept['centroid'] for concept in concepts if concept['channel_index'] == channel_index]
+            labels_channel = None
+            if num_fit_samples is not None and len(centroids_channel) != 0:
+                labels_channel = pairwise_distances_argmin(embeddings_channel, np.array(centroids_channel), metric=metric)
+            
             logger.info('   fitting mapper...')
-            mappings_channel = mapper.fit(embeddings_channel)
+            mappings_channel = fit_transform_mapper(
+                mapper=mapper,
+                embeddings=embeddings_channel,
+                labels=labels_channel,
+                num_fit_samples=num_fit_samples,
+                batch_size=batch_size,
+                random_state=random_state,
+            )
         
         mappers.append(mapper)
-        mappings_channel = mapper.transform(embeddings_channel)
 
         logger.info('   plotting...')
-        ax.scatter(
-            mappings_channel[:, 0], mappings_channel[:, 1], 
+        plot_embedding_points(
+            ax=ax,
+            points=mappings_channel,
             color=channel_info['color'],
             alpha=alpha,
-            edgecolors='none',
+            max_points=max_points,
         )
         ax.set_title(f'UMAP Projection\n'
                      f'Channel {channel_index} - {channel_info["name"]}')
@@ -232,37 +628,460 @@ def concept_umap_visualization(concepts: list[dict],
     # ~ addding concepts
     # At this point we already have the umap projections for both of the channels, which are 
     # represented as 2D scatter plots with all the given embeddings. Now we want to add the 
-    # concept information to those plots. For that we go through all the concepts and 
-    # plot the projection of their centroids into the plots as well.
+    # concept information to those plots. For that we project the centroids of all the concepts 
+    # of one channel at once with the corresponding mapper and plot them into the figures.
     
     if plot_concepts:
         
         logger.info('adding the concept centroids...')
-        for concept in concepts:
+        for channel_index in range(num_channels):
+            
+            channel_concepts = [concept for concept in concepts if concept['channel_index'] == channel_index]
+            if len(channel_concepts) == 0:
+                continue
             
-            logger.info(f' * concept {concept["index"]}')
-            # Based on the channel index with which the concept is associated we can then select 
-            # the appropriate umap mapper and then project the centroid of the concept into the
-            # corresponding figure
-            channel_index = concept['channel_index']
             ax = rows[0][channel_index]
             mapper: umap.UMAP = mappers[channel_index]
-            
-            mapping = mapper.transform([concept['centroid']])[0]
+            # mappings: (num_concepts, 2)
+            mappings = mapper.transform(np.array([concept['centroid'] for concept in channel_concepts]))
             ax.scatter(
-                mapping[0], mapping[1],
+                mappings[:, 0], mappings[:, 1],
                 color='black',
                 marker='x',
             )
-            ax.text(
-                mapping[0], mapping[1],
-                f'({concept["index"]})',
-                color='black',
-            )
+            for concept, mapping in zip(channel_concepts, mappings):
+                ax.text(
+                    mapping[0], mapping[1],
+                    f'({concept["index"]})',
+                    color='black',
+                )
     
     return fig, mappers
 
 
+def get_figure_cache_path(folder_path: str,
+                          name: str,
+                          *values: t.Any,
+                          ) -> t.Tuple[str, bool]:
+    """
+    Returns the content-addressed path of a figure with the given ``name`` inside the ``folder_path``. 
+    The file name of the figure contains a hash of all the given ``values``, which should be all the 
+    input data and plot parameters that determine what the figure looks like. That way, an existing 
+    file at the returned path is guaranteed to show the same figure and does not need to be created again.
+    
+    :param folder_path: The absolute path of the folder into which the figure is saved
+    :param name: The base name of the figure file
+    :param values: All the values that the content of the figure depends on
+    
+    :returns: A tuple (path, is_cached) of the absolute figure path and a boolean flag of whether 
+        that file already exists.
+    """
+    key = content_hash(*values)
+    path = os.path.join(folder_path, f'{name}__{key[:16]}.png')
+    return path, os.path.exists(path)
+
+
+def save_figure(fig: plt.Figure, path: str) -> None:
+    """
+    Saves the given ``fig`` as a PNG file to the given ``path``. The figure is first written to a 
+    temporary file which is then renamed such that an interrupted process does not leave a broken 
+    image file at a content-addressed cache path.
+    """
+    temp_path = f'{path}.tmp'
+    fig.savefig(temp_path, format='png', bbox_inches='tight')
+    os.replace(temp_path, path)
+
+
+def _get_importances_figure_key(graph: dict, image_path: str, channel_index: int) -> tuple:
+    # The figure also depends on the graph visualization image itself, which is why the modification time 
+    # of that file is part of the key as well.
+    return (
+        image_path,
+        os.path.getmtime(image_path),
+        np.array(graph['node_positions']),
+        np.array(graph['node_importances'])[:, channel_index],
+        np.array(graph['edge_importances'])[:, channel_index],
+        channel_index,
+    )
+
+
+def create_concept_cluster_page(data: dict,
+                                temp_path: str,
+                                dataset_type: str = 'regression',
+                                examples_type: str = 'random',
+                                num_examples: int = 8,
+                                num_bins: int = 50,
+                                fig_size: tuple = (5, 5),
+                                plot_node_importances: t.Union[str, t.Callable] = 'background',
+                                plot_edge_importances: t.Union[str, t.Callable] = 'background',
+                                distance_func: t.Callable = euclidean,
+                                normalize_centroid: bool = False,
+                                ) -> str:
+    """
+    Creates the report page for a single concept cluster given as the cluster ``data`` dict. All the 
+    figures of the page are saved as image files into the ``temp_path`` folder and the HTML fragment of 
+    the page itself is written as the file "{index}_page.html" into that folder as well.
+    
+    This function is self-contained such that it can be executed in a separate worker process. See 
+    ``create_concept_cluster_report`` for the description of the parameters.
+    
+    :returns: The absolute path of the HTML fragment file
+    """
+
+    cluster_index = data['index']
+
+    # 01.03.24 - backwards compatibility. Originally the concepts dictionaries were created in a way 
+    # to have the two separate attributes "graphs" and "elements" which were lists containing the 
+    # graph dict representations and the corresponding image paths of those graph elements. In the 
+    # new version though, these are combined into the "elements" list which is a list of visual 
+    # graph elements, that includes the image paths and the graphs!
+    # So here we convert the one format into the other, if it exists.
+    if 'elements' in data:
+        data['graphs'] = [element['metadata']['graph'] for element in data['elements']]
+        data['image_paths'] = [element['image_path'] for element in data['elements']]
+
+    # ~ Basic cluster statistics
+    num_elements = len(data['graphs'])
+    channel_indices = [k for i, k in data['index_tuples']]
+    # From all the individual channel indices we can create a soft assignment to a single channel
+    channel_index = round(np.mean(channel_indices))
+
+    # in the first step we want to create aggregation statistics for all the members of the cluster 
+    # which most importantly includes the mask size and contribution to the prediction outcome
+    graphs = data['graphs']
+    image_paths = data['image_paths']
+    index_tuples = data['index_tuples']
+
+    # These deviatons are still 2-dim tensors for each of the graphs becasue they contain the output 
+    # deviations for every pairing of output value and explanation channel.
+    # for the visualization however we need to reduce this to a single value and which value to 
+    # to choose in this case is different for regression and classification results
+    # deviations: (B, K, C)
+    deviations = [graph['graph_deviation'] for graph in graphs]
+    contributions = []
+    if dataset_type == 'regression':
+        # Since regression is only one value anyways we only need to choose the appropriate channel 
+        for graph, dev, (i, k) in zip(graphs, deviations, index_tuples):
+            contributions.append(dev[0][k])
+
+    if dataset_type == 'classification':
+        for graph, dev, (i, k) in zip(graphs, deviations, index_tuples):
+            contributions.append(dev[k][k])
+
+    lim_factor = 1.1
+
+    contributions_mean = np.mean(contributions)
+    contribution_path, is_cached = get_figure_cache_path(
+        temp_path, f'{cluster_index:02d}_contribution',
+        np.array(contributions), num_bins, fig_size, channel_index,
+    )
+    if not is_cached:
+        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
+        ax.hist(contributions, bins=num_bins, color='lightgray')
+        ax.axvline(contributions_mean, color='black', label=f'avg: {contributions_mean:.2f}')
+        x_min, x_max = ax.get_xlim()
+        ax.set_xlim([min(0, x_min * lim_factor), max(0, x_max * lim_factor)])
+        ax.set_xlabel(f'Channel {channel_index} Fidelity')
+        ax.set_ylabel(f'Number of Cluster Elements')
+        ax.legend()
+        save_figure(fig, contribution_path)
+        plt.close(fig)
+
+    # The more important metric here is the size of the explanation mask
+    mask_sizes = [np.sum(graph['node_importances']) for graph in graphs]
+    mask_sizes_mean = np.mean(mask_sizes)
+
+    mask_size_path, is_cached = get_figure_cache_path(
+        temp_path, f'{cluster_index:02d}_mask_size',
+        np.array(mask_sizes), num_bins, fig_size,
+    )
+    if not is_cached:
+        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
+        ax.hist(mask_sizes, bins=num_bins, color='lightgray')
+        ax.axvline(mask_sizes_mean, color='black', label=f'avg: {mask_sizes_mean:.2f}')
+        x_min, x_max = ax.get_xlim()
+        ax.set_xlim([min(0, x_min * lim_factor), max(0, x_max * lim_factor)])
+        ax.set_xlabel(f'Number of Nodes in Explanation Mask')
+        ax.set_ylabel(f'Number of Cluster Elements')
+        ax.legend()
+        save_figure(fig, mask_size_path)
+        plt.close(fig)
+
+    # ~ Prediction distribution
+    # Another distribution that we want to look at is the distribution of the actual predicted values for all 
+    # the cluster members. This will in general be less informative than the fidelity values but potentially 
+    # still interesting for the contrast.
+
+    # 01.03.24 - This was changed from just taking the prediction from the graph dict as it is. That would assume 
+    # that the actual tensor that is output by the model was already properly processed according to the prediction 
+    # type, which we should not assume and instead we should do that processing here: If the type is regression we 
+    # just take the single value in the array and if classification we determine the class by argmax.
+    predictions: t.List[float] = []
+    for graph in graphs:
+        pred = graph['graph_prediction']
+        if isinstance(pred, np.ndarray):
+            if dataset_type == 'regression':
+                predictions.append(pred[0])
+            else:
+                predictions.append(np.argmax(pred))
+        # backwards compatibility: If the prediction happens to be just a value then we assume this is already 
+        # processed and we can just take it as it is.
+        else:
+            predictions.append(pred)
+
+    predictions_mean = np.mean(predictions)
+    predictions_std = np.std(predictions)
+    predictions_path, is_cached = get_figure_cache_path(
+        temp_path, f'{cluster_index:02d}_predictions',
+        np.array(predictions), fig_size,
+    )
+    if not is_cached:
+        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
+        ax.hist(predictions, color='lightgray')
+        ax.axvline(predictions_mean, color='black', label=f'avg: {predictions_mean:.2f}')
+        x_min, x_max = ax.get_xlim()
+        ax.set_xlim([min(0, x_min * lim_factor), max(0, x_max * lim_factor)])
+        ax.set_xlabel(f'Model Prediction')
+        ax.set_ylabel(f'Number of Cluster Elements')
+        ax.legend()
+        save_figure(fig, predictions_path)
+        plt.close(fig)
+
+    # ~ Centroid and intra-cluster metrics
+    # embeddings: (N, D) - just making sure that we are working with a numpy array here
+    embeddings = np.array(data['embeddings'])
+    # The centroid is just the mean of all those embeddings
+    # centroid: (1, D)
+    centroid = np.mean(embeddings, axis=0)
+    # 31.01.24 
+    # In some situations it makes sense to additionally normalize the centroid for example when the embeddings 
+    # themselves are activated to be on the unit sphere then it would not make sense for the centroid not to be 
+    # on it - yet a simple mean of all the embeddings would not guarantee the centroid also to be on the 
+    # unit sphere.
+    if normalize_centroid:
+        centroid = centroid / np.linalg.norm(centroid)
+
+    # Now with the centroid we can calculate the distances of all the embeddings and then create a plot that 
+    # shows the distribution of those. this will be interesting to judge the homogenity of the cluster.
+    centroid_distances = np.array([distance_func(centroid, emb) for emb in embeddings])
+    centroid_distances_mean = np.mean(centroid_distances)
+    centroid_distances_std = np.std(centroid_distances)
+
+    centroid_distances_path, is_cached = get_figure_cache_path(
+        temp_path, f'{cluster_index:02d}_centroid_distances',
+        centroid_distances, fig_size, distance_func.__name__,
+    )
+    if not is_cached:
+        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
+        ax.hist(centroid_distances, color='lightgray')
+        ax.axvline(centroid_distances_mean, color='black', label=f'avg: {centroid_distances_mean:.2f}')
+        x_min, x_max = ax.get_xlim()
+        ax.set_xlim([min(0, x_min * lim_factor), max(0, x_max * lim_factor)])
+        ax.set_xlabel(f'Distance to Centroid ({distance_func.__name__})')
+        ax.set_ylabel(f'Number of Cluster Elements')
+        ax.legend()
+        save_figure(fig, centroid_distances_path)
+        plt.close(fig)
+
+    # ~ Creating the example visualizations
+
+    # The easiest default case is to just pick some random elements from the entire cluster. This will 
+    # perhaps provide the most realistic overview over the cluster.
+    indices = list(range(num_elements))
+    num_examples_ = min(num_examples, len(indices))
+    if examples_type == 'random':
+        example_indices = random.sample(indices, k=num_examples_)
+
+    # In this case we want to select the examples as those elements which are the clostest to the cluster 
+    # centroid. For that purpose we obtain the index sorting of the distances to the centroid and then 
+    # pick those elements with the lowest distances. 
+    elif examples_type == 'centroid':
+        sorted_indices = np.argsort(centroid_distances).tolist()
+        example_indices = sorted_indices[:num_examples_]
+
+    examples: t.List[dict] = []
+    for c in example_indices:
+        graph, image_path, (i, k) = graphs[c], image_paths[c], index_tuples[c]
+
+        example_path, is_cached = get_figure_cache_path(
+            temp_path, f'{cluster_index:02d}_example_{i}',
+            *_get_importances_figure_key(graph, image_path, k),
+            fig_size, plot_node_importances, plot_edge_importances,
+        )
+        if not is_cached:
+            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
+            ax.spines['top'].set_visible(False)
+            ax.spines['right'].set_visible(False)
+            ax.spines['bottom'].set_visible(False)
+            ax.spines['left'].set_visible(False)
+            draw_image(ax, image_path)
+
+            plot_node_importances_func = PLOT_NODE_IMPORTANCES_OPTIONS[plot_node_importances]
+            plot_node_importances_func(
+                ax=ax,
+                g=graph,
+                node_positions=np.array(graph['node_positions']),
+                node_importances=np.array(graph['node_importances'])[:, k]
+            )
+
+            plot_edge_importances_func = PLOT_EDGE_IMPORTANCES_OPTIONS[plot_edge_importances]
+            plot_edge_importances_func(
+                ax=ax,
+                g=graph,
+                node_positions=np.array(graph['node_positions']),
+                edge_importances=np.array(graph['edge_importances'])[:, k],
+            )
+
+            save_figure(fig, example_path)
+            plt.close(fig)
+
+        examples.append({
+            'path': example_path,
+            'title': f'{i}'  
+        })
+
+    # ~ prototype visualizations
+    # Optionally a cluster may also specify one or more "prototypes" these are subgraphs which are supposed 
+    # to represent the underlying pattern of the concept cluster more clearly. 
+    # These prototypes are passed in as visual graph elements in the "prototypes" list. Here we do a pre-processing 
+    # were we create an image that also shows the models explanations for that prototype graph in addition to 
+    # the raw graph image.
+
+    if 'prototypes' in data:
+
+        for i, _data in enumerate(data['prototypes']):
+            graph = _data['metadata']['graph']
+            image_path = _data['image_path']
+
+            # There might be the chance that the prototype graphs do not contain explanation masks as part of their 
+            # attributes in which case we will skip the procedure to visualize those.
+            if ('node_importances' not in graph) or ('edge_importances' not in graph):
+                continue
+
+            prototype_path, is_cached = get_figure_cache_path(
+                temp_path, f'{cluster_index:02d}_prototype_{i}',
+                *_get_importances_figure_key(graph, image_path, k),
+                fig_size, plot_node_importances, plot_edge_importances,
+            )
+            if not is_cached:
+                fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
+                ax.spines['top'].set_visible(False)
+                ax.spines['right'].set_visible(False)
+                ax.spines['bottom'].set_visible(False)
+                ax.spines['left'].set_visible(False)
+                draw_image(ax, image_path)
+
+                plot_node_importances_func = PLOT_NODE_IMPORTANCES_OPTIONS[plot_node_importances]
+                plot_node_importances_func(
+                    ax=ax,
+                    g=graph,
+                    node_positions=np.array(graph['node_positions']),
+                    node_importances=np.array(graph['node_importances'])[:, k]
+                )
+
+                plot_edge_importances_func = PLOT_EDGE_IMPORTANCES_OPTIONS[plot_edge_importances]
+                plot_edge_importances_func(
+                    ax=ax,
+                    g=graph,
+                    node_positions=np.array(graph['node_positions']),
+                    edge_importances=np.array(graph['edge_importances'])[:, k],
+                )
+
+                save_figure(fig, prototype_path)
+                plt.close(fig)
+
+            # Now we need to add that new path to the metadata of the prototype itself so that we can then 
+            # later access this path during the actual rendering of the report HTML.
+            _data['path'] = prototype_path
+
+    # ~ Creating the html
+    # After we have made all the previous computations we can create the HTML string that 
+    # will visualize all that information.
+    cluster_template = TEMPLATE_ENV.get_template('cluster_details.html.j2')
+    cluster_string = cluster_template.render({
+        **data,
+        'index': cluster_index,
+        'num_elements': num_elements,
+        'channel_index': {
+            'avg': np.mean(channel_indices),
+            'std': np.std(channel_indices),
+            'active': round(np.mean(channel_indices)),
+        },
+        'contribution': {
+            'path': contribution_path,
+            'avg': np.mean(contributions),
+            'std': np.std(contributions)
+        },
+        'mask_size': {
+            'path': mask_size_path,
+            'avg': np.mean(mask_sizes),
+            'std': np.std(mask_sizes),
+        },
+        'centroid_distance': {
+            'path': centroid_distances_path,
+            'avg': centroid_distances_mean,
+            'std': centroid_distances_std,
+        },
+        'prediction': {
+            'path': predictions_path,
+            'avg': predictions_mean,
+            'std': predictions_std,   
+        },
+        'values': {
+            'silhouette': 0,
+        },
+        'examples': examples,
+    })
+
+    page_path = os.path.join(temp_path, f'{cluster_index:02d}_page.html')
+    with open(page_path, mode='w') as file:
+        file.write(cluster_string)
+        
+    return page_path
+
+
+def _initialize_report_worker() -> None:
+    """
+    Initializer for the worker processes of the parallel report creation. The workers only ever save 
+    figures to files, so the non-interactive Agg backend is used.
+    """
+    mpl.use('Agg')
+
+
+def render_report_pdf(pages: t.List[str], path: str) -> str:
+    """
+    Renders the given list of cluster ``pages`` HTML fragments into a single report PDF file at the 
+    given ``path``.
+    
+    :returns: The path of the PDF file
+    """
+    report_template = TEMPLATE_ENV.get_template('cluster_report.html.j2')
+    report_string = report_template.render({
+        'pages': pages
+    })
+    html = HTML(string=report_string)
+    
+    cluster_css = CSS(os.path.join(TEMPLATES_PATH, 'cluster_details.css'))
+    html.write_pdf(path, stylesheets=[cluster_css])
+    
+    return path
+
+
+def concatenate_pdfs(paths: t.List[str], path: str) -> None:
+    """
+    Concatenates all the PDF files at the given list of ``paths`` in that order into a single PDF 
+    file at the given ``path``.
+    """
+    writer = PdfWriter()
+    for part_path in paths:
+        writer.append(part_path)
+        
+    with open(path, mode='wb') as file:
+        writer.write(file)
+        
+    writer.close()
+
+
 def create_concept_cluster_report(cluster_data_list: t.List[dict],
                                   path: str,
                                   dataset_type: str = 'regression',
@@ -276,6 +1095,9 @@ def create_concept_cluster_report(cluster_data_list: t.List[dict],
                                   cache_path: t.Optional[str] = None,
                                   distance_func: t.Callable = euclidean,
                                   normalize_centroid: bool = False,
+                                  num_workers: int = 1,
+                                  chunk_size: t.Optional[int] = None,
+                                  report_format: str = 'pdf',
                                   **kwargs,
                                   ) -> None:
     """
@@ -287,7 +1109,15 @@ def create_concept_cluster_report(cluster_data_list: t.List[dict],
     
     Note that all the given lists needs to be in the same order, which means that list elements 
     at the same indices need to represent information about the same dataset element.
+    
+    With ``num_workers`` > 1 the cluster pages (and the PDF parts) are created in parallel by a process 
+    pool. With a ``chunk_size``, the PDF is created as separate parts of that many clusters each, which 
+    are then concatenated. The ``report_format`` "html" creates a lightweight HTML file with lazily 
+    loaded images instead of the PDF.
     """
+    if report_format not in ['pdf', 'html']:
+        raise ValueError(f'Unknown report format "{report_format}"! Has to be either "pdf" or "html".')
+    
     report_template = TEMPLATE_ENV.get_template('cluster_report.html.j2')
     
     with tempfile.TemporaryDirectory() as temp_path:
@@ -296,304 +1126,109 @@ def create_concept_cluster_report(cluster_data_list: t.List[dict],
         # into which all the temporary files should be saved into. This can be useful when the 
         # individual image files of the examples will be needed separately to the report PDF 
         # for example.
+        # All the figures are saved with content-addressed file names, which means that when a report 
+        # is re-created with the same cache folder, only the figures whose input data has changed are 
+        # actually created again. Note that this works best with the "centroid" examples_type, since 
+        # the "random" option will select different examples each time.
         if cache_path is not None and os.path.exists(cache_path):
             temp_path = cache_path
         
+        # The HTML report only references the image files, which is why those have to be persisted next to 
+        # the report itself (unless an explicit cache folder is given) instead of in the temporary folder.
+        elif report_format == 'html':
+            temp_path = f'{os.path.splitext(path)[0]}_files'
+            os.makedirs(temp_path, exist_ok=True)
+        
         num_clusters = len(cluster_data_list)
         logger.info(f'starting to create report for {num_clusters} clusters...')
         
+        page_kwargs = {
+            'temp_path': temp_path,
+            'dataset_type': dataset_type,
+            'examples_type': examples_type,
+            'num_examples': num_examples,
+            'num_bins': num_bins,
+            'fig_size': fig_size,
+            'plot_node_importances': plot_node_importances,
+            'plot_edge_importances': plot_edge_importances,
+            'distance_func': distance_func,
+            'normalize_centroid': normalize_centroid,
+        }
+        
+        # Each cluster page is created independently and written as a separate HTML fragment file. With 
+        # more than one worker, the (matplotlib heavy) creation of the pages is distributed over a process 
+        # pool and the fragments are only merged in the original order at the very end.
+        page_paths: t.List[t.Optional[str]] = [None] * num_clusters
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers,
+                                     mp_context=mp.get_context('spawn'),
+                                     initializer=_initialize_report_worker) as executor:
+                future_index_map = {
+                    executor.submit(create_concept_cluster_page, data, **page_kwargs): p
+                    for p, data in enumerate(cluster_data_list)
+                }
+                for c, future in enumerate(as_completed(future_index_map)):
+                    page_paths[future_index_map[future]] = future.result()
+                    logger.info(f' * ({c+1}/{num_clusters}) done')
+        
+        else:
+            for p, data in enumerate(cluster_data_list):
+                page_paths[p] = create_concept_cluster_page(data, **page_kwargs)
+                logger.info(f' * ({p+1}/{num_clusters}) done')
+        
         pages = []
-        for p, data in enumerate(cluster_data_list):
-            cluster_index = data['index']
-            
-            # 01.03.24 - backwards compatibility. Originally the concepts dictionaries were created in a way 
-            # to have the two separate attributes "graphs" and "elements" which were lists containing the 
-            # graph dict representations and the corresponding image paths of those graph elements. In the 
-            # new version though, these are combined into the "elements" list which is a list of visual 
-            # graph elements, that includes the image paths and the graphs!
-            # So here we convert the one format into the other, if it exists.
-            if 'elements' in data:
-                data['graphs'] = [element['metadata']['graph'] for element in data['elements']]
-                data['image_paths'] = [element['image_path'] for element in data['elements']]
-            
-            # ~ Basic cluster statistics
-            num_elements = len(data['graphs'])
-            channel_indices = [k for i, k in data['index_tuples']]
-            # From all the individual channel indices we can create a soft assignment to a single channel
-            channel_index = round(np.mean(channel_indices))
-            
-            # in the first step we want to create aggregation statistics for all the members of the cluster 
-            # which most importantly includes the mask size and contribution to the prediction outcome
-            graphs = data['graphs']
-            image_paths = data['image_paths']
-            index_tuples = data['index_tuples']
-            
-            # These deviatons are still 2-dim tensors for each of the graphs becasue they contain the output 
-            # deviations for every pairing of output value and explanation channel.
-            # for the visualization however we need to reduce this to a single value and which value to 
-            # to choose in this case is different for regression and classification results
-            # deviations: (B, K, C)
-            deviations = [graph['graph_deviation'] for graph in graphs]
-            contributions = []
-            if dataset_type == 'regression':
-                # Since regression is only one value anyways we only need to choose the appropriate channel 
-                for graph, dev, (i, k) in zip(graphs, deviations, index_tuples):
-                    contributions.append(dev[0][k])
-                    
-            if dataset_type == 'classification':
-                for graph, dev, (i, k) in zip(graphs, deviations, index_tuples):
-                    contributions.append(dev[k][k])
-                    
-            lim_factor = 1.1
-            
-            contributions_mean = np.mean(contributions)
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
-            ax.hist(contributions, bins=num_bins, color='lightgray')
-            ax.axvline(contributions_mean, color='black', label=f'avg: {contributions_mean:.2f}')
-            x_min, x_max = ax.get_xlim()
-            ax.set_xlim([min(0, x_min * lim_factor), max(0, x_max * lim_factor)])
-            ax.set_xlabel(f'Channel {channel_index} Fidelity')
-            ax.set_ylabel(f'Number of Cluster Elements')
-            ax.legend()
-            contribution_path = os.path.join(temp_path, f'{cluster_index:02d}_contribution.png')
-            fig.savefig(contribution_path, bbox_inches='tight')
-            plt.close(fig)
-            
-            # The more important metric here is the size of the explanation mask
-            mask_sizes = [np.sum(graph['node_importances']) for graph in graphs]
-            mask_sizes_mean = np.mean(mask_sizes)
-            
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
-            ax.hist(mask_sizes, bins=num_bins, color='lightgray')
-            ax.axvline(mask_sizes_mean, color='black', label=f'avg: {mask_sizes_mean:.2f}')
-            x_min, x_max = ax.get_xlim()
-            ax.set_xlim([min(0, x_min * lim_factor), max(0, x_max * lim_factor)])
-            ax.set_xlabel(f'Number of Nodes in Explanation Mask')
-            ax.set_ylabel(f'Number of Cluster Elements')
-            ax.legend()
-            mask_size_path = os.path.join(temp_path, f'{cluster_index:02d}_mask_size.png')
-            fig.savefig(mask_size_path, bbox_inches='tight')
-            plt.close(fig)
-            
-            # ~ Prediction distribution
-            # Another distribution that we want to look at is the distribution of the actual predicted values for all 
-            # the cluster members. This will in general be less informative than the fidelity values but potentially 
-            # still interesting for the contrast.
-            
-            # 01.03.24 - This was changed from just taking the prediction from the graph dict as it is. That would assume 
-            # that the actual tensor that is output by the model was already properly processed according to the prediction 
-            # type, which we should not assume and instead we should do that processing here: If the type is regression we 
-            # just take the single value in the array and if classification we determine the class by argmax.
-            predictions: t.List[float] = []
-            for graph in graphs:
-                pred = graph['graph_prediction']
-                if isinstance(pred, np.ndarray):
-                    if dataset_type == 'regression':
-                        predictions.append(pred[0])
-                    else:
-                        predictions.append(np.argmax(pred))
-                # backwards compatibility: If the prediction happens to be just a value then we assume this is already 
-                # processed and we can just take it as it is.
-                else:
-                    predictions.append(pred)
-            
-            predictions_mean = np.mean(predictions)
-            predictions_std = np.std(predictions)
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
-            ax.hist(predictions, color='lightgray')
-            ax.axvline(predictions_mean, color='black', label=f'avg: {predictions_mean:.2f}')
-            x_min, x_max = ax.get_xlim()
-            ax.set_xlim([min(0, x_min * lim_factor), max(0, x_max * lim_factor)])
-            ax.set_xlabel(f'Model Prediction')
-            ax.set_ylabel(f'Number of Cluster Elements')
-            ax.legend()
-            predictions_path = os.path.join(temp_path, f'{cluster_index:02d}_predictions.png')
-            fig.savefig(predictions_path, bbox_inches='tight')
-            plt.close(fig)
-            
-            # ~ Centroid and intra-cluster metrics
-            # embeddings: (N, D) - just making sure that we are working with a numpy array here
-            embeddings = np.array(data['embeddings'])
-            # The centroid is just the mean of all those embeddings
-            # centroid: (1, D)
-            centroid = np.mean(embeddings, axis=0)
-            # 31.01.24 
-            # In some situations it makes sense to additionally normalize the centroid for example when the embeddings 
-            # themselves are activated to be on the unit sphere then it would not make sense for the centroid not to be 
-            # on it - yet a simple mean of all the embeddings would not guarantee the centroid also to be on the 
-            # unit sphere.
-            if normalize_centroid:
-                centroid = centroid / np.linalg.norm(centroid)
-            
-            # Now with the centroid we can calculate the distances of all the embeddings and then create a plot that 
-            # shows the distribution of those. this will be interesting to judge the homogenity of the cluster.
-            centroid_distances = np.array([distance_func(centroid, emb) for emb in embeddings])
-            centroid_distances_mean = np.mean(centroid_distances)
-            centroid_distances_std = np.std(centroid_distances)
-            
-            fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
-            ax.hist(centroid_distances, color='lightgray')
-            ax.axvline(centroid_distances_mean, color='black', label=f'avg: {centroid_distances_mean:.2f}')
-            x_min, x_max = ax.get_xlim()
-            ax.set_xlim([min(0, x_min * lim_factor), max(0, x_max * lim_factor)])
-            ax.set_xlabel(f'Distance to Centroid ({distance_func.__name__})')
-            ax.set_ylabel(f'Number of Cluster Elements')
-            ax.legend()
-            centroid_distances_path = os.path.join(temp_path, f'{cluster_index:02d}_centroid_distances.png')
-            fig.savefig(centroid_distances_path, bbox_inches='tight')
-            plt.close(fig)
-            
-            # ~ Creating the example visualizations
-            
-            # The easiest default case is to just pick some random elements from the entire cluster. This will 
-            # perhaps provide the most realistic overview over the cluster.
-            indices = list(range(num_elements))
-            num_examples_ = min(num_examples, len(indices))
-            if examples_type == 'random':
-                example_indices = random.sample(indices, k=num_examples_)
-                
-            # In this case we want to select the examples as those elements which are the clostest to the cluster 
-            # centroid. For that purpose we obtain the index sorting of the distances to the centroid and then 
-            # pick those elements with the lowest distances. 
-            elif examples_type == 'centroid':
-                sorted_indices = np.argsort(centroid_distances).tolist()
-                example_indices = sorted_indices[:num_examples_]
+        for page_path in page_paths:
+            with open(page_path, mode='r') as file:
+                pages.append(file.read())
+        
+        # The lightweight HTML report is just a single HTML file which includes the stylesheet and which 
+        # only references the figure images. These images are loaded lazily by the browser, which makes it 
+        # possible to quickly browse even very large reports.
+        if report_format == 'html':
+            logger.info('writing HTML report...')
+            with open(os.path.join(TEMPLATES_PATH, 'cluster_details.css')) as file:
+                css = file.read()
             
-            examples: t.List[dict] = []
-            for c in example_indices:
-                graph, image_path, (i, k) = graphs[c], image_paths[c], index_tuples[c]
-
-                fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
-                ax.spines['top'].set_visible(False)
-                ax.spines['right'].set_visible(False)
-                ax.spines['bottom'].set_visible(False)
-                ax.spines['left'].set_visible(False)
-                draw_image(ax, image_path)
-                
-                plot_node_importances_func = PLOT_NODE_IMPORTANCES_OPTIONS[plot_node_importances]
-                plot_node_importances_func(
-                    ax=ax,
-                    g=graph,
-                    node_positions=np.array(graph['node_positions']),
-                    node_importances=np.array(graph['node_importances'])[:, k]
-                )
-                
-                plot_edge_importances_func = PLOT_EDGE_IMPORTANCES_OPTIONS[plot_edge_importances]
-                plot_edge_importances_func(
-                    ax=ax,
-                    g=graph,
-                    node_positions=np.array(graph['node_positions']),
-                    edge_importances=np.array(graph['edge_importances'])[:, k],
-                )
-                
-                example_path = os.path.join(temp_path, f'{cluster_index:02d}_example_{i}.png')
-                fig.savefig(example_path, bbox_inches='tight')
-                plt.close(fig)
-                
-                examples.append({
-                    'path': example_path,
-                    'title': f'{i}'  
-                })
-                
-            # ~ prototype visualizations
-            # Optionally a cluster may also specify one or more "prototypes" these are subgraphs which are supposed 
-            # to represent the underlying pattern of the concept cluster more clearly. 
-            # These prototypes are passed in as visual graph elements in the "prototypes" list. Here we do a pre-processing 
-            # were we create an image that also shows the models explanations for that prototype graph in addition to 
-            # the raw graph image.
+            report_string = report_template.render({
+                'pages': pages,
+                'css': css,
+            })
+            with open(path, mode='w') as file:
+                file.write(report_string)
             
-            if 'prototypes' in data:
-                
-                for i, _data in enumerate(data['prototypes']):
-                    graph = _data['metadata']['graph']
-                    image_path = _data['image_path']
-                    
-                    # There might be the chance that the prototype graphs do not contain explanation masks as part of their 
-                    # attributes in which case we will skip the procedure to visualize those.
-                    if ('node_importances' not in graph) or ('edge_importances' not in graph):
-                        continue
-                    
-                    fig, ax = plt.subplots(nrows=1, ncols=1, figsize=fig_size)
-                    ax.spines['top'].set_visible(False)
-                    ax.spines['right'].set_visible(False)
-                    ax.spines['bottom'].set_visible(False)
-                    ax.spines['left'].set_visible(False)
-                    draw_image(ax, image_path)
-                    
-                    plot_node_importances_func = PLOT_NODE_IMPORTANCES_OPTIONS[plot_node_importances]
-                    plot_node_importances_func(
-                        ax=ax,
-                        g=graph,
-                        node_positions=np.array(graph['node_positions']),
-                        node_importances=np.array(graph['node_importances'])[:, k]
-                    )
-                    
-                    plot_edge_importances_func = PLOT_EDGE_IMPORTANCES_OPTIONS[plot_edge_importances]
-                    plot_edge_importances_func(
-                        ax=ax,
-                        g=graph,
-                        node_positions=np.array(graph['node_positions']),
-                        edge_importances=np.array(graph['edge_importances'])[:, k],
-                    )
-                    
-                    prototype_path = os.path.join(temp_path, f'{cluster_index:02d}_prototype_{i}.png')
-                    fig.savefig(prototype_path, bbox_inches='tight')
-                    plt.close(fig)
-                    
-                    # Now we need to add that new path to the metadata of the prototype itself so that we can then 
-                    # later access this path during the actual rendering of the report HTML.
-                    _data['path'] = prototype_path
+            return
+        
+        # Converting all the pages in a single weasyprint pass means that the entire document including all 
+        # the images has to be held in memory at once. For very large reports it is possible to instead 
+        # convert chunks of "chunk_size" clusters into separate PDF files (optionally in parallel) which are 
+        # then concatenated into the final report.
+        if chunk_size is None:
+            logger.info('converting to PDF...')
+            render_report_pdf(pages, path)
             
-            # ~ Creating the html
-            # After we have made all the previous computations we can create the HTML string that 
-            # will visualize all that information.
-            cluster_template = TEMPLATE_ENV.get_template('cluster_details.html.j2')
-            cluster_string = cluster_template.render({
-                **data,
-                'index': cluster_index,
-                'num_elements': num_elements,
-                'channel_index': {
-                    'avg': np.mean(channel_indices),
-                    'std': np.std(channel_indices),
-                    'active': round(np.mean(channel_indices)),
-                },
-                'contribution': {
-                    'path': contribution_path,
-                    'avg': np.mean(contributions),
-                    'std': np.std(contributions)
-                },
-                'mask_size': {
-                    'path': mask_size_path,
-                    'avg': np.mean(mask_sizes),
-                    'std': np.std(mask_sizes),
-                },
-                'centroid_distance': {
-                    'path': centroid_distances_path,
-                    'avg': centroid_distances_mean,
-                    'std': centroid_distances_std,
-                },
-                'prediction': {
-                    'path': predictions_path,
-                    'avg': predictions_mean,
-                    'std': predictions_std,   
-                },
-                'values': {
-                    'silhouette': 0,
-                },
-                'examples': examples,
-            })
+        else:
+            chunks = [pages[i:i + chunk_size] for i in range(0, num_clusters, chunk_size)]
+            num_chunks = len(chunks)
+            logger.info(f'converting to PDF in {num_chunks} parts...')
+            part_paths = [os.path.join(temp_path, f'report_part_{c:03d}.pdf') for c in range(num_chunks)]
+            if num_workers > 1:
+                with ProcessPoolExecutor(max_workers=num_workers, 
+                                         mp_context=mp.get_context('spawn')) as executor:
+                    futures = [executor.submit(render_report_pdf, chunk, part_path) 
+                               for chunk, part_path in zip(chunks, part_paths)]
+                    for c, future in enumerate(as_completed(futures)):
+                        future.result()
+                        logger.info(f' * ({c+1}/{num_chunks}) parts done')
             
-            pages.append(cluster_string)
-            logger.info(f' * ({p+1}/{num_clusters}) done')
+            else:
+                for c, (chunk, part_path) in enumerate(zip(chunks, part_paths)):
+                    render_report_pdf(chunk, part_path)
+                    logger.info(f' * ({c+1}/{num_chunks}) parts done')
             
-        report_string = report_template.render({
-            'pages': pages
-        })
-        html = HTML(string=report_string)
-        
-        logger.info('converting to PDF...')
-        cluster_css = CSS(os.path.join(TEMPLATES_PATH, 'cluster_details.css'))
-        html.write_pdf(path, stylesheets=[cluster_css])
+            logger.info('concatenating the PDF parts...')
+            concatenate_pdfs(part_paths, path)
+            for part_path in part_paths:
+                os.remove(part_path)
 
     
     
@@ -1,11 +1,13 @@
 import os
 import pytest
 import json
+import pickle
 import tempfile
 import visual_graph_datasets as t
 import visual_graph_datasets.typing as tv
 
 import numpy as np
+from sklearn.decomposition import PCA
 from visual_graph_datasets.processing.colors import ColorProcessing
 from visual_graph_datasets.processing.base import ProcessingBase
 from visual_graph_datasets.util import dynamic_import
@@ -78,6 +80,113 @@ def test_concept_reader_works(num, dim, num_prototypes):
                 assert 'node_indices' in element['metadata']['graph']
                 assert 'edge_indices' in element['metadata']['graph']
 
+def test_concept_reader_mappers_works():
+    """
+    The ConceptWriter should be able to save the fitted dimensionality reduction mappers of each channel 
+    alongside the concepts and the ConceptReader should load them such that they can be used to transform 
+    new embeddings without re-fitting.
+    """
+    dim = 32
+    concepts: t.List[dict] = load_mock_clusters(num_clusters=3, embedding_dim=dim)
+    model = MockModel(num_channels=2, embedding_dim=dim)
+    index_data_map: dict = load_mock_vgd()
+    
+    # Any object with a "transform" method can act as a mapper here. A PCA is used because it is 
+    # a lot faster to fit than UMAP.
+    embeddings = np.random.random(size=(50, dim))
+    mappers = {channel_index: PCA(n_components=2).fit(embeddings) for channel_index in range(2)}
+    
+    with tempfile.TemporaryDirectory() as tempdir:
+        
+        writer = ConceptWriter(
+            path=tempdir,
+            model=model,
+            processing=ColorProcessing(),
+        )
+        writer.write(concepts, mappers=mappers)
+        assert os.path.exists(os.path.join(tempdir, 'mappers'))
+        
+        reader = ConceptReader(
+            path=tempdir,
+            model=model,
+            dataset=index_data_map,
+            query_model=False,
+        )
+        concepts = reader.read()
+        assert len(concepts) == 3
+        assert isinstance(reader.mappers, dict)
+        assert set(reader.mappers.keys()) == {0, 1}
+        
+        for channel_index, mapper in reader.read_mappers().items():
+            assert np.allclose(mapper.transform(embeddings), mappers[channel_index].transform(embeddings))
+
+
+def test_concept_reader_index_works():
+    """
+    The ConceptWriter should write an index file for the concept clustering, which the ConceptReader uses 
+    to directly access individual concepts and to filter them by channel and size.
+    """
+    dim = 32
+    concepts: t.List[dict] = load_mock_clusters(num_clusters=6, embedding_dim=dim)
+    model = MockModel(num_channels=2, embedding_dim=dim)
+    index_data_map: dict = load_mock_vgd()
+    
+    with tempfile.TemporaryDirectory() as tempdir:
+        
+        writer = ConceptWriter(
+            path=tempdir,
+            model=model,
+            processing=ColorProcessing(),
+        )
+        writer.write(concepts)
+        assert os.path.exists(os.path.join(tempdir, 'index.json'))
+        
+        reader = ConceptReader(
+            path=tempdir,
+            model=model,
+            dataset=index_data_map,
+            query_model=False,
+        )
+        assert len(reader.index) == len(concepts)
+        assert all(reader.verify_concept(index) for index in reader.index)
+        
+        centroids = reader.read_centroids()
+        assert centroids.shape == (len(concepts), dim)
+        assert np.allclose(centroids[2], concepts[2]['centroid'])
+        
+        for channel_index in range(2):
+            indices = reader.select_indices(channel_index=channel_index)
+            assert indices == [i for i, concept in enumerate(concepts) if concept['channel_index'] == channel_index]
+            
+        size = len(concepts[0]['elements'])
+        indices = reader.select_indices(min_size=size, max_size=size)
+        assert 0 in indices
+        
+        reader.read_metadata()
+        reader.load_dataset()
+        concept = reader.read_concept(3)
+        assert np.allclose(concept['centroid'], concepts[3]['centroid'])
+        
+        concepts_read = reader.read(channel_index=1)
+        assert len(concepts_read) == len(reader.select_indices(channel_index=1))
+        
+        # A modified concept metadata file is detected by the checksum
+        with open(os.path.join(tempdir, '000', 'metadata.json'), mode='a') as file:
+            file.write(' ')
+        assert not reader.verify_concept(0)
+        
+        # Without the index file, the reader falls back to the concept metadata files
+        os.remove(os.path.join(tempdir, 'index.json'))
+        reader = ConceptReader(
+            path=tempdir,
+            model=model,
+            dataset=index_data_map,
+            query_model=False,
+        )
+        assert reader.index is None
+        assert reader.select_indices(channel_index=0) == [i for i, concept in enumerate(concepts) if concept['channel_index'] == 0]
+
+
 @pytest.mark.parametrize('num,dim,num_prototypes',[
     (3, 32, 0),
     (5, 64, 1),
@@ -139,6 +248,169 @@ def test_concept_writer_works(num, dim, num_prototypes):
                 metadata = json.loads(content)
 
         
+def test_concept_writer_does_not_modify_concepts():
+    """
+    The ConceptWriter strips the redundant graph information from the concept elements before writing them, 
+    but this should not modify the given concepts, whose elements may be references to the dataset elements.
+    """
+    dim = 32
+    concepts: t.List[dict] = load_mock_clusters(num_clusters=3, embedding_dim=dim, num_prototypes=1)
+    model = MockModel(num_channels=2, embedding_dim=dim)
+    
+    with tempfile.TemporaryDirectory() as tempdir:
+        writer = ConceptWriter(
+            path=tempdir,
+            model=model,
+            processing=ColorProcessing(),
+        )
+        writer.write(concepts)
+        
+    for concept in concepts:
+        assert 'prototypes' in concept
+        assert 'graph' in concept['prototypes'][0]['metadata']
+        for element in concept['elements']:
+            assert 'image_path' in element
+            assert 'graph' in element['metadata']
+
+
+def test_concept_writer_num_workers_works():
+    """
+    With num_workers > 1, the ConceptWriter should write the concepts in parallel and the result should be 
+    readable just like the result of the sequential write. No temporary folders should remain.
+    """
+    dim = 32
+    concepts: t.List[dict] = load_mock_clusters(num_clusters=4, embedding_dim=dim, num_prototypes=1)
+    model = MockModel(num_channels=2, embedding_dim=dim)
+    index_data_map: dict = load_mock_vgd()
+    
+    with tempfile.TemporaryDirectory() as tempdir:
+        
+        # A leftover from an interrupted write should be removed
+        os.mkdir(os.path.join(tempdir, '.009.tmp'))
+        
+        writer = ConceptWriter(
+            path=tempdir,
+            model=model,
+            processing=ColorProcessing(),
+            num_workers=2,
+        )
+        writer.write(concepts)
+        
+        files = os.listdir(tempdir)
+        assert not any(file.endswith('.tmp') for file in files)
+        for index in range(len(concepts)):
+            assert os.listdir(os.path.join(tempdir, f'{index:03d}', 'prototypes')) != []
+        
+        reader = ConceptReader(
+            path=tempdir,
+            model=model,
+            dataset=index_data_map,
+            query_model=False,
+        )
+        concepts_read = reader.read()
+        assert len(concepts_read) == len(concepts)
+        for concept, concept_read in zip(concepts, concepts_read):
+            assert np.allclose(concept['centroid'], concept_read['centroid'])
+            assert len(concept_read['prototypes']) == 1
+
+
+class FailingProcessing(ColorProcessing):
+    """
+    A processing which fails to create the visual graph elements for the given concept folder. It can be 
+    pickled such that it can be used by the worker processes of the ConceptWriter.
+    """
+    def __init__(self, fail_name: str = '', **kwargs):
+        super().__init__(**kwargs)
+        self.fail_name = fail_name
+        
+    def __getstate__(self):
+        return {'fail_name': self.fail_name}
+    
+    def __setstate__(self, state):
+        self.__init__(**state)
+        
+    def create(self, *args, output_path: str = '', **kwargs):
+        if self.fail_name in output_path:
+            raise ValueError('processing failed')
+        
+        return super().create(*args, output_path=output_path, **kwargs)
+
+
+def test_concept_writer_failing_prototype_works():
+    """
+    When the visualization of a prototype fails, the ConceptWriter should skip that prototype but still write 
+    all the concepts and the index - with exactly the same result for the sequential and the parallel write.
+    """
+    dim = 32
+    concepts: t.List[dict] = load_mock_clusters(num_clusters=3, embedding_dim=dim, num_prototypes=1)
+    model = MockModel(num_channels=2, embedding_dim=dim)
+    
+    results = []
+    for num_workers in [1, 2]:
+        with tempfile.TemporaryDirectory() as tempdir:
+            writer = ConceptWriter(
+                path=tempdir,
+                model=model,
+                processing=FailingProcessing(fail_name='.001.tmp'),
+                num_workers=num_workers,
+            )
+            writer.write(concepts)
+            
+            assert os.path.exists(os.path.join(tempdir, 'index.json'))
+            results.append({
+                name: sorted(os.listdir(os.path.join(tempdir, name, 'prototypes')))
+                for name in sorted(os.listdir(tempdir))
+                if os.path.isdir(os.path.join(tempdir, name, 'prototypes'))
+            })
+    
+    assert results[0] == results[1]
+    assert sorted(results[0].keys()) == ['000', '001', '002']
+    assert results[0]['000'] != []
+    assert results[0]['001'] == []
+
+
+def test_concept_writer_num_workers_dynamic_processing_works():
+    """
+    When the processing instance was loaded dynamically from a file (like the "process.py" of a dataset) it can 
+    be pickled in the main process but not unpickled by the worker processes. In that case, the ConceptWriter 
+    should detect this and render the prototypes in the main process instead, so that no concept folder is 
+    written without its prototypes.
+    """
+    dim = 32
+    concepts: t.List[dict] = load_mock_clusters(num_clusters=3, embedding_dim=dim, num_prototypes=1)
+    model = MockModel(num_channels=2, embedding_dim=dim)
+    
+    with tempfile.TemporaryDirectory() as tempdir:
+        
+        module_path = os.path.join(tempdir, 'process.py')
+        with open(module_path, mode='w') as file:
+            file.write('from visual_graph_datasets.processing.colors import ColorProcessing\n'
+                       'class DynamicProcessing(ColorProcessing):\n'
+                       '    def __getstate__(self):\n'
+                       '        return {}\n'
+                       '    def __setstate__(self, state):\n'
+                       '        self.__init__()\n')
+        module = dynamic_import(module_path, name='dynamic_process')
+        processing = module.DynamicProcessing()
+        # The instance itself can be pickled in the main process, only the worker processes cannot import the class
+        pickle.dumps(processing)
+        
+        concepts_path = os.path.join(tempdir, 'concepts')
+        os.mkdir(concepts_path)
+        writer = ConceptWriter(
+            path=concepts_path,
+            model=model,
+            processing=processing,
+            num_workers=2,
+        )
+        writer.write(concepts)
+        
+        files = os.listdir(concepts_path)
+        assert not any(file.endswith('.tmp') for file in files)
+        for index in range(len(concepts)):
+            assert len(os.listdir(os.path.join(concepts_path, f'{index:03d}', 'prototypes'))) != 0
+
+
 @pytest.mark.parametrize('num,dim,num_prototypes',[
     (3, 32, 0),
     (5, 64, 1),   
@@ -8,8 +8,13 @@ import numpy as np
 
 from visual_graph_datasets.data import NumericJsonEncoder
 from megan_global_explanations.models import DensePredictor
+from megan_global_explanations.serialization import iterate_frames
 from megan_global_explanations.deep_ect import DeepEctTrainer
 from megan_global_explanations.deep_ect import CustomJsonEncoder
+from megan_global_explanations.deep_ect import tf_projection_loss
+from megan_global_explanations.deep_ect import tf_center_loss
+from megan_global_explanations.deep_ect import tf_assign_leaves
+from megan_global_explanations.deep_ect import batched_two_means
 
 
 def test_deep_ect_trainer_construction_worlks():
@@ -113,4 +118,160 @@ def test_deep_ect_trainer_to_dict_from_dict_works():
     trainer_loaded = DeepEctTrainer.from_dict(data)
     assert isinstance(trainer_loaded, DeepEctTrainer)
     
-    
\ No newline at end of file
+    
+def test_deep_ect_trainer_save_load_works():
+    
+    vectors = np.random.random(size=(100, 10))
+    model = DensePredictor(
+        units=[10, 2],
+        final_units=[10]
+    )
+    trainer = DeepEctTrainer(
+        model=model,
+        elements=vectors,
+    )
+    trainer.initialize()
+    trainer.split_node(0, force=True)
+    trainer.collect_leaves()
+    
+    # The state of the trainer is saved as a binary checkpoint and loading it should restore the same tree
+    with tempfile.TemporaryDirectory() as path:
+        checkpoint_path = os.path.join(path, 'checkpoint.npz')
+        trainer.save(checkpoint_path)
+        assert os.path.exists(checkpoint_path)
+        
+        trainer_loaded = DeepEctTrainer.load(checkpoint_path)
+        assert isinstance(trainer_loaded, DeepEctTrainer)
+        assert np.allclose(trainer_loaded.elements, vectors)
+        assert trainer_loaded.leafs == trainer.leafs
+        assert trainer_loaded.splits == trainer.splits
+        assert np.allclose(
+            trainer_loaded.centers.numpy()[:trainer.next_index], 
+            trainer.centers.numpy()[:trainer.next_index]
+        )
+
+
+def test_deep_ect_trainer_record_history_path_works():
+
+    vectors = np.random.random(size=(100, 10))
+    model = DensePredictor(
+        units=[10, 2],
+        final_units=[10]
+    )
+    model.compile(optimizer='adam')
+
+    with tempfile.TemporaryDirectory() as path:
+        history_path = os.path.join(path, 'history.bin')
+        trainer = DeepEctTrainer(
+            model=model,
+            elements=vectors,
+            batch_size=50,
+            split_epoch_step=2,
+            save_history=True,
+            history_path=history_path,
+            history_num_samples=20,
+        )
+        trainer.initialize()
+
+        # The trainer is stepped through the same callback methods that are invoked during the model training,
+        # where every epoch should append exactly one frame to the history log file.
+        for epoch in range(4):
+            trainer.callback.epoch = epoch
+            for step in range(3):
+                trainer.on_train_batch_end(step)
+            trainer.on_epoch_end(epoch)
+
+            frames = list(iterate_frames(history_path))
+            assert len(frames) == epoch + 1
+
+        for epoch, frame in enumerate(frames):
+            assert frame['epoch'] == epoch
+            assert len(frame['embeddings']) <= 20
+            assert len(frame['embeddings']) == len(frame['labels'])
+            assert len(frame['leafs']) == len(frame['centers'])
+
+        # Since the frames are written to the file, nothing should be kept in memory
+        assert trainer.history == {}
+
+
+def test_tf_projection_loss_works():
+    
+    # Here we construct a small tree with a root node (0) and two leaf nodes (1, 2) and one additional 
+    # padding row which is supposed to be ignored.
+    embeddings = np.random.random(size=(20, 2)).astype(np.float32)
+    positions = np.array([[0.5, 0.5], [0.2, 0.2], [0.8, 0.8], [0.0, 0.0]], dtype=np.float32)
+    siblings = np.array([0, 2, 1, 0], dtype=np.int32)
+    valid = np.array([0, 1, 1, 0], dtype=np.float32)
+    labels = np.array([1] * 10 + [2] * 10)
+    masks = np.zeros(shape=(4, 20), dtype=np.float32)
+    masks[0, :] = 1
+    masks[1, labels == 1] = 1
+    masks[2, labels == 2] = 1
+    
+    loss = tf_projection_loss(embeddings, positions, siblings, masks, valid, tf.constant(3.0))
+    
+    # The vectorized loss has to be the same as the loss of the individual nodes
+    expected = 0.0
+    for node_index in [1, 2]:
+        rho = positions[siblings[node_index]] - positions[node_index]
+        rho = rho / np.linalg.norm(rho)
+        node_embeddings = embeddings[labels == node_index]
+        expected += np.mean(np.abs((positions[node_index] - node_embeddings) @ rho)) / 3
+    
+    assert np.isclose(loss.numpy(), expected, atol=1e-5)
+    
+    
+def test_tf_center_loss_works():
+    
+    # The center matrix contains the root node (0), two leaf nodes (1, 2) and an unused padding row
+    centers = tf.Variable(np.random.random(size=(4, 2)).astype(np.float32))
+    embeddings = np.random.random(size=(20, 2)).astype(np.float32)
+    labels = np.array([1] * 5 + [2] * 15, dtype=np.int32)
+    
+    with tf.GradientTape() as tape:
+        loss = tf_center_loss(centers, embeddings, labels, tf.constant(2.0))
+    
+    # The loss has to be the average distance of the leaf centers to the means of their members
+    expected = np.mean([
+        np.linalg.norm(centers.numpy()[node_index] - np.mean(embeddings[labels == node_index], axis=0))
+        for node_index in [1, 2]
+    ])
+    assert np.isclose(loss.numpy(), expected, atol=1e-5)
+    
+    # Only the rows of the leaf nodes which actually have members should receive a gradient
+    gradient = tape.gradient(loss, centers).numpy()
+    assert np.allclose(gradient[[0, 3]], 0)
+    assert not np.allclose(gradient[[1, 2]], 0)
+    
+    
+def test_tf_assign_leaves_works():
+    
+    # Only the rows 1 and 2 of the center matrix are leaf nodes, which means that the embeddings should never 
+    # be assigned to the root node 0 even though it is the closest one for some of them.
+    centers = np.array([[0.0, 0.0], [-1.0, -1.0], [1.0, 1.0]], dtype=np.float32)
+    embeddings = np.array([[-0.9, -1.2], [0.1, 0.2], [-0.1, -0.1], [2.0, 1.0]], dtype=np.float32)
+    
+    labels = tf_assign_leaves(embeddings, centers, tf.constant([1, 2]))
+    assert labels.numpy().tolist() == [1, 2, 1, 2]
+    
+    
+def test_batched_two_means_works():
+    
+    # The 2-means clusterings of several sets of embeddings with different sizes are computed in one call. Each 
+    # set consists of two clearly separated blobs, which should be exactly recovered.
+    sizes = [10, 40, 100]
+    embeddings_list = [
+        np.concatenate([
+            np.random.normal(loc=-5, scale=0.1, size=(size // 2, 3)),
+            np.random.normal(loc=5, scale=0.1, size=(size - size // 2, 3)),
+        ])
+        for size in sizes
+    ]
+    labels_list = batched_two_means(embeddings_list)
+    assert len(labels_list) == len(sizes)
+    
+    for size, labels in zip(sizes, labels_list):
+        assert labels.shape == (size, )
+        assert len(set(labels[:size // 2])) == 1
+        assert len(set(labels[size // 2:])) == 1
+        assert labels[0] != labels[-1]
@@ -1,7 +1,20 @@
 import os
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import CancelledError
+
 import pytest
 
+import megan_global_explanations.gpt as gpt
 from megan_global_explanations.gpt import query_gpt
+from megan_global_explanations.gpt import GptQueue
+from megan_global_explanations.gpt import RateLimiter
+from megan_global_explanations.gpt import GptCache
+from megan_global_explanations.gpt import resolve_futures
+from megan_global_explanations.gpt import encode_image
+from megan_global_explanations.gpt import prepare_image
 from megan_global_explanations.gpt import describe_molecule
 from megan_global_explanations.gpt import describe_color_graph
 from .util import ASSETS_PATH
@@ -9,6 +22,233 @@ from .util import ARTIFACTS_PATH
 from .util import OPENAI_KEY
 
 
+def test_prepare_image_works():
+    """
+    The prepare_image function should downscale the image to the given maximum size, encode it more 
+    compactly than the original image and memoize the result.
+    """
+    import io
+    import base64
+    from PIL import Image
+    
+    image_path = os.path.join(ASSETS_PATH, 'test_color_graph.png')
+    encoded = prepare_image(image_path, max_size=256)
+    assert isinstance(encoded, str)
+    assert len(encoded) < len(encode_image(image_path))
+    
+    image = Image.open(io.BytesIO(base64.b64decode(encoded)))
+    assert image.size == (256, 256)
+    
+    # The second call should return the memoized string
+    assert prepare_image(image_path, max_size=256) is encoded
+    assert prepare_image(image_path, max_size=None) is not encoded
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    A local stub of the chat completion API, which echoes the user message as the response content. The 
+    first ``num_failures`` requests are answered with the 429 rate limit status code instead.
+    """
+    def __init__(self, num_failures: int = 0, delay: float = 0.0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.num_failures = num_failures
+        self.delay = delay
+        self.num_requests = 0
+        self.num_active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/v1/chat/completions'
+        
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+    
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    
+    def do_POST(self):
+        server: StubServer = self.server
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.num_requests += 1
+            server.num_active += 1
+            server.max_active = max(server.max_active, server.num_active)
+            fail = server.num_requests <= server.num_failures
+            
+        time.sleep(server.delay)
+        with server.lock:
+            server.num_active -= 1
+        
+        if fail:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+        
+        content = payload['messages'][-1]['content'][0]['text']
+        data = {'choices': [{'message': {'role': 'assistant', 'content': content}}]}
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def log_message(self, *args):
+        pass
+
+
+def test_query_gpt_stub_server_works():
+    """
+    The query_gpt function should send the request to the given url and return the response content.
+    """
+    with StubServer() as server:
+        content, messages = query_gpt(
+            api_key='key',
+            system_message='system',
+            user_message='hello',
+            url=server.url,
+        )
+        assert content == 'hello'
+        assert len(messages) == 3
+
+
+def test_gpt_queue_concurrency_works():
+    """
+    The GptQueue should execute the submitted requests concurrently, but never more than the given 
+    maximum concurrency at the same time.
+    """
+    with StubServer(delay=0.1) as server:
+        with GptQueue(api_key='key', url=server.url, max_concurrency=3) as queue:
+            futures = [queue.submit('system', f'message {i}') for i in range(12)]
+            
+        assert [future.result()[0] for future in futures] == [f'message {i}' for i in range(12)]
+        assert server.num_requests == 12
+        assert 1 < server.max_active <= 3
+
+
+def test_gpt_queue_retry_works():
+    """
+    Requests that fail with a rate limit error should be retried by the GptQueue until they succeed 
+    or the maximum number of retries is exceeded.
+    """
+    with StubServer(num_failures=2) as server:
+        with GptQueue(api_key='key', url=server.url, max_concurrency=1, backoff_base=0.01) as queue:
+            future = queue.submit('system', 'hello')
+        
+        assert future.result()[0] == 'hello'
+        assert queue.num_retries == 2
+        assert server.num_requests == 3
+        
+    with StubServer(num_failures=10) as server:
+        with GptQueue(api_key='key', url=server.url, max_retries=1, backoff_base=0.01) as queue:
+            future = queue.submit('system', 'hello')
+        
+        with pytest.raises(Exception):
+            future.result()
+        assert server.num_requests == 2
+
+
+def test_gpt_queue_close_cancels_pending_works():
+    """
+    Closing the GptQueue without joining it first should cancel all the requests which are still pending, 
+    such that their futures raise a CancelledError instead of blocking forever.
+    """
+    with StubServer(delay=0.2) as server:
+        queue = GptQueue(api_key='key', url=server.url, max_concurrency=1)
+        futures = [queue.submit('system', f'message {i}') for i in range(5)]
+        time.sleep(0.05)
+        queue.close()
+        
+        assert all(future.done() for future in futures)
+        assert all(future.cancelled() for future in futures[1:])
+        with pytest.raises(CancelledError):
+            futures[-1].result(timeout=1)
+        
+        # Pending futures which are resolved later on are replaced with their default values
+        dicts = resolve_futures([{'name': future} for future in futures], defaults={'name': 'default'})
+        assert dicts[-1]['name'] == 'default'
+        
+        # Closing the queue a second time should do nothing
+        queue.close()
+
+
+def test_gpt_cache_works(tmp_path):
+    """
+    The GptCache should store the responses of the queries, such that the same query returns the cached 
+    response without sending another request - even if the server is not reachable anymore.
+    """
+    cache = GptCache(path=str(tmp_path / 'cache'))
+    image_path = os.path.join(ASSETS_PATH, 'test_color_graph.png')
+    kwargs = dict(api_key='key', system_message='system', user_message='hello', image_paths=[image_path])
+    
+    with StubServer() as server:
+        content, _ = query_gpt(url=server.url, cache=cache, **kwargs)
+        assert content == 'hello'
+        assert server.num_requests == 1
+        assert (cache.num_hits, cache.num_misses) == (0, 1)
+        
+        # A different max_tokens or image size is a different query
+        query_gpt(url=server.url, cache=cache, max_tokens=100, **kwargs)
+        assert server.num_requests == 2
+        query_gpt(url=server.url, cache=cache, image_size=256, **kwargs)
+        assert server.num_requests == 3
+        
+        with GptQueue(api_key='key', url=server.url, cache=cache) as queue:
+            future = queue.submit('system', 'hello', image_paths=[image_path])
+            assert future.done()
+        assert future.result()[0] == 'hello'
+        assert server.num_requests == 3
+    
+    # The server is shut down at this point, so this only works with the cache. On a cache hit, the images 
+    # are not even prepared for the request.
+    gpt._IMAGE_ENCODING_MAP.clear()
+    content, messages = query_gpt(url=server.url, cache=cache, **kwargs)
+    assert content == 'hello'
+    assert len(messages) == 3
+    assert len(gpt._IMAGE_ENCODING_MAP) == 0
+    assert (cache.num_hits, cache.num_misses) == (2, 3)
+    assert '2 hits' in cache.report()
+
+    # Messages which only differ in their role or in the images of the message history are different queries
+    def history(role: str, url: str) -> list[dict]:
+        return [{'role': role, 'content': [
+            {'type': 'text', 'text': 'hello'},
+            {'type': 'image_url', 'image_url': {'url': url}},
+        ]}]
+
+    key = cache.key('model', history('user', 'data:image/png;base64,AAAA'))
+    assert key == cache.key('model', history('user', 'data:image/png;base64,AAAA'))
+    assert key != cache.key('model', history('assistant', 'data:image/png;base64,AAAA'))
+    assert key != cache.key('model', history('user', 'data:image/png;base64,BBBB'))
+
+
+def test_rate_limiter_works():
+    """
+    The RateLimiter should delay the requests which exceed the given number of requests per minute.
+    """
+    import asyncio
+    
+    async def acquire_all(limiter: RateLimiter, num: int):
+        for _ in range(num):
+            await limiter.acquire(tokens=10)
+    
+    # 600 requests per minute means a refill of one request every 0.1 seconds. The first 2 requests are 
+    # covered by the initial capacity, the remaining 3 have to wait.
+    limiter = RateLimiter(requests_per_minute=600)
+    limiter.requests_available = 2
+    time_start = time.time()
+    asyncio.run(acquire_all(limiter, 5))
+    assert 0.25 < time.time() - time_start < 1.0
+
+
 def test_query_gpt_basically_works():
     """
     The query_gpt function is a generic function that wraps the functionality to send a query to ghe GPT API.
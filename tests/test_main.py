@@ -2,8 +2,11 @@ import os
 import pytest
 import tempfile
 
+import numpy as np
+
 from megan_global_explanations.testing import MockModel
 from megan_global_explanations.main import generate_concept_prototypes
+from megan_global_explanations.main import update_concepts
 
 from .util import load_mock_clusters
 from .util import load_mock_vgd
@@ -54,4 +57,60 @@ def test_generate_concept_prototypes_basically_works():
             prototype = concept['prototypes'][0]
             assert 'image_path' in prototype
             # path should exists
-            assert os.path.exists(prototype['image_path'])
\ No newline at end of file
+            assert os.path.exists(prototype['image_path'])
+
+
+def test_update_concepts_basically_works():
+    """
+    The "update_concepts" function is supposed to incrementally update an existing list of concepts with 
+    new elements. New elements close to an existing concept should be assigned to it and new elements 
+    far away from all the existing concepts should form new concepts.
+    """
+    embedding_dim = 4
+    
+    def create_elements(center: np.ndarray, num: int, start: int) -> dict:
+        index_data_map = {}
+        for index in range(start, start + num):
+            embeddings = np.zeros(shape=(embedding_dim, 2))
+            embeddings[:, 0] = center + np.random.normal(0, 0.1, size=embedding_dim)
+            index_data_map[index] = {'metadata': {'index': index, 'graph': {
+                'graph_embeddings': embeddings,
+                'graph_fidelity': np.array([1.0, 0.0]),
+                'graph_deviation': np.array([[1.0, 0.0]]),
+            }}}
+        return index_data_map
+    
+    # The existing concept is located around the origin
+    index_data_map = create_elements(np.zeros(embedding_dim), num=50, start=0)
+    concepts = [{
+        'index': 0,
+        'channel_index': 0,
+        'centroid': np.zeros(embedding_dim),
+        'embeddings': np.array([data['metadata']['graph']['graph_embeddings'][:, 0] for data in index_data_map.values()]),
+        'index_tuples': [(index, 0) for index in index_data_map.keys()],
+        'elements': list(index_data_map.values()),
+        'contribution': 1.0,
+    }]
+    
+    # The new elements consist of some elements close to the existing concept and a separate group of 
+    # elements which is far away from it.
+    index_data_map.update(create_elements(np.zeros(embedding_dim), num=20, start=100))
+    index_data_map.update(create_elements(np.ones(embedding_dim) * 5, num=30, start=200))
+    indices_new = list(range(100, 120)) + list(range(200, 230))
+    
+    concepts, update_indices = update_concepts(
+        concepts=concepts,
+        index_data_map=index_data_map,
+        indices=indices_new,
+        num_channels=2,
+        min_cluster_size=5,
+        min_samples=2,
+        logger=LOG,
+    )
+    
+    assert len(concepts) >= 2
+    assert len(concepts[0]['elements']) > 50
+    assert len(concepts[0]['elements']) == len(concepts[0]['embeddings'])
+    # The new concept has to be in the list of concepts that need new prototypes
+    assert concepts[-1]['index'] in update_indices
+    assert all(index >= 200 for index, _ in concepts[-1]['index_tuples'])
@@ -0,0 +1,59 @@
+import pytest
+
+import numpy as np
+from sklearn.metrics import silhouette_score
+from sklearn.metrics import davies_bouldin_score
+
+from megan_global_explanations.metrics import concepts_to_columns
+from megan_global_explanations.metrics import cluster_centroids
+from megan_global_explanations.metrics import clustering_metrics
+
+
+def create_concepts(sizes: list = [30, 20, 50], dim: int = 8) -> list:
+    return [
+        {'embeddings': np.random.normal(loc=index * 3, size=(size, dim))}
+        for index, size in enumerate(sizes)
+    ]
+
+
+def test_concepts_to_columns_works():
+    """
+    The concepts_to_columns function should turn a list of concepts into a single embedding array and 
+    the corresponding label array with the positions of the concepts.
+    """
+    concepts = create_concepts(sizes=[30, 20, 50], dim=8)
+    embeddings, labels = concepts_to_columns(concepts)
+    
+    assert embeddings.shape == (100, 8)
+    assert labels.shape == (100, )
+    assert np.bincount(labels).tolist() == [30, 20, 50]
+    
+    centroids = cluster_centroids(embeddings, labels)
+    for concept, centroid in zip(concepts, centroids):
+        assert np.allclose(centroid, np.mean(concept['embeddings'], axis=0))
+
+
+def test_clustering_metrics_match_sklearn():
+    """
+    The silhouette and Davies-Bouldin values of the clustering_metrics function should be the same as the 
+    reference implementations of sklearn if the silhouette is not subsampled.
+    """
+    embeddings, labels = concepts_to_columns(create_concepts())
+    metrics = clustering_metrics(embeddings, labels, silhouette_sample_size=None)
+    
+    assert np.isclose(metrics['silhouette'], silhouette_score(embeddings, labels))
+    assert np.isclose(metrics['dbi'], davies_bouldin_score(embeddings, labels))
+    assert len(metrics['intra_distances']) == 3
+    assert len(metrics['nearest_distances']) == 3
+    assert metrics['inter_distance_mean'] >= min(metrics['nearest_distances'])
+    
+    
+def test_clustering_metrics_silhouette_sample_works():
+    """
+    With a silhouette_sample_size smaller than the number of elements, the silhouette should only be 
+    approximated on a subsample, which for well separated clusters should still be close to the exact value.
+    """
+    embeddings, labels = concepts_to_columns(create_concepts(sizes=[300, 200, 500]))
+    metrics = clustering_metrics(embeddings, labels, silhouette_sample_size=200, random_state=0)
+    
+    assert metrics['silhouette'] == pytest.approx(silhouette_score(embeddings, labels), abs=0.1)
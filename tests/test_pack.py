@@ -0,0 +1,205 @@
+import numpy as np
+import tensorflow as tf
+import tensorflow.keras as ks
+import hdbscan
+from hdbscan import HDBSCAN
+
+from megan_global_explanations.pack import weighted_cluster_centers
+from megan_global_explanations.pack import ClusterPackingTrainer
+
+
+class MockPackingModel(ks.models.Model):
+    """
+    A minimal model for the ClusterPackingTrainer with two explanation channels. The embeddings of both channels
+    are linear projections of the input vectors, which are returned in the channel-major order: (2 * B, 4).
+    """
+    def __init__(self):
+        super().__init__()
+        self.channel_layers = [ks.layers.Dense(4), ks.layers.Dense(4)]
+        self.final_layer = ks.layers.Dense(1)
+
+    def embedd(self, inputs):
+        return tf.concat([lay(inputs) for lay in self.channel_layers], axis=0)
+
+    def call(self, inputs):
+        return self.final_layer(inputs)
+
+    def train_step(self, data):
+        x, y, clusters = data
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compiled_loss(y, y_pred)
+            loss += self.get_packing_loss(self.embedd(x), clusters)
+
+        gradients = tape.gradient(loss, self.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        return {'loss': loss}
+
+
+def create_packing_data(num_samples: int = 200):
+    # The inputs consist of 4 clearly separated blobs, which remain separated after any linear projection
+    x = np.concatenate([
+        np.random.normal(loc=index * 10, scale=0.5, size=(num_samples // 4, 6))
+        for index in range(4)
+    ]).astype(np.float32)
+    y = np.random.random(size=(num_samples, 1))
+
+    return x, y
+
+
+def test_weighted_cluster_centers_works():
+
+    # The centers of all the clusters are computed at once and should be exactly the same as the weighted
+    # centroids which HDBSCAN computes for each cluster individually.
+    embeddings = np.concatenate([
+        np.random.normal(loc=index * 5, scale=0.5, size=(100, 6))
+        for index in range(4)
+    ])
+    clusterer = HDBSCAN(min_cluster_size=5, min_samples=10, metric='manhattan', prediction_data=True)
+    clusterer.fit(embeddings)
+    labels = clusterer.labels_
+
+    centers = weighted_cluster_centers(embeddings, labels, clusterer.probabilities_)
+    num_clusters = np.max(labels) + 1
+    assert centers.shape == (num_clusters, 6)
+    for label in range(num_clusters):
+        assert np.allclose(centers[label], clusterer.weighted_cluster_centroid(label))
+
+
+def test_cluster_packing_trainer_update_clusters_works():
+
+    x, y = create_packing_data(200)
+    model = MockPackingModel()
+    model(x)
+    trainer = ClusterPackingTrainer(
+        model=model,
+        num_channels=2,
+        cluster_batch_size=80,
+        label_batch_size=150,
+        min_samples=5,
+    )
+
+    # Initially, none of the embeddings belongs to a cluster
+    trainer.set_data(x, y)
+    assert trainer.labels.shape == (200, 2)
+    assert np.all(trainer.var_labels.numpy() == -1)
+
+    # The sampled elements directly get the labels of the clustering, whose labels are in the channel-major
+    # order of the model embeddings. All the other elements do not belong to a cluster yet.
+    trainer.update_clusters()
+    centers = trainer.cluster_centers
+    indices = trainer.cluster_indices
+    assert len(indices) == 80
+    assert len(centers) > 1
+    assert np.array_equal(trainer.labels[indices], trainer.clusterer.labels_.reshape((2, 80)).T)
+    assert np.all(np.delete(trainer.labels, indices, axis=0) == -1)
+    assert np.array_equal(trainer.var_labels.numpy(), trainer.labels)
+    assert np.allclose(trainer.var_centers.numpy(), centers)
+
+    # As long as the model has not been trained any further, the clustering is re-used and only the labels
+    # of the next chunk are updated.
+    clusterer = trainer.clusterer
+    trainer.update_clusters()
+    assert trainer.clusterer is clusterer
+    assert trainer.label_offset == 150
+
+    # After a new clustering, the labels of the elements which were not sampled are mapped to the new cluster
+    # centers that are the closest to their previous cluster centers.
+    labels_previous = trainer.labels.copy()
+    trainer.callback.epoch = 1
+    trainer.update_clusters()
+    assert trainer.clusterer is not clusterer
+    assert trainer.cluster_epoch == 1
+
+    distances = np.sum(np.abs(centers[:, None, :] - trainer.cluster_centers[None, :, :]), axis=-1)
+    mapping = np.argmin(distances, axis=1)
+    labels_expected = np.where(labels_previous < 0, -1, mapping[np.maximum(labels_previous, 0)])
+    not_sampled = np.setdiff1d(np.arange(200), trainer.cluster_indices)
+    assert np.array_equal(trainer.labels[not_sampled], labels_expected[not_sampled])
+    assert np.array_equal(trainer.var_labels.numpy(), trainer.labels)
+    assert np.allclose(trainer.var_centers.numpy(), trainer.cluster_centers)
+
+
+def test_cluster_packing_trainer_update_labels_works():
+
+    x, y = create_packing_data(200)
+    model = MockPackingModel()
+    model(x)
+    trainer = ClusterPackingTrainer(
+        model=model,
+        num_channels=2,
+        cluster_batch_size=80,
+        label_batch_size=150,
+        min_samples=5,
+    )
+    trainer.set_data(x, y)
+    trainer.update_clusters()
+    labels_before = trainer.labels.copy()
+
+    embeddings = model.embedd(x).numpy()
+    labels_expected, _ = hdbscan.approximate_predict(trainer.clusterer, embeddings)
+    labels_expected = labels_expected.reshape((2, 200)).T
+
+    # Only the labels of the first chunk are updated
+    trainer.update_labels()
+    assert trainer.label_offset == 150
+    assert np.array_equal(trainer.labels[:150], labels_expected[:150])
+    assert np.array_equal(trainer.labels[150:], labels_before[150:])
+
+    # The next chunk wraps around to the start of the dataset
+    trainer.update_labels()
+    assert trainer.label_offset == 100
+    assert np.array_equal(trainer.labels, labels_expected)
+    assert np.array_equal(trainer.var_labels.numpy(), labels_expected)
+
+
+def test_cluster_packing_trainer_create_dataset_works():
+
+    x, y = create_packing_data(200)
+    model = MockPackingModel()
+    model(x)
+    trainer = ClusterPackingTrainer(model=model, num_channels=2, cluster_batch_size=200, min_samples=5)
+    trainer.set_data(x, y)
+    trainer.update_clusters()
+
+    # The last partial batch of the epoch is kept and the cluster targets of each batch are the centers of the
+    # current labels, in the channel-major order of the embeddings.
+    dataset = trainer.create_dataset(x, y, batch_size=64)
+    sizes = []
+    for x_batch, y_batch, (centers_batch, mask_batch) in dataset.take(4):
+        indices = [int(np.argmin(np.abs(y[:, 0] - value))) for value in y_batch.numpy()[:, 0]]
+        assert np.allclose(x_batch.numpy(), x[indices])
+
+        labels = trainer.labels[indices].T.flatten()
+        assert np.allclose(mask_batch.numpy(), labels >= 0)
+        assert np.allclose(centers_batch.numpy()[labels >= 0], trainer.cluster_centers[labels[labels >= 0]])
+        sizes.append(len(indices))
+
+    assert sizes == [64, 64, 64, 8]
+
+
+def test_cluster_packing_trainer_fit_works():
+
+    x, y = create_packing_data(200)
+    model = MockPackingModel()
+    model(x)
+    trainer = ClusterPackingTrainer(
+        model=model,
+        num_channels=2,
+        cluster_batch_size=100,
+        cluster_epoch_step=2,
+        label_batch_size=50,
+        min_samples=5,
+        epochs_warmup=1,
+        factor=0.1,
+    )
+    trainer.compile(optimizer='adam', loss='mse')
+
+    # All the epochs are trained in a single run, in which the clustering is created after the warmup epoch and
+    # then re-created every 2 epochs, with the labels of a chunk being updated in between.
+    history = trainer.fit(x, y, batch_size=32, epochs=4, verbose=0)
+    assert len(history.history['loss']) == 4
+    assert trainer.epoch == 4
+    assert trainer.cluster_epoch == 3
+    assert trainer.label_offset == 100
+    assert np.isclose(trainer.var_factor.numpy(), 0.1)
@@ -0,0 +1,96 @@
+import os
+import json
+import tempfile
+
+import numpy as np
+
+from megan_global_explanations.serialization import dump_json
+from megan_global_explanations.serialization import load_json
+from megan_global_explanations.serialization import get_sidecar_path
+from megan_global_explanations.serialization import ARRAY_KEY
+from megan_global_explanations.serialization import append_frame
+from megan_global_explanations.serialization import iterate_frames
+
+
+def test_dump_json_works():
+    """
+    The dump_json function should save the large arrays into the binary sidecar file and only encode the 
+    small arrays and the other values into the JSON file itself. load_json should restore all of it.
+    """
+    data = {
+        'embeddings': np.random.random(size=(200, 16)),
+        'centroid': np.random.random(size=(16, )),
+        'index': np.int64(3),
+        'name': 'concept',
+        'elements': [{'index': i, 'mask': np.ones(shape=(2000, ), dtype=bool)} for i in range(3)],
+        1: [1.5, 2.5],
+    }
+    
+    with tempfile.TemporaryDirectory() as path:
+        json_path = os.path.join(path, 'data.json')
+        dump_json(data, json_path)
+        assert os.path.exists(get_sidecar_path(json_path))
+        
+        # The large arrays should only be references in the JSON file
+        with open(json_path) as file:
+            content = json.load(file)
+        assert ARRAY_KEY in content['embeddings']
+        assert ARRAY_KEY in content['elements'][0]['mask']
+        assert isinstance(content['centroid'], list)
+        
+        loaded = load_json(json_path)
+        assert np.allclose(loaded['embeddings'], data['embeddings'])
+        assert np.allclose(loaded['centroid'], data['centroid'])
+        assert loaded['index'] == 3
+        assert loaded['name'] == 'concept'
+        assert loaded['1'] == [1.5, 2.5]
+        for element, element_loaded in zip(data['elements'], loaded['elements']):
+            assert element_loaded['index'] == element['index']
+            assert np.array_equal(element_loaded['mask'], element['mask'])
+            
+        # Without any large arrays, a stale sidecar file should be removed
+        dump_json({'value': np.arange(10)}, json_path)
+        assert not os.path.exists(get_sidecar_path(json_path))
+        assert load_json(json_path) == {'value': list(range(10))}
+        
+        
+def test_dump_json_threshold_none_works():
+    """
+    With a threshold of None, all the arrays should be encoded into the JSON file itself.
+    """
+    data = {'embeddings': np.random.random(size=(100, 32))}
+    
+    with tempfile.TemporaryDirectory() as path:
+        json_path = os.path.join(path, 'data.json')
+        dump_json(data, json_path, threshold=None)
+        assert not os.path.exists(get_sidecar_path(json_path))
+        
+        with open(json_path) as file:
+            content = json.load(file)
+        assert np.allclose(content['embeddings'], data['embeddings'])
+        
+        
+def test_append_frame_iterate_frames_works():
+    """
+    The frames appended to a log file with append_frame should be read back in the same order by iterate_frames, 
+    where an incomplete last frame is ignored.
+    """
+    with tempfile.TemporaryDirectory() as path:
+        log_path = os.path.join(path, 'history.log')
+        for epoch in range(3):
+            append_frame(log_path, {
+                'epoch': epoch, 
+                'embeddings': np.random.random(size=(10, 2)), 
+                'labels': np.arange(10),
+            })
+            
+        frames = list(iterate_frames(log_path))
+        assert len(frames) == 3
+        assert [frame['epoch'] for frame in frames] == [0, 1, 2]
+        assert frames[0]['embeddings'].shape == (10, 2)
+        assert np.array_equal(frames[0]['labels'], np.arange(10))
+        
+        # Simulating a write that was interrupted in the middle of the last frame
+        with open(log_path, mode='r+b') as file:
+            file.truncate(os.path.getsize(log_path) - 20)
+        assert len(list(iterate_frames(log_path))) == 2
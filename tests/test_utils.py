@@ -1,5 +1,6 @@
 import os
 
+import pytest
 import torch
 import torch.nn as nn
 import pytorch_lightning as pl
@@ -7,6 +8,9 @@ import numpy as np
 from megan_global_explanations.utils import get_version
 from megan_global_explanations.utils import render_latex
 from megan_global_explanations.utils import sort_cluster_centroids
+from megan_global_explanations.utils import order_centroids
+from megan_global_explanations.utils import sort_concepts_by_similarity
+from megan_global_explanations.utils import content_hash
 
 from .util import ASSETS_PATH, ARTIFACTS_PATH
 
@@ -48,7 +52,79 @@ def test_sort_cluster_centroids():
     print('original', cluster_centroid_map)
     print('sorted', cluster_centroid_map_sorted)
     
+    # Every original label has to be mapped to exactly one of the new labels
+    assert set(label_mapping.keys()) == set(cluster_centroid_map.keys())
+    assert set(label_mapping.values()) == set(range(len(cluster_centroid_map)))
     
+    
+@pytest.mark.parametrize('method', ['greedy', 'two_opt', 'leaf'])
+def test_order_centroids_works(method):
+    """
+    The "order_centroids" function should return a permutation of the centroid indices for all the 
+    different ordering methods. The greedy method should start at the given start index.
+    """
+    centroids = np.random.random(size=(50, 8))
+    order = order_centroids(centroids, method=method)
+    
+    assert isinstance(order, np.ndarray)
+    assert order.shape == (50, )
+    assert set(order.tolist()) == set(range(50))
+    if method in ['greedy', 'two_opt']:
+        assert order[0] == 0
+        
+        
+def test_order_centroids_two_opt_not_worse_than_greedy():
+    """
+    The 2-opt refinement starts from the greedy ordering and only applies improving moves, so the 
+    resulting path length can never be larger than the one of the greedy ordering.
+    """
+    centroids = np.random.random(size=(100, 8))
+    
+    def path_length(order):
+        return np.sum(np.abs(centroids[order[1:]] - centroids[order[:-1]]))
+    
+    order_greedy = order_centroids(centroids, method='greedy', metric='manhattan')
+    order_two_opt = order_centroids(centroids, method='two_opt', metric='manhattan')
+    assert path_length(order_two_opt) <= path_length(order_greedy) + 1e-6
+    
+    
+def test_sort_concepts_by_similarity_works():
+    """
+    The "sort_concepts_by_similarity" function should keep all the concepts, group them by channel and 
+    update the "index" attribute to reflect the new order.
+    """
+    concepts = [
+        {'index': i, 'channel_index': i % 2, 'centroid': np.random.random(size=(8, ))}
+        for i in range(10)
+    ]
+    concepts_sorted = sort_concepts_by_similarity(concepts, num_channels=2)
+    
+    assert len(concepts_sorted) == 10
+    assert [concept['index'] for concept in concepts_sorted] == list(range(10))
+    assert [concept['channel_index'] for concept in concepts_sorted] == [0] * 5 + [1] * 5
+    
+    
+def test_content_hash_works():
+    """
+    The content_hash function should return the same hash for values with the same content and a 
+    different hash as soon as any part of the (nested) values changes.
+    """
+    array = np.random.random(size=(10, 3))
+    value = {'array': array, 'list': [1, 2.0, 'three'], 'size': (5, 5)}
+    
+    hash_1 = content_hash(value, 10)
+    assert isinstance(hash_1, str)
+    assert hash_1 == content_hash({'size': (5, 5), 'list': [1, 2.0, 'three'], 'array': array.copy()}, 10)
+    
+    assert hash_1 != content_hash(value, 11)
+    assert hash_1 != content_hash({**value, 'size': [5, 5]}, 10)
+    
+    array_modified = array.copy()
+    array_modified[0, 0] += 1e-6
+    assert hash_1 != content_hash({**value, 'array': array_modified}, 10)
+    assert content_hash(array) != content_hash(array.astype(np.float32))
+
+
 def test_torch_checkpointing():
     """
     This test checks if the torch checkpointing works as expected. This is important because
@@ -9,7 +9,10 @@ import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from weasyprint import HTML
+from pypdf import PdfReader
 from lorem_text import lorem
+from sklearn.decomposition import PCA
+from PIL import Image
 
 from visual_graph_datasets.visualization.base import create_frameless_figure, draw_image
 from visual_graph_datasets.visualization.importances import plot_node_importances_background
@@ -17,6 +20,11 @@ from visual_graph_datasets.visualization.importances import plot_edge_importance
 from megan_global_explanations.visualization import create_concept_cluster_report
 from megan_global_explanations.visualization import generate_contrastive_colors
 from megan_global_explanations.visualization import concept_umap_visualization
+from megan_global_explanations.visualization import stratified_subsample
+from megan_global_explanations.visualization import fit_transform_mapper
+from megan_global_explanations.visualization import fit_history_projection
+from megan_global_explanations.visualization import animate_deepect_history
+from megan_global_explanations.serialization import append_frame
 
 from .util import ARTIFACTS_PATH
 from .util import LOG
@@ -59,6 +67,73 @@ def test_concept_umap_visualization_works():
     fig.savefig(fig_path)
 
     
+def test_stratified_subsample_works():
+    """
+    The stratified_subsample function should return a subsample of the given size in which all the labels 
+    are represented proportionally - and every label at least once.
+    """
+    labels = np.array([0] * 900 + [1] * 90 + [2] * 10)
+    indices = stratified_subsample(labels, num_samples=100, random_state=0)
+    
+    assert len(indices) == 100
+    assert len(set(indices.tolist())) == 100
+    assert np.bincount(labels[indices]).tolist() == [90, 9, 1]
+    
+    # If more samples are requested than there are elements, all the elements are returned
+    indices = stratified_subsample(labels, num_samples=2000)
+    assert len(indices) == len(labels)
+    
+    
+def test_fit_transform_mapper_works():
+    """
+    The fit_transform_mapper function should fit the mapper only on the subsample, if the number of fit 
+    samples is given, and map all the remaining embeddings with the fitted mapper as well.
+    """
+    embeddings = np.random.random(size=(1000, 10))
+    labels = np.random.randint(0, 5, size=(1000, ))
+    
+    mapper = PCA(n_components=2)
+    mapped = fit_transform_mapper(
+        mapper=mapper, 
+        embeddings=embeddings, 
+        labels=labels, 
+        num_fit_samples=100,
+        batch_size=128,
+    )
+    assert mapped.shape == (1000, 2)
+    assert mapper.n_samples_ <= 105
+    assert np.allclose(mapped, mapper.transform(embeddings))
+    
+    
+def test_animate_deepect_history_works():
+    """
+    The animate_deepect_history function should create a GIF with one frame per epoch from the frames of a 
+    history log file, which are projected into 2D with a shared projection.
+    """
+    with tempfile.TemporaryDirectory() as path:
+        log_path = os.path.join(path, 'history.log')
+        for epoch in range(5):
+            labels = np.random.randint(1, 4, size=(100, ))
+            embeddings = np.random.normal(size=(100, 8)) + labels[:, None]
+            append_frame(log_path, {
+                'epoch': epoch,
+                'embeddings': embeddings,
+                'labels': labels,
+                'leafs': np.array([1, 2, 3]),
+                'centers': np.stack([embeddings[labels == k].mean(axis=0) for k in [1, 2, 3]]),
+                'weights': np.array([1.0, 1.0, 1.0]),
+            })
+            
+        mean, components = fit_history_projection(log_path, num_fit_samples=200)
+        assert mean.shape == (8, )
+        assert components.shape == (8, 2)
+        
+        output_path = os.path.join(ARTIFACTS_PATH, 'animate_deepect_history_works.gif')
+        animate_deepect_history(log_path, output_path, fig_size=(5, 5))
+        assert os.path.exists(output_path)
+        assert Image.open(output_path).n_frames == 5
+    
+    
 def test_generate_contrastive_colors():
     """
     If the generation of colors with a high contrast works
@@ -139,6 +214,119 @@ def test_create_concept_cluster_report_cache_path_works():
         assert len(files) != 0
         
         
+def test_create_concept_cluster_report_figure_cache_works():
+    """
+    When the report is created a second time with the same cache_path, the figures should not be 
+    created again. Only the figures of a concept whose data was changed should be re-created.
+    """
+    cluster_data_list = load_mock_clusters()
+    
+    with tempfile.TemporaryDirectory() as temp_path:
+        
+        cache_path = os.path.join(temp_path, 'cache')
+        os.mkdir(cache_path)
+        output_path = os.path.join(temp_path, 'report.pdf')
+        
+        kwargs = dict(
+            path=output_path,
+            cache_path=cache_path,
+            examples_type='centroid',
+        )
+        create_concept_cluster_report(cluster_data_list=cluster_data_list, **kwargs)
+        mtimes = {name: os.path.getmtime(os.path.join(cache_path, name)) 
+                  for name in os.listdir(cache_path) if name.endswith('.png')}
+        
+        # Changing the embeddings of the first concept changes the centroid distances figure of that 
+        # concept only.
+        cluster_data_list[0]['embeddings'] = np.array(cluster_data_list[0]['embeddings']) * 2
+        create_concept_cluster_report(cluster_data_list=cluster_data_list, **kwargs)
+        
+        names_new = [name for name in os.listdir(cache_path) if name.endswith('.png') and name not in mtimes]
+        assert len(names_new) != 0
+        for name in names_new:
+            assert name.startswith(f'{cluster_data_list[0]["index"]:02d}_')
+            
+        for name, mtime in mtimes.items():
+            assert os.path.getmtime(os.path.join(cache_path, name)) == mtime
+        
+        
+def test_create_concept_cluster_report_num_workers_works():
+    """
+    With the "num_workers" option, the individual cluster pages should be created in parallel by a process 
+    pool. The fragments of all the pages should still be merged into the report in the original order.
+    """
+    cluster_data_list = load_mock_clusters()
+    
+    with tempfile.TemporaryDirectory() as temp_path:
+        
+        cache_path = os.path.join(temp_path, 'cache')
+        os.mkdir(cache_path)
+        
+        output_path = os.path.join(ARTIFACTS_PATH, 'test_create_concept_cluster_report_num_workers_works.pdf')
+        create_concept_cluster_report(
+            cluster_data_list=cluster_data_list,
+            path=output_path,
+            cache_path=cache_path,
+            num_workers=2,
+        )
+        
+        assert os.path.exists(output_path)
+        files = os.listdir(cache_path)
+        for data in cluster_data_list:
+            assert f'{data["index"]:02d}_page.html' in files
+        
+        
+def test_create_concept_cluster_report_chunk_size_works():
+    """
+    With the "chunk_size" option, the report PDF should be converted in separate parts which are then 
+    concatenated into a single PDF file that contains the pages of all the clusters.
+    """
+    cluster_data_list = load_mock_clusters(num_clusters=3)
+    
+    output_path = os.path.join(ARTIFACTS_PATH, 'test_create_concept_cluster_report_chunk_size_works.pdf')
+    if os.path.exists(output_path):
+        os.remove(output_path)
+        
+    create_concept_cluster_report(
+        cluster_data_list=cluster_data_list,
+        path=output_path,
+        chunk_size=1,
+        num_workers=2,
+    )
+    assert os.path.exists(output_path)
+    
+    # Every cluster takes up at least two pages in the report
+    reader = PdfReader(output_path)
+    assert len(reader.pages) >= 2 * len(cluster_data_list)
+    
+    
+def test_create_concept_cluster_report_html_works():
+    """
+    With the report_format "html", a single HTML file should be created instead of the PDF, which 
+    references the lazily loaded figure images that are stored in a folder next to it.
+    """
+    cluster_data_list = load_mock_clusters()
+    
+    with tempfile.TemporaryDirectory() as temp_path:
+        
+        output_path = os.path.join(temp_path, 'report.html')
+        create_concept_cluster_report(
+            cluster_data_list=cluster_data_list,
+            path=output_path,
+            report_format='html',
+        )
+        assert os.path.exists(output_path)
+        
+        with open(output_path) as file:
+            content = file.read()
+        assert '<style>' in content
+        assert 'loading="lazy"' in content
+        
+        files_path = os.path.join(temp_path, 'report_files')
+        assert os.path.isdir(files_path)
+        assert len(os.listdir(files_path)) != 0
+        
+        
 def test_create_cluster_report_prototype_works():
     
     num_channels = 2